@@ -0,0 +1,53 @@
+"""Cached lookups of Stellar accounts on Horizon."""
+import copy
+import logging
+
+import cache
+
+LOGGER = logging.getLogger('pkt.api')
+
+
+class AccountCache:
+    """
+    A TTL cache in front of an account lookup (a network round trip to Horizon).
+    Concurrent misses for an account share a single lookup. Lookups that started before an account was invalidated
+    are neither cached nor shared with later callers, so a client reading its account after a transaction sees it.
+    """
+
+    def __init__(self, lookup, max_size=1000, ttl=5):
+        self.lookup = lookup
+        self.cache = cache.LRUCache(max_size, ttl)
+        self.single_flight = cache.SingleFlight()
+        # Incremented by clear, which forgets the generations of the accounts.
+        self.epoch = 0
+
+    def get(self, pubkey):
+        """Get the details of an account."""
+        account = self.cache.get(pubkey)
+        if account is None:
+            epoch, generation = self.epoch, self.cache.generation()
+            account = self.single_flight.call(
+                (pubkey, epoch, generation), lambda: self.load(pubkey, epoch, generation))
+        return copy.deepcopy(account)
+
+    def load(self, pubkey, epoch, generation):
+        """Look an account up and cache it, unless it was invalidated (or the cache cleared) in the meantime."""
+        LOGGER.debug("looking up account %s", pubkey)
+        account = self.lookup(pubkey)
+        self.cache.set(pubkey, account, generation)
+        if epoch != self.epoch:
+            self.cache.invalidate(pubkey)
+        return account
+
+    def invalidate(self, pubkey):
+        """Drop an account, which may have changed."""
+        self.cache.invalidate(pubkey)
+
+    def clear(self):
+        """Drop all accounts."""
+        self.epoch += 1
+        self.cache.clear()
+
+    def stats(self):
+        """Get cache and lookup statistics."""
+        return dict(self.cache.stats(), lookups=self.single_flight.stats())
@@ -0,0 +1,71 @@
+"""Running several API calls in a single HTTP round trip."""
+import json
+import logging
+
+import flask
+
+LOGGER = logging.getLogger('pkt.api')
+
+
+def parse_batch(requests, max_requests):
+    """
+    Parse and check the JSON list of sub-requests of a batch: up to max_requests objects with a path (like
+    "/v3/package"), and optional data and headers objects.
+    """
+    try:
+        subrequests = json.loads(requests)
+    except ValueError:
+        raise ValueError('requests must be a JSON list')
+    if not isinstance(subrequests, list) or not subrequests:
+        raise ValueError('requests must be a non empty JSON list')
+    if len(subrequests) > max_requests:
+        raise ValueError("a batch can not hold more than {} requests".format(max_requests))
+    for index, subrequest in enumerate(subrequests):
+        if not isinstance(subrequest, dict) or not isinstance(subrequest.get('path'), str):
+            raise ValueError("request {} has no path".format(index))
+        for key in ('data', 'headers'):
+            if not isinstance(subrequest.get(key, {}), dict):
+                raise ValueError("request {} {} must be an object".format(index, key))
+    return [{
+        'path': subrequest['path'],
+        'data': {key: str(value) for key, value in subrequest.get('data', {}).items() if value is not None},
+        # Sub-responses are embedded in the batch response, which is compressed as a whole.
+        'headers': {
+            key: str(value) for key, value in subrequest.get('headers', {}).items()
+            if key.lower() != 'accept-encoding'}}
+            for subrequest in subrequests]
+
+
+def dispatch_subrequest(app, url_root, subrequest, blueprint_name, excluded_endpoints=()):
+    """
+    Run a sub-request of a batch through the app, in a request context of its own, so that it is validated and
+    authenticated (by its own Pubkey, Fingerprint and Signature headers) like a standalone request.
+    Only the endpoints of a blueprint, but the excluded ones, can be batched.
+    Returns the status and the body of its response.
+    """
+    with app.test_request_context(
+            subrequest['path'], base_url=url_root, method='POST', data=subrequest['data'],
+            headers=subrequest['headers']):
+        routing_exception = flask.request.routing_exception
+        if routing_exception is not None:
+            return {
+                'status': getattr(routing_exception, 'code', 404),
+                'error': "{} is not a valid path".format(subrequest['path'])}
+        if flask.request.blueprint != blueprint_name or flask.request.endpoint in excluded_endpoints:
+            return {'status': 400, 'error': "{} can not be batched".format(subrequest['path'])}
+        try:
+            response = app.full_dispatch_request()
+        # pylint: disable=broad-except
+        # A failing sub-request must not fail the whole batch.
+        except Exception:
+            LOGGER.exception("batched request to %s failed", subrequest['path'])
+            return {'status': 500, 'error': 'internal server error'}
+        # pylint: enable=broad-except
+        result = {'status': response.status_code, 'body': None}
+        if response.headers.get('ETag'):
+            result['etag'] = response.headers['ETag']
+        if response.status_code != 304 and response.is_json:
+            result['body'] = json.loads(response.get_data())
+        elif response.status_code != 304:
+            result['body'] = response.get_data(as_text=True)
+        return result
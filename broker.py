@@ -0,0 +1,98 @@
+"""Publish/subscribe brokers, for sharing notifications between workers."""
+import collections
+import json
+import logging
+import threading
+import uuid
+
+LOGGER = logging.getLogger('pkt.api')
+
+
+class LocalBroker:
+    """
+    An in-process broker, delivering messages synchronously to the subscribers of this process.
+    Several subscribers of a single LocalBroker behave like several workers sharing a broker, which makes it a
+    stand-in for a shared broker in tests.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = collections.defaultdict(list)
+
+    def subscribe(self, channel, callback):
+        """Call callback with every message published on channel."""
+        with self.lock:
+            self.subscribers[channel].append(callback)
+        return callback
+
+    def unsubscribe(self, channel, callback):
+        """Stop calling callback with messages published on channel."""
+        with self.lock:
+            self.subscribers[channel].remove(callback)
+
+    def publish(self, channel, message):
+        """Deliver a message to all the subscribers of a channel."""
+        with self.lock:
+            callbacks = list(self.subscribers[channel])
+        for callback in callbacks:
+            try:
+                callback(message)
+            # pylint: disable=broad-except
+            # A failing subscriber must not prevent delivery to the others, or fail the publisher.
+            except Exception:
+                LOGGER.exception("subscriber of %s failed", channel)
+            # pylint: enable=broad-except
+
+
+class RedisBroker:
+    """
+    A broker shared by all the workers connected to a Redis server.
+    Messages are JSON encoded. They are delivered synchronously to the subscribers of the publishing worker, and
+    to the subscribers of every other worker by a listener thread.
+    """
+
+    def __init__(self, url):
+        # Redis is an optional dependency, only required when a shared broker is configured.
+        # pylint: disable=import-error
+        import redis
+        # pylint: enable=import-error
+        self.redis = redis.StrictRedis.from_url(url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.local = LocalBroker()
+        self.lock = threading.Lock()
+        self.listener = None
+        self.origin = uuid.uuid4().hex
+
+    def dispatch(self, message):
+        """Deliver a message received from another worker to local subscribers."""
+        channel = message['channel']
+        envelope = json.loads(message['data'])
+        if envelope['origin'] != self.origin:
+            self.local.publish(channel.decode() if isinstance(channel, bytes) else channel, envelope['message'])
+
+    def subscribe(self, channel, callback):
+        """Call callback with every message published on channel, by any worker."""
+        with self.lock:
+            if not self.local.subscribers[channel]:
+                self.pubsub.subscribe(**{channel: self.dispatch})
+            self.local.subscribe(channel, callback)
+            if self.listener is None:
+                self.listener = self.pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+        return callback
+
+    def unsubscribe(self, channel, callback):
+        """Stop calling callback with messages published on channel."""
+        self.local.unsubscribe(channel, callback)
+
+    def publish(self, channel, message):
+        """Publish a message to the subscribers of all workers."""
+        self.local.publish(channel, message)
+        self.redis.publish(channel, json.dumps({'origin': self.origin, 'message': message}, default=str))
+
+
+def get_broker(url=None):
+    """Get a shared broker if a URL is given, or an in-process one otherwise."""
+    if url:
+        LOGGER.info("using shared broker at %s", url.split('@')[-1])
+        return RedisBroker(url)
+    return LocalBroker()
@@ -0,0 +1,150 @@
+"""In-process LRU cache with time based expiry."""
+import collections
+import threading
+import time
+
+
+# pylint: disable=too-many-instance-attributes
+# The invalidation bookkeeping sits next to the entries, as both are guarded by the same lock.
+class LRUCache:
+    """
+    A thread-safe, size bounded LRU cache whose entries expire ttl seconds after being set.
+    To avoid caching values that were loaded before a concurrent invalidation, get the cache's generation before
+    loading and pass it to set - the value will only be stored if the key was not invalidated in the meantime.
+    Invalidations are remembered apart from the entries (so they take no entry slots), up to max_size of them: once
+    one is forgotten, values loaded before it are not stored, whatever their key.
+    """
+
+    def __init__(self, max_size=1000, ttl=10):
+        if max_size < 1:
+            raise ValueError("invalid cache size {}".format(max_size))
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        # Invalidations are numbered, and the number of the last invalidation of each key is kept, oldest first.
+        self.invalidations_num = 0
+        self.invalidated = collections.OrderedDict()
+        self.forgotten_invalidation = 0
+        self.counters = dict(hits=0, misses=0, evictions=0, expirations=0, invalidations=0, stale_sets=0)
+
+    def get(self, key, default=None):
+        """Get a cached value, or default if it is missing, expired or invalidated."""
+        with self.lock:
+            if key not in self.entries:
+                self.counters['misses'] += 1
+                return default
+            value, expires_at = self.entries[key]
+            if expires_at < time.monotonic():
+                self.counters['misses'] += 1
+                self.counters['expirations'] += 1
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+
+    def generation(self):
+        """Get the current generation of the cache, to pass to set (the number of invalidations so far)."""
+        with self.lock:
+            return self.invalidations_num
+
+    def set(self, key, value, generation=None):
+        """Cache a value, unless the key has been invalidated since generation was read."""
+        with self.lock:
+            if generation is not None and self.invalidated.get(key, self.forgotten_invalidation) > generation:
+                self.counters['stale_sets'] += 1
+                return False
+            self.entries[key] = value, time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+            return True
+
+    def invalidate(self, key):
+        """Invalidate a key."""
+        with self.lock:
+            self.counters['invalidations'] += 1
+            self.entries.pop(key, None)
+            self.invalidations_num += 1
+            self.invalidated[key] = self.invalidations_num
+            self.invalidated.move_to_end(key)
+            while len(self.invalidated) > self.max_size:
+                _, self.forgotten_invalidation = self.invalidated.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries, as if all keys were invalidated."""
+        with self.lock:
+            self.entries.clear()
+            self.invalidations_num += 1
+            self.invalidated.clear()
+            self.forgotten_invalidation = self.invalidations_num
+
+    def stats(self):
+        """Get cache statistics."""
+        with self.lock:
+            stats = dict(self.counters, size=len(self.entries), max_size=self.max_size)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0
+        return stats
+# pylint: enable=too-many-instance-attributes
+
+
+# pylint: disable=too-few-public-methods
+# A plain record of a call in progress, filled in by the SingleFlight making it.
+class Flight:
+    """A call in progress, whose result (or exception) is shared by all the callers waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+    def wait(self):
+        """Wait for the call to end, and return its result (or raise its exception)."""
+        self.done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+# pylint: enable=too-few-public-methods
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls by key: while a call for a key is in progress, other calls for the same key wait for
+    it and share its result (or exception) instead of making calls of their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.counters = dict(calls=0, coalesced=0)
+
+    def call(self, key, function):
+        """Call function, unless a call for key is already in progress, in which case wait for its result."""
+        with self.lock:
+            flight = self.flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self.flights[key] = Flight()
+                self.counters['calls'] += 1
+            else:
+                self.counters['coalesced'] += 1
+        if not leading:
+            return flight.wait()
+        try:
+            flight.result = function()
+        except Exception as exception:
+            flight.exception = exception
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        """Get call statistics."""
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.flights))
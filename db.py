@@ -1,16 +1,168 @@
 """PaKeT database interface."""
+import atexit
+import base64
+import copy
+import datetime
+import json
 import logging
 import os
 
+import mysql.connector
 import util.db
 
+import broker
+import cache
+import db_rows
+import event_buffer
+import geo
+import migrations
+import pool
+import replicas
+import rollups
+import sqlite_engine
+import updates
+
 LOGGER = logging.getLogger('pkt.db')
+# The storage engine, either 'mysql' (the default) or 'sqlite' for single node deployments and hermetic tests.
+DB_ENGINE = os.environ.get('PAKET_DB_ENGINE', 'mysql')
 DB_HOST = os.environ.get('PAKET_DB_HOST', '127.0.0.1')
 DB_PORT = int(os.environ.get('PAKET_DB_PORT', 3306))
 DB_USER = os.environ.get('PAKET_DB_USER', 'root')
 DB_PASSWORD = os.environ.get('PAKET_DB_PASSWORD')
 DB_NAME = os.environ.get('PAKET_DB_NAME', 'paket')
-SQL_CONNECTION = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+DB_PATH = os.environ.get('PAKET_DB_PATH', "{}.sqlite3".format(DB_NAME))
+DB_POOL_MIN_SIZE = int(os.environ.get('PAKET_DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('PAKET_DB_POOL_MAX_SIZE', 10))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('PAKET_DB_POOL_IDLE_TIMEOUT', 300))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('PAKET_DB_POOL_MAX_LIFETIME', 3600))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('PAKET_DB_POOL_CHECKOUT_TIMEOUT', 10))
+DB_POOL_HEALTH_CHECK = os.environ.get('PAKET_DB_POOL_HEALTH_CHECK', '1') == '1'
+DB_POOL_REAP_INTERVAL = float(os.environ.get('PAKET_DB_POOL_REAP_INTERVAL', 30))
+# Comma separated host[:port] list of read replicas, e.g. "replica1:3306,replica2".
+DB_REPLICA_HOSTS = [host for host in os.environ.get('PAKET_DB_REPLICA_HOSTS', '').split(',') if host]
+DB_REPLICA_MAX_LAG = float(os.environ.get('PAKET_DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_RETRY_INTERVAL = float(os.environ.get('PAKET_DB_REPLICA_RETRY_INTERVAL', 30))
+DB_READ_YOUR_WRITES_WINDOW = float(os.environ.get('PAKET_DB_READ_YOUR_WRITES_WINDOW', 10))
+
+
+def create_sql_connection(host, port):
+    """
+    Create an SQL connection context manager for a database host, and its pool.
+    Setting PAKET_DB_POOL_MAX_SIZE to 0 disables pooling, opening a connection per call.
+    """
+    if not DB_POOL_MAX_SIZE:
+        return None, util.db.custom_sql_connection(host, port, DB_USER, DB_PASSWORD, DB_NAME)
+    connection_pool = pool.ConnectionPool(
+        lambda: mysql.connector.connect(host=host, port=port, user=DB_USER, password=DB_PASSWORD, database=DB_NAME),
+        DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_IDLE_TIMEOUT, DB_POOL_MAX_LIFETIME, DB_POOL_CHECKOUT_TIMEOUT,
+        DB_POOL_HEALTH_CHECK, reap_interval=DB_POOL_REAP_INTERVAL)
+    return connection_pool, connection_pool.sql_connection
+
+
+if DB_ENGINE == 'sqlite':
+    SQLITE_DATABASE = sqlite_engine.SQLiteDatabase(DB_PATH)
+    POOL, SQL_CONNECTION = None, SQLITE_DATABASE.sql_connection
+    if DB_REPLICA_HOSTS:
+        LOGGER.warning('read replicas are not supported by the sqlite engine - ignoring them')
+        DB_REPLICA_HOSTS = []
+elif DB_ENGINE == 'mysql':
+    SQLITE_DATABASE = None
+    POOL, SQL_CONNECTION = create_sql_connection(DB_HOST, DB_PORT)
+else:
+    raise ValueError("unknown database engine {}, must be mysql or sqlite".format(DB_ENGINE))
+REPLICA_POOLS = {}
+for replica_host in DB_REPLICA_HOSTS:
+    REPLICA_POOLS[replica_host] = create_sql_connection(
+        replica_host.split(':')[0], int(replica_host.split(':')[1]) if ':' in replica_host else DB_PORT)
+
+
+def primary_sql_connection():
+    """Get a connection to the primary, through the current SQL_CONNECTION of the module (so it can be swapped)."""
+    return SQL_CONNECTION()
+
+
+REPLICA_ROUTER = replicas.ReplicaRouter(
+    primary_sql_connection,
+    [(replica_host, sql_connection) for replica_host, (_, sql_connection) in REPLICA_POOLS.items()],
+    DB_REPLICA_MAX_LAG, retry_interval=DB_REPLICA_RETRY_INTERVAL,
+    read_your_writes_window=DB_READ_YOUR_WRITES_WINDOW) if REPLICA_POOLS else None
+# With PAKET_DB_EVENT_BUFFER set to 1, add_event queues events to be written in batches by a background thread.
+DB_EVENT_BUFFER = os.environ.get('PAKET_DB_EVENT_BUFFER', '0') == '1'
+DB_EVENT_BATCH_SIZE = int(os.environ.get('PAKET_DB_EVENT_BATCH_SIZE', 200))
+DB_EVENT_FLUSH_INTERVAL = float(os.environ.get('PAKET_DB_EVENT_FLUSH_INTERVAL', 0.05))
+DB_EVENT_QUEUE_SIZE = int(os.environ.get('PAKET_DB_EVENT_QUEUE_SIZE', 10000))
+# Set PAKET_BROKER_URL (e.g. redis://localhost:6379/0) to share cache invalidations between workers.
+BROKER_URL = os.environ.get('PAKET_BROKER_URL')
+BROKER = broker.get_broker(BROKER_URL)
+# Enriched packages are cached for PAKET_DB_PACKAGE_CACHE_TTL seconds. Setting the size to 0 disables the cache.
+# As workers only see each other's writes through the broker, the cache is disabled by default without one.
+DB_PACKAGE_CACHE_SIZE = int(os.environ.get('PAKET_DB_PACKAGE_CACHE_SIZE', 1000 if BROKER_URL else 0))
+DB_PACKAGE_CACHE_TTL = float(os.environ.get('PAKET_DB_PACKAGE_CACHE_TTL', 10))
+PACKAGE_CACHE = cache.LRUCache(DB_PACKAGE_CACHE_SIZE, DB_PACKAGE_CACHE_TTL) if DB_PACKAGE_CACHE_SIZE else None
+PACKAGE_INVALIDATION_CHANNEL = 'pkt.packages.invalidate'
+WRITES_CHANNEL = 'pkt.db.writes'
+PACKAGE_EVENTS_CHANNEL = 'pkt.packages.events'
+if PACKAGE_CACHE:
+    BROKER.subscribe(PACKAGE_INVALIDATION_CHANNEL, PACKAGE_CACHE.invalidate)
+if REPLICA_ROUTER:
+    BROKER.subscribe(WRITES_CHANNEL, REPLICA_ROUTER.mark_written)
+# New package events are published on the broker, and handed to the clients waiting for them by the updates hub.
+UPDATES_HUB = updates.UpdatesHub(BROKER, PACKAGE_EVENTS_CHANNEL)
+# Ordered so that referencing tables are cleared before the tables they reference.
+DATA_TABLES = ('events', 'packages', 'event_rollups', 'event_rollup_users', 'transaction_submissions')
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+EVENTS_SORT_COLUMNS = ('timestamp', 'id')
+PACKAGES_SORT_COLUMNS = ('launch_date', 'escrow_pubkey')
+# Event types that change package status, from weakest to strongest.
+STATUS_EVENT_TYPES = ('launched', 'couriered', 'received')
+USER_ROLES = ('launcher', 'recipient', 'courier')
+# Event scopes: events of packages, or events of users (with no package).
+EVENT_SCOPES = {'package': 'escrow_pubkey IS NOT NULL', 'user': 'escrow_pubkey IS NULL'}
+NEARBY_RADIUS_KM = 10
+STATS_DEFAULT_DAYS = 30
+PACKAGE_SUMMARY_COLUMNS = (
+    'escrow_pubkey', 'launcher_pubkey', 'recipient_pubkey', 'deadline', 'payment', 'collateral',
+    'status', 'custodian_pubkey', 'launch_date', 'last_event_at', 'state_version', 'latitude', 'longitude')
+PACKAGE_TRANSACTION_COLUMNS = (
+    'set_options_transaction', 'refund_transaction', 'merge_transaction', 'payment_transaction')
+PACKAGE_COLUMNS = PACKAGE_SUMMARY_COLUMNS + PACKAGE_TRANSACTION_COLUMNS
+# Package views, as (selected columns, load events).
+PACKAGE_VIEWS = {
+    'full': (PACKAGE_COLUMNS, True),
+    'summary': (PACKAGE_SUMMARY_COLUMNS, False)}
+# Resolve all the roles of a user in one round trip. Each branch is paginated on its own, using its own index, so
+# the union never holds more than three pages.
+USER_PACKAGES_QUERY = """
+    SELECT {columns}, user_packages.user_roles FROM (
+        SELECT escrow_pubkey, GROUP_CONCAT(user_role) AS user_roles FROM (
+            SELECT * FROM (
+                SELECT escrow_pubkey, launch_date, 'launcher' AS user_role FROM packages
+                WHERE launcher_pubkey = %s AND {condition}{suffix}) AS launched
+            UNION SELECT * FROM (
+                SELECT escrow_pubkey, launch_date, 'recipient' AS user_role FROM packages
+                WHERE recipient_pubkey = %s AND {condition}{suffix}) AS received
+            UNION SELECT * FROM (
+                SELECT DISTINCT packages.escrow_pubkey, packages.launch_date, 'courier' AS user_role
+                FROM events JOIN packages ON packages.escrow_pubkey = events.escrow_pubkey
+                WHERE events.user_pubkey = %s AND events.event_type = 'couriered'
+                AND {qualified_condition}{qualified_suffix}) AS couriered
+        ) AS roles GROUP BY escrow_pubkey
+    ) AS user_packages JOIN packages ON packages.escrow_pubkey = user_packages.escrow_pubkey
+    WHERE {qualified_condition}{qualified_suffix}"""
+PACKAGE_EVENTS_QUERY = """
+    SELECT timestamp, user_pubkey, event_type, location FROM events
+    WHERE escrow_pubkey = %s
+    ORDER BY timestamp ASC"""
+PACKAGES_VERSION_QUERY = """
+    SELECT COUNT(*) AS packages_num, SUM(state_version) AS state_versions FROM packages
+    WHERE escrow_pubkey IN (
+        SELECT escrow_pubkey FROM packages WHERE launcher_pubkey = %s
+        UNION SELECT escrow_pubkey FROM packages WHERE recipient_pubkey = %s
+        UNION SELECT escrow_pubkey FROM events WHERE user_pubkey = %s AND event_type = 'couriered')"""
+NEARBY_PACKAGES_QUERY = """
+    SELECT {} FROM packages
+    WHERE status = %s AND latitude BETWEEN %s AND %s AND longitude BETWEEN %s AND %s
+    ORDER BY launch_date ASC"""
 
 
 class UnknownUser(Exception):
@@ -25,86 +177,426 @@ class UnknownPaket(Exception):
     """Unknown paket ID."""
 
 
-def jsonable(list_of_dicts):
-    """Fix for mysql-connector bug which makes sql.fetchall() return some keys as (unjsonable) bytes."""
-    return [{
-        key.decode('utf8') if isinstance(key, bytes) else key: val for key, val in dict_.items()}
-            for dict_ in list_of_dicts]
+class InvalidCursor(Exception):
+    """Invalid pagination cursor."""
+
+
+class UnknownField(Exception):
+    """Unknown package field or view."""
+
+
+class InvalidFilter(Exception):
+    """Invalid event filter."""
+
+
+def get_pool_stats():
+    """Get statistics of the connection pool."""
+    if SQLITE_DATABASE:
+        return SQLITE_DATABASE.stats()
+    return POOL.stats() if POOL else {'max_size': 0}
+
+
+def get_replica_stats():
+    """Get statistics of read routing between the primary and the replicas, and of the replica pools."""
+    if not REPLICA_ROUTER:
+        return {}
+    return dict(REPLICA_ROUTER.stats(), pools={
+        replica_host: replica_pool.stats() for replica_host, (replica_pool, _) in REPLICA_POOLS.items()
+        if replica_pool})
+
+
+def read_sql_connection(*keys):
+    """
+    Get an SQL connection context manager for reading data concerning keys (user or escrow pubkeys).
+    Reads go to a replica if any is configured and healthy, unless one of the keys was recently written.
+    """
+    if REPLICA_ROUTER:
+        return REPLICA_ROUTER.read_connection(keys)
+    return SQL_CONNECTION()
+
+
+def mark_written(keys):
+    """Mark keys as recently written, sending their reads to the primary for a while, on all workers."""
+    if REPLICA_ROUTER:
+        BROKER.publish(WRITES_CHANNEL, list(set(keys) - {None}))
+
+
+def encode_cursor(*values):
+    """Encode the sort key values of the last row of a page into an opaque pagination cursor."""
+    return base64.urlsafe_b64encode(json.dumps([
+        value.strftime(CURSOR_TIMESTAMP_FORMAT) if isinstance(value, datetime.datetime) else value
+        for value in values]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor into a pair of sort key values, the first being a timestamp (or None for NULL)."""
+    try:
+        timestamp, tie_breaker = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if timestamp is None:
+            return None, tie_breaker
+        return datetime.datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), tie_breaker
+    except (ValueError, TypeError) as exception:
+        raise InvalidCursor("invalid cursor {}: {}".format(cursor, exception))
+
+
+def page_clauses(sort_columns, cursor=None, limit=None):
+    """
+    Build the clauses of a keyset paginated query, ordered by a (timestamp, tie breaker) pair of columns.
+    Returns a condition selecting the rows after the cursor, and an ordering and limiting suffix, each with its params.
+    NULL timestamps come first (both MySQL and SQLite sort them first in ascending order), so the rows following a
+    NULL one are those with a timestamp, and those with a NULL one and a greater tie breaker.
+    """
+    condition, condition_params = '1 = 1', ()
+    if cursor:
+        after_timestamp, after_tie_breaker = decode_cursor(cursor)
+        if after_timestamp is None:
+            condition = "({0} IS NOT NULL OR ({0} IS NULL AND {1} > %s))".format(*sort_columns)
+            condition_params = (after_tie_breaker,)
+        else:
+            condition = "({0} > %s OR ({0} = %s AND {1} > %s))".format(*sort_columns)
+            condition_params = (after_timestamp, after_timestamp, after_tie_breaker)
+    suffix = " ORDER BY {} ASC, {} ASC".format(*sort_columns)
+    suffix_params = ()
+    if limit:
+        suffix += ' LIMIT %s'
+        suffix_params = (int(limit),)
+    return condition, condition_params, suffix, suffix_params
+
+
+def next_page_cursor(rows, sort_columns, limit):
+    """Get the cursor of the page following a page of rows, or None if it is the last page."""
+    if not limit or len(rows) < int(limit):
+        return None
+    return encode_cursor(*[rows[-1][column] for column in sort_columns])
+
+
+def package_projection(view=None, fields=None):
+    """
+    Get the columns to select and whether to load events, either for a view ('full' or 'summary') or for a comma
+    separated list of fields (columns and 'events'). The sort columns are always selected.
+    """
+    if fields:
+        fields = {field.strip() for field in fields.split(',')} - {''}
+        unknown_fields = fields - set(PACKAGE_COLUMNS) - {'events'}
+        if unknown_fields:
+            raise UnknownField("unknown package fields: {}".format(', '.join(sorted(unknown_fields))))
+        return tuple(
+            column for column in PACKAGE_COLUMNS
+            if column in fields or column in PACKAGES_SORT_COLUMNS), 'events' in fields
+    try:
+        return PACKAGE_VIEWS[view or 'full']
+    except KeyError:
+        raise UnknownField("unknown package view {}, must be one of: {}".format(view, ', '.join(PACKAGE_VIEWS)))
 
 
 def init_db():
-    """Initialize the database."""
+    """Initialize the database, bringing its schema up to date."""
+    migrate_db()
+
+
+def migrate_db(target_version=None):
+    """Apply pending schema migrations and return the resulting schema version."""
+    version = migrations.migrate(SQL_CONNECTION, target_version, DB_ENGINE)
+    LOGGER.debug("database schema is at version %s", version)
+    return version
+
+
+def backfill_packages_state():
+    """Recompute the stored state of all packages from their events."""
+    updated_rows = migrations.backfill_packages_state(SQL_CONNECTION)
+    LOGGER.info("backfilled state of %s packages", updated_rows)
+    return updated_rows
+
+
+def clear_tables():
+    """Delete all data from the database, keeping its schema."""
+    flush_events()
     with SQL_CONNECTION() as sql:
-        sql.execute('''
-            CREATE TABLE packages(
-                escrow_pubkey VARCHAR(56) UNIQUE,
-                launcher_pubkey VARCHAR(56),
-                recipient_pubkey VARCHAR(56),
-                deadline INTEGER,
-                payment INTEGER,
-                collateral INTEGER,
-                set_options_transaction VARCHAR(1024),
-                refund_transaction VARCHAR(1024),
-                merge_transaction VARCHAR(1024),
-                payment_transaction VARCHAR(1024))''')
-        LOGGER.debug('packages table created')
-        sql.execute('''
-            CREATE TABLE events(
-                timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
-                escrow_pubkey VARCHAR(56) NULL,
-                user_pubkey VARCHAR(56),
-                event_type VARCHAR(20),
-                location VARCHAR(24),
-                FOREIGN KEY(escrow_pubkey) REFERENCES packages(escrow_pubkey))''')
-        LOGGER.debug('events table created')
-
-
-def add_event(escrow_pubkey, user_pubkey, event_type, location):
-    """Add a package event."""
+        for table in DATA_TABLES:
+            sql.execute("DELETE FROM {}".format(table))
+    if PACKAGE_CACHE:
+        PACKAGE_CACHE.clear()
+
+
+def rebuild_rollups():
+    """Recompute the daily event rollups from all events."""
     with SQL_CONNECTION() as sql:
-        sql.execute("""
-            INSERT INTO events (escrow_pubkey, user_pubkey, event_type, location)
-            VALUES (%s, %s, %s, %s)
-        """, (escrow_pubkey, user_pubkey, event_type, location))
+        events_num = rollups.rebuild_rollups(sql, DB_ENGINE)
+    LOGGER.info("rebuilt rollups of %s events", events_num)
+    return events_num
+
+
+def invalidate_packages(escrow_pubkeys):
+    """Drop packages from the package cache of all workers."""
+    if PACKAGE_CACHE:
+        for escrow_pubkey in set(escrow_pubkeys) - {None}:
+            BROKER.publish(PACKAGE_INVALIDATION_CHANNEL, escrow_pubkey)
+
+
+def package_update(event):
+    """Describe a package event as sent to subscribers, with a JSON friendly timestamp."""
+    return dict(
+        {key: event[key] for key in ('id', 'escrow_pubkey', 'user_pubkey', 'event_type', 'location')},
+        timestamp=event['timestamp'].strftime(CURSOR_TIMESTAMP_FORMAT)
+        if isinstance(event['timestamp'], datetime.datetime) else event['timestamp'])
+
+
+def package_update_cursor(update):
+    """
+    Get the cursor of the updates following a package update.
+    Updates are keyed on their event ID alone: events are numbered as they are written, while their timestamps are
+    taken when they are added, so buffered events may be written after events with later timestamps.
+    """
+    return encode_cursor(update['id'])
+
+
+def decode_package_update_cursor(cursor):
+    """
+    Decode a package update cursor into the ID of the last event it follows.
+    Cursors holding a (timestamp, event ID) pair, as issued before, are still accepted by their event ID.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError) as exception:
+        raise InvalidCursor("invalid cursor {}: {}".format(cursor, exception))
+    if not isinstance(values, list) or len(values) not in (1, 2) or not isinstance(values[-1], int):
+        raise InvalidCursor("invalid cursor {}: not a package update cursor".format(cursor))
+    return values[-1]
+
+
+def publish_package_events(events):
+    """Publish new package events to their subscribers on all workers."""
+    for event in events:
+        if event['escrow_pubkey'] is not None:
+            BROKER.publish(PACKAGE_EVENTS_CHANNEL, package_update(event))
+
+
+def get_package_cache_stats():
+    """Get statistics of the package cache."""
+    return PACKAGE_CACHE.stats() if PACKAGE_CACHE else {}
 
 
-def get_events(max_events_num):
-    """Get all user and package events up to a limit."""
+def update_package_state(sql, escrow_pubkey, event_type, latitude=None, longitude=None):
+    """
+    Update the stored state of a package following new events, which may carry a new position, and count the update
+    in its state version. The custodian is the user of the latest event by timestamp, as buffered events may be
+    written out of order.
+    """
+    sql.execute("""
+        UPDATE packages SET
+            status = CASE
+                WHEN status = 'delivered' OR %s = 'received' THEN 'delivered'
+                WHEN status = 'in transit' OR %s = 'couriered' THEN 'in transit'
+                WHEN status = 'waiting pickup' OR %s = 'launched' THEN 'waiting pickup'
+                ELSE status END,
+            custodian_pubkey = (
+                SELECT user_pubkey FROM events WHERE escrow_pubkey = %s ORDER BY timestamp DESC, id DESC LIMIT 1),
+            launch_date = COALESCE(launch_date, (SELECT MIN(timestamp) FROM events WHERE escrow_pubkey = %s)),
+            last_event_at = (SELECT MAX(timestamp) FROM events WHERE escrow_pubkey = %s),
+            state_version = state_version + 1,
+            latitude = COALESCE(%s, latitude),
+            longitude = COALESCE(%s, longitude)
+        WHERE escrow_pubkey = %s""", (
+            event_type, event_type, event_type, escrow_pubkey, escrow_pubkey, escrow_pubkey, latitude, longitude,
+            escrow_pubkey))
+
+
+def status_rank(event_type):
+    """Get the strength of an event type in setting package status (-1 if it does not affect status)."""
+    return STATUS_EVENT_TYPES.index(event_type) if event_type in STATUS_EVENT_TYPES else -1
+
+
+def insert_event_rows(sql, events):
+    """Insert a list of events with a single statement, along with the coordinates parsed from their locations."""
+    sql.execute("""
+        INSERT INTO events (timestamp, escrow_pubkey, user_pubkey, event_type, location, latitude, longitude)
+        VALUES {}""".format(', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(events))), tuple(
+            value for event in events for value in (
+                event['timestamp'], event['escrow_pubkey'], event['user_pubkey'], event['event_type'],
+                event['location']) + geo.parse_location(event['location'])))
+    # The rows of a single insert get consecutive IDs, in order: MySQL reports the first one, SQLite the last one.
+    first_id = sql.lastrowid - len(events) + 1 if DB_ENGINE == 'sqlite' else sql.lastrowid
+    for index, event in enumerate(events):
+        event['id'] = first_id + index
+
+
+def insert_events(sql, events):
+    """Insert a list of events with a single statement, and update the state of their packages."""
+    insert_event_rows(sql, events)
+    # Fold the events of each package: the strongest one sets the status, and the last one with a valid location
+    # sets the position.
+    packages_state = {}
+    for event in events:
+        if event['escrow_pubkey'] is None:
+            continue
+        strongest_event_type, position = packages_state.get(
+            event['escrow_pubkey'], (event['event_type'], (None, None)))
+        if status_rank(event['event_type']) > status_rank(strongest_event_type):
+            strongest_event_type = event['event_type']
+        event_position = geo.parse_location(event['location'])
+        if event_position[0] is not None:
+            position = event_position
+        packages_state[event['escrow_pubkey']] = strongest_event_type, position
+    for escrow_pubkey, (event_type, position) in packages_state.items():
+        update_package_state(sql, escrow_pubkey, event_type, *position)
+
+
+def commit_events(events):
+    """Insert a batch of events, and count them in the rollups, in a single transaction."""
     with SQL_CONNECTION() as sql:
-        sql.execute("SELECT * FROM events LIMIT %s", (int(max_events_num),))
-        events = jsonable(sql.fetchall())
+        insert_events(sql, events)
+        rollups.update_rollups(sql, events, DB_ENGINE)
+
+
+def events_written(events):
+    """
+    Announce and publish a batch of committed events.
+    Errors are logged rather than raised: the events are committed, and must not be written again.
+    """
+    try:
+        mark_written([event[key] for event in events for key in ('escrow_pubkey', 'user_pubkey')])
+        invalidate_packages(event['escrow_pubkey'] for event in events)
+        publish_package_events(events)
+    # pylint: disable=broad-except
+    # A broker failure only delays cache invalidations and updates, which expire or are caught up with by cursor.
+    except Exception:
+        LOGGER.exception("post commit hooks of %s events failed", len(events))
+    # pylint: enable=broad-except
+
+
+def write_events(events):
+    """Write a batch of events in a single transaction, then run its post commit hooks."""
+    commit_events(events)
+    events_written(events)
+
+
+# The buffer retries failed batches event by event, so only the transaction is retried, and the post commit hooks
+# run once per written batch.
+EVENT_BUFFER = event_buffer.EventBuffer(
+    commit_events, DB_EVENT_BATCH_SIZE, DB_EVENT_FLUSH_INTERVAL, DB_EVENT_QUEUE_SIZE,
+    on_written=events_written) if DB_EVENT_BUFFER else None
+if EVENT_BUFFER:
+    atexit.register(EVENT_BUFFER.stop)
+
+
+def flush_events():
+    """Write all buffered events."""
+    if EVENT_BUFFER:
+        EVENT_BUFFER.flush()
+
+
+def get_event_buffer_stats():
+    """Get statistics of the event buffer."""
+    return EVENT_BUFFER.stats() if EVENT_BUFFER else {}
+
+
+def add_event(escrow_pubkey, user_pubkey, event_type, location, sync=False):
+    """
+    Add a package event, updating the stored state of the package in the same transaction.
+    If event buffering is enabled the event is queued and written shortly after, unless sync is set, in which case
+    all buffered events are written before this one so the caller can read its own writes.
+    """
+    event = dict(
+        timestamp=datetime.datetime.now(), escrow_pubkey=escrow_pubkey, user_pubkey=user_pubkey,
+        event_type=event_type, location=location)
+    if EVENT_BUFFER and not sync:
+        EVENT_BUFFER.put(event)
+        # Invalidate now as well as when the event is written, so pollers don't wait for the TTL to see it.
+        invalidate_packages([escrow_pubkey])
+        return
+    flush_events()
+    write_events([event])
+
+
+def event_filter_clauses(
+        event_type=None, user_pubkey=None, escrow_pubkey=None, since_timestamp=None, until_timestamp=None,
+        scope=None):
+    """
+    Build the conditions selecting events by type, user, package, scope ('package' or 'user') and time window
+    (unix timestamps, since inclusive and until exclusive), and their params.
+    """
+    conditions, params = [], []
+    for column, value in (('event_type', event_type), ('user_pubkey', user_pubkey), ('escrow_pubkey', escrow_pubkey)):
+        if value is not None:
+            conditions.append("{} = %s".format(column))
+            params.append(value)
+    for operator, value in (('>=', since_timestamp), ('<', until_timestamp)):
+        if value is not None:
+            try:
+                params.append(datetime.datetime.fromtimestamp(float(value)))
+            except (ValueError, TypeError, OverflowError, OSError) as exception:
+                raise InvalidFilter("invalid timestamp {}: {}".format(value, exception))
+            conditions.append("timestamp {} %s".format(operator))
+    if scope is not None:
+        if scope not in EVENT_SCOPES:
+            raise InvalidFilter("invalid scope {}, must be one of: {}".format(scope, ', '.join(EVENT_SCOPES)))
+        conditions.append(EVENT_SCOPES[scope])
+    return conditions, tuple(params)
+
+
+def events_page_query(
+        max_events_num, cursor=None, event_type=None, user_pubkey=None, escrow_pubkey=None, since_timestamp=None,
+        until_timestamp=None, scope=None):
+    """Build the query of a page of events after a cursor, matching some filters (see get_events), and its params."""
+    condition, condition_params, suffix, suffix_params = page_clauses(EVENTS_SORT_COLUMNS, cursor, max_events_num)
+    filter_conditions, filter_params = event_filter_clauses(
+        event_type, user_pubkey, escrow_pubkey, since_timestamp, until_timestamp, scope)
+    return "SELECT * FROM events WHERE {}{}".format(' AND '.join(filter_conditions + [condition]), suffix), (
+        filter_params + condition_params + suffix_params)
+
+
+def get_events(
+        max_events_num, cursor=None, event_type=None, user_pubkey=None, escrow_pubkey=None, since_timestamp=None,
+        until_timestamp=None, scope=None):
+    """
+    Get a page of user and package events, ordered by time, up to a limit.
+    The returned next_cursor can be passed as cursor to get the following page.
+    See event_filter_clauses for the filters.
+    """
+    query, params = events_page_query(
+        max_events_num, cursor, event_type, user_pubkey, escrow_pubkey, since_timestamp, until_timestamp, scope)
+    with read_sql_connection(*{user_pubkey, escrow_pubkey} - {None}) as sql:
+        sql.execute(query, params)
+        events = db_rows.decode_rows(sql.fetchall())
     return {
         'packages_events': [event for event in events if event['escrow_pubkey'] is not None],
-        'user_events': [event for event in events if event['escrow_pubkey'] is None]}
+        'user_events': [event for event in events if event['escrow_pubkey'] is None],
+        'next_cursor': next_page_cursor(events, EVENTS_SORT_COLUMNS, max_events_num)}
 
 
 def get_package_events(escrow_pubkey):
     """Get a list of events relating to a package."""
-    with SQL_CONNECTION() as sql:
-        sql.execute("""
-            SELECT timestamp, user_pubkey, event_type, location FROM events
-            WHERE escrow_pubkey = %s
-            ORDER BY timestamp ASC""", (escrow_pubkey,))
-        return jsonable(sql.fetchall())
+    with read_sql_connection(escrow_pubkey) as sql:
+        sql.execute(PACKAGE_EVENTS_QUERY, (escrow_pubkey,))
+        return db_rows.decode_rows(sql.fetchall())
+
+
+def fetch_packages_events(sql, escrow_pubkeys):
+    """Get the events of several packages in a single query, grouped by escrow pubkey."""
+    packages_events = {escrow_pubkey: [] for escrow_pubkey in escrow_pubkeys}
+    if not packages_events:
+        return packages_events
+    sql.execute("""
+        SELECT timestamp, escrow_pubkey, user_pubkey, event_type, location FROM events
+        WHERE escrow_pubkey IN ({})
+        ORDER BY timestamp ASC""".format(', '.join(['%s'] * len(packages_events))), tuple(packages_events))
+    for event in db_rows.decode_rows(sql.fetchall()):
+        packages_events[event.pop('escrow_pubkey')].append(event)
+    return packages_events
+
 
+def get_packages_events(escrow_pubkeys):
+    """Get a dict of event lists relating to several packages, keyed by escrow pubkey."""
+    with read_sql_connection(*escrow_pubkeys) as sql:
+        return fetch_packages_events(sql, escrow_pubkeys)
 
-def enrich_package(package, user_role=None, user_pubkey=None):
+
+def enrich_package(package, user_role=None, user_pubkey=None, events=None, with_events=True):
     """Add some periferal data to the package object."""
     package['blockchain_url'] = "https://testnet.stellarchain.io/address/{}".format(package['escrow_pubkey'])
     package['paket_url'] = "https://paket.global/paket/{}".format(package['escrow_pubkey'])
-    package['events'] = get_package_events(package['escrow_pubkey'])
-    if package['events']:
-        package['launch_date'] = package['events'][0]['timestamp']
-    event_types = set([event['event_type'] for event in package['events']])
-
-    if 'received' in event_types:
-        package['status'] = 'delivered'
-    elif 'couriered' in event_types:
-        package['status'] = 'in transit'
-    elif 'launched' in event_types:
-        package['status'] = 'waiting pickup'
-    else:
-        package['status'] = 'unknown'
+    if with_events:
+        package['events'] = get_package_events(package['escrow_pubkey']) if events is None else events
 
     if user_role:
         package['user_role'] = user_role
@@ -119,52 +611,375 @@ def enrich_package(package, user_role=None, user_pubkey=None):
     return package
 
 
+def enrich_packages(sql, packages_and_roles, with_events=True):
+    """Enrich a list of (package, user_role) pairs, loading all their events (if required) with a single query."""
+    if not with_events:
+        return [enrich_package(package, user_role, with_events=False) for package, user_role in packages_and_roles]
+    packages_events = fetch_packages_events(sql, [package['escrow_pubkey'] for package, _ in packages_and_roles])
+    return [
+        enrich_package(package, user_role=user_role, events=packages_events[package['escrow_pubkey']])
+        for package, user_role in packages_and_roles]
+
+
 def create_package(
         escrow_pubkey, launcher_pubkey, recipient_pubkey, payment, collateral, deadline,
         set_options_transaction, refund_transaction, merge_transaction, payment_transaction, location=None):
-    """Create a new package row."""
+    """
+    Create a new package row along with its launch event, in a single transaction.
+    The returned package is built from the written values, without reading it back.
+    """
+    launch_event = dict(
+        timestamp=datetime.datetime.now(), escrow_pubkey=escrow_pubkey, user_pubkey=launcher_pubkey,
+        event_type='launched', location=location)
+    package = dict(
+        escrow_pubkey=escrow_pubkey, launcher_pubkey=launcher_pubkey, recipient_pubkey=recipient_pubkey,
+        deadline=deadline, payment=payment, collateral=collateral,
+        set_options_transaction=set_options_transaction, refund_transaction=refund_transaction,
+        merge_transaction=merge_transaction, payment_transaction=payment_transaction,
+        status='waiting pickup', custodian_pubkey=launcher_pubkey,
+        launch_date=launch_event['timestamp'], last_event_at=launch_event['timestamp'], state_version=1)
+    package['latitude'], package['longitude'] = geo.parse_location(location)
     with SQL_CONNECTION() as sql:
         sql.execute("""
-            INSERT INTO packages (
-                escrow_pubkey, launcher_pubkey, recipient_pubkey, deadline, payment, collateral,
-                set_options_transaction, refund_transaction, merge_transaction, payment_transaction
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", (
-                escrow_pubkey, launcher_pubkey, recipient_pubkey, deadline, payment, collateral,
-                set_options_transaction, refund_transaction, merge_transaction, payment_transaction))
-    add_event(escrow_pubkey, launcher_pubkey, 'launched', location)
-    return enrich_package(get_package(escrow_pubkey))
-
-
-def get_package(escrow_pubkey):
-    """Get package details."""
-    with SQL_CONNECTION() as sql:
-        sql.execute("SELECT * FROM packages WHERE escrow_pubkey = %s", (escrow_pubkey,))
+            INSERT INTO packages ({}) VALUES ({})""".format(
+                ', '.join(package), ', '.join(['%s'] * len(package))), tuple(package.values()))
+        insert_event_rows(sql, [launch_event])
+        rollups.update_rollups(sql, [launch_event], DB_ENGINE)
+    events_written([launch_event])
+    return enrich_package(package, events=[{
+        key: launch_event[key] for key in ('timestamp', 'user_pubkey', 'event_type', 'location')}])
+
+
+def get_package(escrow_pubkey, view=None, fields=None, version=None):
+    """
+    Get package details, from the package cache if possible.
+    See package_projection for the view and fields arguments. If a version marker is given (see get_package_version),
+    cached packages of another version are read again, so the package is never older than the version.
+    """
+    columns, with_events = package_projection(view, fields)
+    full_view = columns == PACKAGE_COLUMNS and with_events
+    package = PACKAGE_CACHE.get(escrow_pubkey) if PACKAGE_CACHE else None
+    if package is not None and version is not None and package_version(package) != version:
+        package = None
+    if package is None:
+        if not full_view:
+            return read_package(escrow_pubkey, columns, with_events)
+        generation = PACKAGE_CACHE.generation() if PACKAGE_CACHE else None
+        package = read_package(escrow_pubkey)
+        if PACKAGE_CACHE:
+            PACKAGE_CACHE.set(escrow_pubkey, package, generation)
+    return project_package(package, columns, with_events)
+
+
+def project_package(package, columns, with_events):
+    """Get a copy of a full package, holding only the columns and events selected by package_projection."""
+    if columns == PACKAGE_COLUMNS and with_events:
+        return copy.deepcopy(package)
+    return copy.deepcopy({
+        key: value for key, value in package.items()
+        if key in columns or key not in PACKAGE_COLUMNS and (with_events or key != 'events')})
+
+
+def read_package(escrow_pubkey, columns=PACKAGE_COLUMNS, with_events=True):
+    """Read package details from the database."""
+    with read_sql_connection(escrow_pubkey) as sql:
+        sql.execute("SELECT {} FROM packages WHERE escrow_pubkey = %s".format(', '.join(columns)), (escrow_pubkey,))
         try:
-            return enrich_package(sql.fetchone())
+            return enrich_package(sql.fetchone(), with_events=with_events)
         except TypeError:
             raise UnknownPaket("paket {} is not valid".format(escrow_pubkey))
 
 
-def get_packages(user_pubkey=None):
+def get_packages_by_ids(escrow_pubkeys, view=None, fields=None):
+    """
+    Get the details of several packages, in the order of escrow_pubkeys, with None in place of unknown packages.
+    Cached packages are taken from the package cache, and all the others are read, along with their events, in two
+    queries. See package_projection for the view and fields arguments.
+    """
+    columns, with_events = package_projection(view, fields)
+    full_view = columns == PACKAGE_COLUMNS and with_events
+    packages = {}
+    unique_escrow_pubkeys = list(dict.fromkeys(escrow_pubkeys))
+    if PACKAGE_CACHE:
+        for escrow_pubkey in unique_escrow_pubkeys:
+            package = PACKAGE_CACHE.get(escrow_pubkey)
+            if package is not None:
+                packages[escrow_pubkey] = project_package(package, columns, with_events)
+    missing_escrow_pubkeys = [
+        escrow_pubkey for escrow_pubkey in unique_escrow_pubkeys if escrow_pubkey not in packages]
+    if not missing_escrow_pubkeys:
+        return [packages.get(escrow_pubkey) for escrow_pubkey in escrow_pubkeys]
+    generation = PACKAGE_CACHE.generation() if PACKAGE_CACHE and full_view else None
+    with read_sql_connection(*missing_escrow_pubkeys) as sql:
+        sql.execute("SELECT {} FROM packages WHERE escrow_pubkey IN ({})".format(
+            ', '.join(columns), ', '.join(['%s'] * len(missing_escrow_pubkeys))), tuple(missing_escrow_pubkeys))
+        read_packages = enrich_packages(sql, [(row, None) for row in db_rows.decode_rows(sql.fetchall())], with_events)
+    for package in read_packages:
+        packages[package['escrow_pubkey']] = package
+        if generation is not None:
+            PACKAGE_CACHE.set(package['escrow_pubkey'], copy.deepcopy(package), generation)
+    return [packages.get(escrow_pubkey) for escrow_pubkey in escrow_pubkeys]
+
+
+def package_version(package):
+    """Get the version marker of a package (see get_package_version)."""
+    return str(package['state_version'])
+
+
+def get_package_version(escrow_pubkey):
+    """
+    Get a marker changing with every event of a package (its state version, counting the updates of its state, as
+    events written late may carry older timestamps), or None for unknown packages.
+    Costs a single primary key lookup, without loading the events of the package.
+    """
+    with read_sql_connection(escrow_pubkey) as sql:
+        sql.execute("SELECT state_version FROM packages WHERE escrow_pubkey = %s", (escrow_pubkey,))
+        package = sql.fetchone()
+    return None if package is None else package_version(package)
+
+
+def get_packages_version(user_pubkey):
+    """
+    Get a marker changing with every event of the packages concerning a user, and when packages concern the user
+    (the number of packages and the sum of their state versions, which only grow). Costs index lookups only.
+    """
+    with read_sql_connection(user_pubkey) as sql:
+        sql.execute(PACKAGES_VERSION_QUERY, (user_pubkey, user_pubkey, user_pubkey))
+        version = sql.fetchone()
+    return "{}:{}".format(version['packages_num'], version['state_versions'])
+
+
+def user_packages_query(user_pubkey, columns, cursor=None, max_packages_num=None):
+    """Build the query of a page of the packages concerning a user (see USER_PACKAGES_QUERY), and its params."""
+    condition, condition_params, suffix, suffix_params = page_clauses(
+        PACKAGES_SORT_COLUMNS, cursor, max_packages_num)
+    qualified_condition, _, qualified_suffix, _ = page_clauses(
+        ['packages.{}'.format(column) for column in PACKAGES_SORT_COLUMNS], cursor, max_packages_num)
+    return USER_PACKAGES_QUERY.format(
+        columns=', '.join('packages.{}'.format(column) for column in columns),
+        condition=condition, suffix=suffix,
+        qualified_condition=qualified_condition, qualified_suffix=qualified_suffix), (
+            (user_pubkey,) + condition_params + suffix_params) * 3 + condition_params + suffix_params
+
+
+def user_package_and_role(row):
+    """Get a (package, user_role) pair from a row of USER_PACKAGES_QUERY, splitting its comma separated roles."""
+    user_roles = row.pop('user_roles')
+    user_roles = user_roles.decode() if isinstance(user_roles, (bytes, bytearray)) else user_roles
+    row['user_roles'] = [role for role in USER_ROLES if role in user_roles.split(',')]
+    return row, row['user_roles'][0]
+
+
+def packages_page_query(columns, cursor=None, max_packages_num=None):
+    """Build the query of a page of all packages, and its params."""
+    condition, condition_params, suffix, suffix_params = page_clauses(
+        PACKAGES_SORT_COLUMNS, cursor, max_packages_num)
+    return "SELECT {} FROM packages WHERE {}{}".format(', '.join(columns), condition, suffix), (
+        condition_params + suffix_params)
+
+
+def get_packages(user_pubkey=None, view=None, fields=None):
     """Get a list of packages."""
-    with SQL_CONNECTION() as sql:
+    return get_packages_page(user_pubkey, view=view, fields=fields)[0]
+
+
+def get_packages_page(user_pubkey=None, max_packages_num=None, cursor=None, view=None, fields=None):
+    """
+    Get a page of packages ordered by launch date, and the cursor of the following page (None on the last page).
+    Without max_packages_num all the packages are returned.
+    If user_pubkey is given, only the packages concerning the user are returned, each one once, with all the roles
+    of the user in user_roles, and the first of them in user_role.
+    See package_projection for the view and fields arguments.
+    """
+    columns, with_events = package_projection(view, fields)
+    with read_sql_connection(user_pubkey) as sql:
         if user_pubkey:
-            sql.execute("""
-            SELECT * FROM packages
-            WHERE launcher_pubkey = %s""", (user_pubkey,))
-            launched = [enrich_package(row, user_role='launcher') for row in sql.fetchall()]
-            sql.execute("""
-            SELECT * FROM packages
-            WHERE recipient_pubkey = %s""", (user_pubkey,))
-            received = [enrich_package(row, user_role='recipient') for row in sql.fetchall()]
-            sql.execute("""
-            SELECT * FROM packages
-            WHERE escrow_pubkey IN (
-                SELECT escrow_pubkey FROM events
-                WHERE event_type = 'couriered' AND user_pubkey = %s)""", (user_pubkey,))
-            couriered = [enrich_package(row, user_role='courier') for row in sql.fetchall()]
-            return [
-                dict(package, custodian_pubkey=package['events'][-1]['user_pubkey'])
-                for package in launched + received + couriered]
-        sql.execute('SELECT * FROM packages')
-        return [enrich_package(row) for row in sql.fetchall()]
+            sql.execute(*user_packages_query(user_pubkey, columns, cursor, max_packages_num))
+            packages_and_roles = [user_package_and_role(row) for row in db_rows.decode_rows(sql.fetchall())]
+        else:
+            sql.execute(*packages_page_query(columns, cursor, max_packages_num))
+            packages_and_roles = [(row, None) for row in sql.fetchall()]
+        packages = enrich_packages(sql, packages_and_roles, with_events)
+    return packages, next_page_cursor(packages, PACKAGES_SORT_COLUMNS, max_packages_num)
+
+
+def get_packages_by_state(status=None, custodian_pubkey=None, view=None, fields=None):
+    """Get a list of packages with a specific status and/or custodian, without replaying their events."""
+    columns, with_events = package_projection(view, fields)
+    conditions, params = [], []
+    if status is not None:
+        conditions.append('status = %s')
+        params.append(status)
+    if custodian_pubkey is not None:
+        conditions.append('custodian_pubkey = %s')
+        params.append(custodian_pubkey)
+    with read_sql_connection(custodian_pubkey) as sql:
+        sql.execute("SELECT {} FROM packages{} ORDER BY launch_date ASC".format(
+            ', '.join(columns), " WHERE {}".format(' AND '.join(conditions)) if conditions else ''), tuple(params))
+        return enrich_packages(sql, [(row, None) for row in sql.fetchall()], with_events)
+
+
+def parse_nearby_area(latitude, longitude, radius_km, box):
+    """
+    Parse the area of a nearby packages query, either a position (and radius_km) or a (min_latitude, max_latitude,
+    min_longitude, max_longitude) bounding box (and an optional position). Returns the position, radius and box.
+    """
+    try:
+        if any(coordinate is not None for coordinate in box):
+            box = [float(coordinate) for coordinate in box]
+            if latitude is not None and longitude is not None:
+                latitude, longitude = float(latitude), float(longitude)
+            radius_km = float(radius_km) if radius_km is not None else None
+        elif latitude is not None and longitude is not None:
+            latitude, longitude = float(latitude), float(longitude)
+            radius_km = float(radius_km) if radius_km is not None else NEARBY_RADIUS_KM
+            box = geo.bounding_box(latitude, longitude, radius_km)
+        else:
+            raise ValueError('either a position or a bounding box is required')
+    except (ValueError, TypeError) as exception:
+        raise InvalidFilter("invalid nearby packages query: {}".format(exception))
+    return latitude, longitude, radius_km, box
+
+
+def nearest_packages(packages, latitude=None, longitude=None, radius_km=None, max_packages_num=None):
+    """
+    Get the first max_packages_num packages (all of them if it is not set). If a position is given, packages get
+    their distance_km from it, and are sorted closest first, dropping those beyond radius_km (if set).
+    """
+    if latitude is not None and longitude is not None:
+        for package in packages:
+            package['distance_km'] = geo.distance_km(latitude, longitude, package['latitude'], package['longitude'])
+        packages = [package for package in packages if radius_km is None or package['distance_km'] <= radius_km]
+        packages.sort(key=lambda package: package['distance_km'])
+    return packages[:int(max_packages_num)] if max_packages_num else packages
+
+
+def get_nearby_packages(
+        latitude=None, longitude=None, radius_km=None, min_latitude=None, max_latitude=None, min_longitude=None,
+        max_longitude=None, status='waiting pickup', max_packages_num=None, view=None, fields=None):
+    """
+    Get packages with a status (waiting pickup by default) within radius_km of a position, or within a bounding box.
+    Packages are selected with an index range scan on their stored position. If a position is given they are
+    returned closest first with their distance_km, otherwise by launch date.
+    See package_projection for the view and fields arguments.
+    """
+    columns, with_events = package_projection(view, fields)
+    columns += tuple(column for column in ('latitude', 'longitude') if column not in columns)
+    latitude, longitude, radius_km, box = parse_nearby_area(
+        latitude, longitude, radius_km, [min_latitude, max_latitude, min_longitude, max_longitude])
+    with read_sql_connection() as sql:
+        sql.execute(NEARBY_PACKAGES_QUERY.format(', '.join(columns)), (status,) + tuple(box))
+        return enrich_packages(sql, [(package, None) for package in nearest_packages(
+            sql.fetchall(), latitude, longitude, radius_km, max_packages_num)], with_events)
+
+
+def get_waiting_packages_positions():
+    """Get the positions, payments, collaterals and deadlines of all the located packages waiting for pickup."""
+    with read_sql_connection() as sql:
+        sql.execute("""
+            SELECT escrow_pubkey, latitude, longitude, payment, collateral, deadline FROM packages
+            WHERE status = 'waiting pickup' AND latitude IS NOT NULL""")
+        return sql.fetchall()
+
+
+def get_users_positions(since_timestamp):
+    """
+    Get the last known position of every courier (user who ever couriered a package) with a located event since a
+    unix timestamp.
+    """
+    with read_sql_connection() as sql:
+        sql.execute("""
+            SELECT user_pubkey, latitude, longitude FROM events
+            WHERE timestamp >= %s AND latitude IS NOT NULL AND EXISTS (
+                SELECT 1 FROM events AS courier_events
+                WHERE courier_events.user_pubkey = events.user_pubkey AND courier_events.event_type = 'couriered')
+            ORDER BY timestamp ASC, id ASC""", (datetime.datetime.fromtimestamp(since_timestamp),))
+        return list({event['user_pubkey']: event for event in db_rows.decode_rows(sql.fetchall())}.values())
+
+
+def get_stats(since_timestamp=None, until_timestamp=None, event_type=None, region=None):
+    """
+    Get the number of events and of distinct users per day and event type, from the rollups.
+    The days are those from since_timestamp (default is 30 days ago) to until_timestamp (default is now), unix
+    timestamps. Use region ('latitude,longitude' of the south west corner of a one degree cell) to get the counts of
+    located events in a region.
+    """
+    try:
+        until_day = datetime.date.fromtimestamp(float(until_timestamp or datetime.datetime.now().timestamp()))
+        since_day = datetime.date.fromtimestamp(float(since_timestamp)) if since_timestamp else (
+            until_day - datetime.timedelta(days=STATS_DEFAULT_DAYS))
+    except (ValueError, TypeError, OverflowError, OSError) as exception:
+        raise InvalidFilter("invalid time window: {}".format(exception))
+    with read_sql_connection() as sql:
+        return rollups.get_rollups(
+            sql, since_day, until_day + datetime.timedelta(days=1), event_type, region or rollups.ALL_REGIONS)
+
+
+def get_package_updates(escrow_pubkeys, cursor=None):
+    """
+    Get the events of some packages following a package update cursor, and the cursor following them.
+    Without a cursor no events are returned, only the cursor following the last recorded event of the packages.
+    """
+    escrow_pubkeys = list(escrow_pubkeys)
+    in_clause = ', '.join(['%s'] * len(escrow_pubkeys))
+    with read_sql_connection(*escrow_pubkeys) as sql:
+        if not cursor:
+            sql.execute("SELECT MAX(id) AS id FROM events WHERE escrow_pubkey IN ({})".format(in_clause), tuple(
+                escrow_pubkeys))
+            return [], encode_cursor(sql.fetchone()['id'] or 0)
+        sql.execute("""
+            SELECT id, timestamp, escrow_pubkey, user_pubkey, event_type, location FROM events
+            WHERE escrow_pubkey IN ({}) AND id > %s ORDER BY id ASC""".format(in_clause), tuple(
+                escrow_pubkeys) + (decode_package_update_cursor(cursor),))
+        package_updates = [package_update(event) for event in db_rows.decode_rows(sql.fetchall())]
+    return package_updates, package_update_cursor(package_updates[-1]) if package_updates else cursor
+
+
+def stream_package_updates(escrow_pubkeys, cursor=None, heartbeat_interval=15, max_duration=None):
+    """
+    Generate (events, cursor) pairs: lists of new events of some packages as they are recorded (an empty list every
+    heartbeat_interval seconds without events), each with the cursor following them.
+    The first pair holds the events following cursor if given (none otherwise), and is generated once subscribed, so
+    clients that resume with the last cursor they got miss nothing.
+    """
+    escrow_pubkeys = set(escrow_pubkeys)
+    position = {}
+
+    def catch_up():
+        """Get the missed events, and the cursor following them."""
+        missed_events, position['cursor'] = get_package_updates(escrow_pubkeys, cursor)
+        position['key'] = decode_package_update_cursor(position['cursor'])
+        return missed_events
+
+    caught_up_ids = None
+    for events in UPDATES_HUB.stream(escrow_pubkeys, catch_up, heartbeat_interval, max_duration):
+        # Events published while catching up are received twice. Events are not filtered by their ID, as events may
+        # be published out of order (by other workers).
+        if caught_up_ids is None:
+            caught_up_ids = {event['id'] for event in events}
+        elif caught_up_ids:
+            events = [event for event in events if event['id'] not in caught_up_ids]
+        for event in events:
+            if event['id'] > position['key']:
+                position['key'], position['cursor'] = event['id'], package_update_cursor(event)
+        yield events, position['cursor']
+
+
+def wait_package_updates(escrow_pubkeys, cursor=None, timeout=25):
+    """
+    Wait up to timeout seconds for new events of some packages (or get the events following cursor right away).
+    Returns the events, and the cursor to pass to the next call (following the events recorded by then, even if
+    there are none).
+    """
+    if cursor:
+        decode_package_update_cursor(cursor)
+    next_cursor = cursor
+    for events, next_cursor in stream_package_updates(escrow_pubkeys, cursor, timeout, timeout):
+        if events:
+            return events, next_cursor
+    return [], next_cursor
+
+
+def get_updates_stats():
+    """Get statistics of the package updates hub."""
+    return UPDATES_HUB.stats()
@@ -0,0 +1,17 @@
+"""Fix for mysql-connector bug which makes fetched rows have some keys as (unjsonable) bytes."""
+
+
+def decode_keys(row):
+    """Get a row with its bytes keys decoded."""
+    return {key.decode('utf8') if isinstance(key, bytes) else key: value for key, value in row.items()}
+
+
+def decode_rows(rows):
+    """
+    Get a list of rows with their bytes keys decoded.
+    Rows fetched together share their keys, so the rows are only rebuilt if the keys of the first one need it.
+    """
+    rows = list(rows)
+    if not rows or not any(isinstance(key, bytes) for key in rows[0]):
+        return rows
+    return [decode_keys(row) for row in rows]
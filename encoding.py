@@ -0,0 +1,168 @@
+"""Fast JSON encoding and compression of API responses."""
+import base64
+import datetime
+import decimal
+import gzip
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+
+# orjson and brotli are optional dependencies, used when they are installed.
+# pylint: disable=import-error,invalid-name
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# pylint: enable=import-error,invalid-name
+
+LOGGER = logging.getLogger('pkt.api')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Encodings we can compress with, preferred first.
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value):
+    """Format a datetime or a date the way Flask's default encoder does (naive values are taken as UTC)."""
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    elif value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return "{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT".format(
+        WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1], value.year, value.hour, value.minute,
+        value.second)
+
+
+def default(value):
+    """Encode the values JSON has no type for, like Flask's default encoder."""
+    if isinstance(value, datetime.date):
+        return http_date(value)
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def dumps(value):
+    """
+    Encode a value as JSON, with orjson if it is installed.
+    Values orjson rejects (like dicts with non string keys, or huge integers) are encoded by the json module.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(value, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(value, default=default, separators=(',', ':'))
+
+
+def accepted_encodings(accept_encoding):
+    """Parse an Accept-Encoding header into a dict of quality values keyed by encoding."""
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        name, quality = name.strip().lower(), 1.0
+        if not name:
+            continue
+        for param in params.split(';'):
+            key, _, param_value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    return qualities
+
+
+def negotiate(accept_encoding):
+    """Get the best encoding we can compress with that the client accepts, or None."""
+    qualities = accepted_encodings(accept_encoding)
+    best_encoding, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0))
+        if quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+    return best_encoding
+
+
+def compress(body, encoding):
+    """Compress a body with an encoding returned by negotiate."""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, GZIP_LEVEL)
+    raise ValueError("unsupported encoding {}".format(encoding))
+
+
+def benchmark_response(packages_num=1000, events_num=4):
+    """Build a response shaped like a list of full packages, with their events and XDR transactions."""
+    now = datetime.datetime(2018, 8, 3, 12)
+    randomizer = random.Random(0)
+
+    def xdr():
+        """Get a transaction sized blob: keys and a signature (random) in a mostly constant XDR structure."""
+        keys_and_signature = randomizer.getrandbits(96 * 8).to_bytes(96, 'big')
+        return base64.b64encode(keys_and_signature[:64] + bytes(range(256)) * 2 + keys_and_signature[64:] + bytes(
+            142)).decode()
+
+    return {'status': 200, 'next_cursor': None, 'packages': [{
+        'escrow_pubkey': "GESCROW{:049d}".format(index), 'launcher_pubkey': "GLAUNCHER{:047d}".format(index),
+        'recipient_pubkey': "GRECIPIENT{:046d}".format(index), 'custodian_pubkey': "GCOURIER{:048d}".format(index),
+        'payment': 50000000, 'collateral': 100000000, 'deadline': 1533297600 + index, 'status': 'in transit',
+        'set_options_transaction': xdr(), 'refund_transaction': xdr(), 'merge_transaction': xdr(),
+        'payment_transaction': xdr(), 'launch_date': now, 'last_event_at': now, 'state_version': 3,
+        'latitude': 51.4983407, 'longitude': -0.173709, 'user_role': 'launcher', 'user_roles': ['launcher'],
+        'blockchain_url': "https://testnet.stellarchain.io/address/GESCROW{:049d}".format(index),
+        'paket_url': "https://paket.global/paket/GESCROW{:049d}".format(index),
+        'events': [{
+            'timestamp': now + datetime.timedelta(minutes=event_index), 'event_type': 'couriered',
+            'user_pubkey': "GCOURIER{:048d}".format(index), 'location': '51.4983407,-0.173709'}
+                   for event_index in range(events_num)]} for index in range(packages_num)]}
+
+
+def benchmark(packages_num=1000, repeat=5):
+    """Compare encoding CPU time and bytes on the wire of a list of packages, before and after."""
+    response = benchmark_response(packages_num)
+    rows = [{key.encode(): value for key, value in package.items()} for package in response['packages']]
+
+    def baseline():
+        """Flask's default encoding (the json module, sorting keys), with the former key decoding of db.jsonable."""
+        packages = [{
+            key.decode('utf8') if isinstance(key, bytes) else key: value for key, value in row.items()}
+                    for row in rows]
+        return json.dumps(dict(response, packages=packages), default=default, separators=(',', ':'), sort_keys=True)
+
+    def timed(encode):
+        """Get the best time of encode, in milliseconds, and its result."""
+        timings = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            body = encode()
+            timings.append((time.perf_counter() - started_at) * 1000)
+        return min(timings), body
+
+    baseline_ms, baseline_body = timed(lambda: baseline().encode())
+    fast_ms, fast_body = timed(lambda: dumps(response).encode())
+    print("{} packages, encoder: {}".format(packages_num, 'orjson' if orjson else 'json'))
+    print("{:<24}{:>12}{:>14}".format('', 'cpu (ms)', 'bytes'))
+    print("{:<24}{:>12.1f}{:>14}".format('json, identity', baseline_ms, len(baseline_body)))
+    print("{:<24}{:>12.1f}{:>14}".format('fast, identity', fast_ms, len(fast_body)))
+    for encoding in ENCODINGS:
+        compress_ms, compressed = timed(lambda encoding=encoding: compress(fast_body, encoding))
+        print("{:<24}{:>12.1f}{:>14}".format("fast, {}".format(encoding), fast_ms + compress_ms, len(compressed)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark(*[int(arg) for arg in sys.argv[2:3]])
+    else:
+        print("usage: python encoding.py benchmark [packages_num]")
@@ -0,0 +1,167 @@
+"""Write-behind buffer that groups events into batched writes."""
+import logging
+import queue
+import threading
+import time
+
+LOGGER = logging.getLogger('pkt.db')
+
+
+class BufferFull(Exception):
+    """The buffer queue stayed full for too long."""
+
+
+# pylint: disable=too-few-public-methods
+# A plain marker, waited on by whoever requested the flush.
+class FlushRequest:
+    """A marker placed in the queue, signalling that everything before it must be written."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+# pylint: enable=too-few-public-methods
+
+
+# pylint: disable=too-many-instance-attributes
+# The buffer settings sit next to the state the producers and the flusher thread share.
+class EventBuffer:
+    """
+    A bounded queue of events, written in batches by a background flusher thread.
+    A batch is written as soon as it holds max_batch_size events, or max_delay seconds after its first event was
+    queued. If a batch fails, its events are retried one by one so a single bad event does not take the rest down.
+    Only write_batch is retried: the on_written callback, if given, is called once with every written batch, and
+    its errors are logged, as its events are already written.
+    """
+
+    def __init__(
+            self, write_batch, max_batch_size=200, max_delay=0.05, max_queue_size=10000, put_timeout=1,
+            name='event-buffer-flusher', on_written=None):
+        self.write_batch = write_batch
+        self.on_written = on_written
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(max_queue_size)
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.stopping = False
+        self.counters = dict(queued=0, written=0, batches=0, dropped=0)
+
+    def start(self):
+        """Start the flusher thread, if it is not already running."""
+        with self.lock:
+            if self.flusher is None or not self.flusher.is_alive():
+                self.stopping = False
+                self.flusher = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.flusher.start()
+
+    def put(self, event):
+        """Queue an event for writing."""
+        self.start()
+        try:
+            self.queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            raise BufferFull("event buffer is full ({} events)".format(self.queue.maxsize))
+        with self.lock:
+            self.counters['queued'] += 1
+
+    def flush(self):
+        """Block until all the events queued so far are written."""
+        if self.flusher is None or not self.flusher.is_alive():
+            self.write(self.drain())
+            return
+        flush_request = FlushRequest()
+        self.queue.put(flush_request)
+        flush_request.done.wait()
+        if flush_request.error is not None:
+            raise flush_request.error
+
+    def stop(self):
+        """Flush all queued events and stop the flusher thread. Registered to run on shutdown."""
+        if self.flusher is not None and self.flusher.is_alive():
+            self.stopping = True
+            self.flush()
+            self.flusher.join()
+        else:
+            self.flush()
+
+    def drain(self):
+        """Take all the events currently in the queue."""
+        events = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return events
+            if isinstance(item, FlushRequest):
+                item.done.set()
+            else:
+                events.append(item)
+
+    def write(self, events):
+        """Write a batch of events, falling back to writing them one by one on error."""
+        if not events:
+            return
+        try:
+            self.write_batch(events)
+        # pylint: disable=broad-except
+        # Any failure of a batch is retried per event, so the failing event can be found and dropped.
+        except Exception as exception:
+            if len(events) == 1:
+                self.counters['dropped'] += 1
+                LOGGER.error("dropping event %s: %s", events[0], exception)
+                return
+            LOGGER.warning("batch of %s events failed (%s), writing them one by one", len(events), exception)
+            for event in events:
+                self.write([event])
+            return
+        # pylint: enable=broad-except
+        self.counters['written'] += len(events)
+        self.counters['batches'] += 1
+        if self.on_written is None:
+            return
+        try:
+            self.on_written(events)
+        # pylint: disable=broad-except
+        # The events are written, so writing them again would duplicate them.
+        except Exception:
+            LOGGER.exception("post write callback failed on %s written events", len(events))
+        # pylint: enable=broad-except
+
+    def run(self):
+        """Flusher loop: collect a batch, write it, repeat."""
+        while True:
+            item = self.queue.get()
+            batch, flush_requests = [], []
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if isinstance(item, FlushRequest):
+                    flush_requests.append(item)
+                    break
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            # pylint: disable=broad-except
+            # The flusher must survive anything, reporting errors to whoever waits for a flush.
+            except Exception as exception:
+                LOGGER.exception('event buffer flusher failed')
+                for flush_request in flush_requests:
+                    flush_request.error = exception
+            # pylint: enable=broad-except
+            for flush_request in flush_requests:
+                flush_request.done.set()
+            if self.stopping and flush_requests:
+                return
+
+    def stats(self):
+        """Get buffer statistics."""
+        return dict(self.counters, pending=self.queue.qsize())
+# pylint: enable=too-many-instance-attributes
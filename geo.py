@@ -0,0 +1,49 @@
+"""Geographic helpers for package and event locations."""
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def parse_location(location):
+    """
+    Parse a "latitude,longitude" location string into a pair of floats.
+    Returns (None, None) for missing or malformed locations, which are still stored verbatim.
+    """
+    try:
+        latitude, longitude = (float(coordinate) for coordinate in location.split(','))
+    except (AttributeError, ValueError):
+        return None, None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None, None
+    return latitude, longitude
+
+
+def distance_km(latitude, longitude, other_latitude, other_longitude):
+    """Get the great circle distance between two points in kilometers (haversine formula)."""
+    latitude, longitude, other_latitude, other_longitude = map(
+        math.radians, (latitude, longitude, other_latitude, other_longitude))
+    haversine = (
+        math.sin((other_latitude - latitude) / 2) ** 2 +
+        math.cos(latitude) * math.cos(other_latitude) * math.sin((other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(haversine)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Get the (min_latitude, max_latitude, min_longitude, max_longitude) box containing a circle.
+    Circles reaching a pole or crossing the antimeridian get the full longitude range.
+    """
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("invalid position {},{}".format(latitude, longitude))
+    if radius_km <= 0:
+        raise ValueError("invalid radius {}".format(radius_km))
+    angular_radius = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_latitude, max_latitude = latitude - angular_radius, latitude + angular_radius
+    if min_latitude <= -90 or max_latitude >= 90:
+        return max(min_latitude, -90), min(max_latitude, 90), -180, 180
+    longitude_delta = math.degrees(math.asin(
+        math.sin(math.radians(angular_radius)) / math.cos(math.radians(latitude))))
+    min_longitude, max_longitude = longitude - longitude_delta, longitude + longitude_delta
+    if min_longitude < -180 or max_longitude > 180:
+        return min_latitude, max_latitude, -180, 180
+    return min_latitude, max_latitude, min_longitude, max_longitude
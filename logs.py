@@ -0,0 +1,113 @@
+"""Reading the tail of large log files, backward from their end."""
+import io
+import itertools
+import os
+import re
+
+BLOCK_SIZE = 64 * 1024
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+LEVEL_ALIASES = {'WARN': 'WARNING', 'FATAL': 'CRITICAL'}
+LEVEL_PATTERN = re.compile(r'\b({})\b'.format('|'.join(LEVELS + tuple(LEVEL_ALIASES))))
+# Lines without a level are grouped with the record above them, up to this many lines per record.
+MAX_RECORD_LINES = 1000
+
+
+def read_lines_backward(logfile, block_size=BLOCK_SIZE, max_bytes=None):
+    """
+    Generate the lines of a binary file from the last to the first, reading it block by block from its end, so only
+    the blocks holding the consumed lines are read. Lines are decoded as UTF-8 and keep their newline.
+    With max_bytes, reading stops that many bytes before the end (dropping the line cut by that limit).
+    """
+    position = logfile.seek(0, io.SEEK_END)
+    stop = 0 if max_bytes is None else max(0, position - max_bytes)
+    buffer = b''
+    while True:
+        # Every newline in the buffer, but its last byte (which ends the last line), ends a previous line.
+        end = len(buffer)
+        index = buffer.rfind(b'\n', 0, end - 1) if end else -1
+        while index != -1:
+            yield buffer[index + 1:end].decode('utf8', 'replace')
+            end = index + 1
+            index = buffer.rfind(b'\n', 0, end - 1)
+        buffer = buffer[:end]
+        if position <= stop:
+            if position == 0 and buffer:
+                yield buffer.decode('utf8', 'replace')
+            return
+        read_size = min(block_size, position - stop)
+        position -= read_size
+        logfile.seek(position)
+        buffer = logfile.read(read_size) + buffer
+
+
+def get_level(line):
+    """Get the level of a log line (the first level name in it), or None for lines without one."""
+    match = LEVEL_PATTERN.search(line)
+    if match is None:
+        return None
+    return LEVEL_ALIASES.get(match.group(1), match.group(1))
+
+
+def read_records_backward(lines):
+    """
+    Group lines read backward into records: a line with a level, and the lines without one following it (like the
+    lines of a traceback). Records are generated newest first, as lists of lines read backward (the line with the
+    level last).
+    """
+    record = []
+    for line in lines:
+        record.append(line)
+        if get_level(line) or len(record) >= MAX_RECORD_LINES:
+            yield record
+            record = []
+    if record:
+        yield record
+
+
+def record_filter(level=None, logger_name=None, substring=None):
+    """
+    Get a function checking if a record (see read_records_backward) has level or a higher one, comes from a logger
+    (like pkt.db, including its children) and contains a substring. Returns None if there are no filters.
+    The level and the logger name are looked for in the first line of records, whatever the log format.
+    """
+    if level is not None:
+        level = LEVEL_ALIASES.get(level.upper(), level.upper())
+        if level not in LEVELS:
+            raise ValueError("unknown log level {}, must be one of: {}".format(level, ', '.join(LEVELS)))
+    if level is None and not logger_name and not substring:
+        return None
+    logger_pattern = re.compile(r'(?<![\w.]){}(?!\w)'.format(re.escape(logger_name))) if logger_name else None
+
+    def matches(record):
+        """Check if a record matches the filters."""
+        if level is not None:
+            record_level = get_level(record[-1])
+            if record_level is None or LEVELS.index(record_level) < LEVELS.index(level):
+                return False
+        if logger_pattern and not logger_pattern.search(record[-1]):
+            return False
+        return not substring or any(substring in line for line in record)
+
+    return matches
+
+
+def tail(path, lines_num, level=None, logger_name=None, substring=None, block_size=BLOCK_SIZE, max_bytes=None):
+    """
+    Get a generator of the last lines_num lines of a log file, newest first, keeping only the records matching the
+    filters if any (see record_filter). An invalid lines_num or filters, and missing files, raise at once, not when
+    generating. Reading stops max_bytes bytes before the end of the file, if set.
+    """
+    if isinstance(lines_num, bool) or not isinstance(lines_num, int) or lines_num < 1:
+        raise ValueError("invalid lines_num {}, must be a positive integer".format(lines_num))
+    matches = record_filter(level, logger_name, substring)
+    os.stat(path)
+
+    def generate_lines():
+        """Read the log backward, as far as needed."""
+        with open(path, 'rb') as logfile:
+            lines = read_lines_backward(logfile, block_size, max_bytes)
+            if matches is not None:
+                lines = (line for record in read_records_backward(lines) if matches(record) for line in record)
+            yield from itertools.islice(lines, lines_num)
+
+    return generate_lines()
@@ -0,0 +1,182 @@
+"""Courier to package matching engine."""
+import logging
+import threading
+import time
+
+import numpy
+
+import geo
+
+LOGGER = logging.getLogger('pkt.api')
+# Relative weights of the score components: closeness, payment, collateral (a penalty) and deadline urgency.
+DEFAULT_WEIGHTS = {'distance': 1.0, 'payment': 0.5, 'collateral': 0.25, 'deadline': 0.25}
+# Number of couriers matched at once, bounding the size of the distance matrix.
+COURIERS_BLOCK_SIZE = 256
+
+
+class UnknownCourier(Exception):
+    """No known position for courier."""
+
+
+def unit_vectors(latitudes, longitudes):
+    """
+    Get the unit vectors of positions (in degrees) on the sphere, as an array of shape (positions, 3).
+    The cosine of the angle between two positions is the dot product of their vectors, so the distances between
+    many positions are computed with a single matrix product.
+    """
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    longitudes = numpy.radians(numpy.asarray(longitudes, dtype=float))
+    return numpy.stack((
+        numpy.cos(latitudes) * numpy.cos(longitudes), numpy.cos(latitudes) * numpy.sin(longitudes),
+        numpy.sin(latitudes)), axis=-1)
+
+
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+# A plain record of one array per package attribute, replaced as a whole on every refresh.
+class PackagesSnapshot:
+    """Arrays describing the packages waiting for pickup, one entry per package, ordered by latitude."""
+
+    def __init__(self, packages):
+        packages = sorted(packages, key=lambda package: package['latitude'])
+        self.latitudes = numpy.array([package['latitude'] for package in packages], dtype=float)
+        self.escrow_pubkeys = [package['escrow_pubkey'] for package in packages]
+        self.vectors = unit_vectors(
+            [package['latitude'] for package in packages], [package['longitude'] for package in packages]).reshape(
+                len(packages), 3)
+        self.payments = numpy.array([package['payment'] or 0 for package in packages], dtype=float)
+        self.collaterals = numpy.array([package['collateral'] or 0 for package in packages], dtype=float)
+        self.deadlines = numpy.array([package['deadline'] or 0 for package in packages], dtype=float)
+        self.payment_scores = self.payments / (self.payments.max() if packages and self.payments.max() else 1)
+        self.collateral_scores = self.collaterals / (
+            self.collaterals.max() if packages and self.collaterals.max() else 1)
+# pylint: enable=too-few-public-methods,too-many-instance-attributes
+
+
+# pylint: disable=too-many-instance-attributes
+# The scoring settings sit next to the snapshots the refreshes replace under the lock.
+class MatchingEngine:
+    """
+    Suggests packages waiting for pickup to couriers, scoring each pair by distance, payment, collateral and
+    deadline. Positions are kept in NumPy arrays, and distances are computed for blocks of couriers at once.
+    Packages and couriers are reloaded with load_packages and load_couriers every refresh_interval seconds.
+    """
+
+    def __init__(
+            self, load_packages, load_couriers, refresh_interval=30, max_distance_km=50, deadline_horizon=86400,
+            weights=None):
+        self.load_packages = load_packages
+        self.load_couriers = load_couriers
+        self.refresh_interval = refresh_interval
+        self.max_distance_km = max_distance_km
+        self.deadline_horizon = deadline_horizon
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.lock = threading.Lock()
+        self.packages = PackagesSnapshot([])
+        self.couriers = {}
+        self.refreshed_at = None
+
+    def set_packages(self, packages):
+        """Replace the packages, given as dicts with escrow_pubkey, latitude, longitude, payment and so on."""
+        self.packages = PackagesSnapshot(packages)
+
+    def set_couriers(self, couriers):
+        """Replace the couriers, given as dicts with user_pubkey, latitude and longitude."""
+        self.couriers = {
+            courier['user_pubkey']: (courier['latitude'], courier['longitude']) for courier in couriers}
+
+    def refresh(self, force=False):
+        """Reload packages and couriers if they are older than the refresh interval."""
+        with self.lock:
+            if not force and self.refreshed_at and time.monotonic() - self.refreshed_at < self.refresh_interval:
+                return
+            self.set_packages(self.load_packages())
+            self.set_couriers(self.load_couriers())
+            self.refreshed_at = time.monotonic()
+        LOGGER.debug(
+            "matching engine refreshed with %s packages and %s couriers",
+            len(self.packages.escrow_pubkeys), len(self.couriers))
+
+    def score(self, packages, latitudes, longitudes, now=None, packages_slice=slice(None)):
+        """
+        Score a slice of the packages for a block of positions (in degrees).
+        Returns (scores, distances) matrices of shape (positions, packages). Packages out of reach, or past their
+        deadline, score -inf.
+        """
+        distances = unit_vectors(latitudes, longitudes) @ packages.vectors[packages_slice].T
+        numpy.clip(distances, -1, 1, out=distances)
+        numpy.arccos(distances, out=distances)
+        distances *= geo.EARTH_RADIUS_KM
+        # The package terms of the score are computed once for the whole block.
+        time_left = packages.deadlines[packages_slice] - (time.time() if now is None else now)
+        package_scores = (
+            self.weights['distance'] +
+            self.weights['payment'] * packages.payment_scores[packages_slice] -
+            self.weights['collateral'] * packages.collateral_scores[packages_slice] +
+            self.weights['deadline'] * numpy.clip(1 - time_left / self.deadline_horizon, 0, 1))
+        package_scores[time_left < 0] = -numpy.inf
+        scores = package_scores - distances * (self.weights['distance'] / self.max_distance_km)
+        scores[distances > self.max_distance_km] = -numpy.inf
+        return scores, distances
+
+    @staticmethod
+    def suggestion(packages, index, distance, score):
+        """Describe a suggested package."""
+        return {
+            'escrow_pubkey': packages.escrow_pubkeys[index], 'distance_km': float(distance), 'score': float(score),
+            'payment': int(packages.payments[index]), 'collateral': int(packages.collaterals[index]),
+            'deadline': int(packages.deadlines[index])}
+
+    def band(self, packages, latitudes):
+        """Get the slice of the packages within reach of a block of latitudes (in degrees)."""
+        reach = numpy.degrees(self.max_distance_km / geo.EARTH_RADIUS_KM)
+        return slice(
+            numpy.searchsorted(packages.latitudes, latitudes.min() - reach, 'left'),
+            numpy.searchsorted(packages.latitudes, latitudes.max() + reach, 'right'))
+
+    def best_suggestions(self, packages, band, scores, distances, top_k):
+        """Get the top_k suggestions, best first, for each row of the scores of a band of packages."""
+        top_k = min(int(top_k), band.stop - band.start)
+        best = numpy.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        best = numpy.take_along_axis(best, numpy.argsort(-numpy.take_along_axis(scores, best, axis=1), axis=1), axis=1)
+        return [
+            [self.suggestion(packages, band.start + index, distances[row, index], scores[row, index])
+             for index in indices if scores[row, index] > -numpy.inf]
+            for row, indices in enumerate(best)]
+
+    def suggest(self, positions, top_k=10, now=None):
+        """
+        Get the top_k suggestions, best first, for each of a list of (latitude, longitude) positions.
+        Positions are matched in blocks of nearby latitudes, each against the band of packages within reach.
+        """
+        packages = self.packages
+        suggestions = [[] for _ in positions]
+        if not packages.escrow_pubkeys or not positions:
+            return suggestions
+        positions = numpy.asarray(positions, dtype=float).reshape(len(positions), 2)
+        order = numpy.argsort(positions[:, 0], kind='stable')
+        for block_start in range(0, len(order), COURIERS_BLOCK_SIZE):
+            block = order[block_start:block_start + COURIERS_BLOCK_SIZE]
+            band = self.band(packages, positions[block, 0])
+            if band.stop == band.start:
+                continue
+            scores, distances = self.score(packages, positions[block, 0], positions[block, 1], now, band)
+            for row, row_suggestions in enumerate(self.best_suggestions(packages, band, scores, distances, top_k)):
+                suggestions[block[row]] = row_suggestions
+        return suggestions
+
+    def suggest_for_courier(self, user_pubkey, latitude=None, longitude=None, top_k=10):
+        """Get suggestions for a courier, at a given position or at the last known one."""
+        self.refresh()
+        if latitude is None or longitude is None:
+            try:
+                latitude, longitude = self.couriers[user_pubkey]
+            except KeyError:
+                raise UnknownCourier("no known position for courier {}".format(user_pubkey))
+        return self.suggest([(float(latitude), float(longitude))], top_k)[0]
+
+    def suggest_for_all(self, top_k=10):
+        """Get suggestions for all the active couriers, keyed by courier pubkey."""
+        self.refresh()
+        couriers = dict(self.couriers)
+        return dict(zip(couriers, self.suggest(list(couriers.values()), top_k)))
+# pylint: enable=too-many-instance-attributes
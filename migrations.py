@@ -0,0 +1,311 @@
+"""PaKeT database schema migrations."""
+import logging
+import sys
+
+import geo
+
+LOGGER = logging.getLogger('pkt.db')
+
+# Recompute the denormalized state columns of packages from their events.
+BACKFILL_PACKAGES_STATE = '''
+    UPDATE packages SET
+        status = CASE
+            WHEN EXISTS (
+                SELECT 1 FROM events WHERE events.escrow_pubkey = packages.escrow_pubkey
+                AND event_type = 'received') THEN 'delivered'
+            WHEN EXISTS (
+                SELECT 1 FROM events WHERE events.escrow_pubkey = packages.escrow_pubkey
+                AND event_type = 'couriered') THEN 'in transit'
+            WHEN EXISTS (
+                SELECT 1 FROM events WHERE events.escrow_pubkey = packages.escrow_pubkey
+                AND event_type = 'launched') THEN 'waiting pickup'
+            ELSE 'unknown' END,
+        custodian_pubkey = (
+            SELECT user_pubkey FROM events WHERE events.escrow_pubkey = packages.escrow_pubkey
+            ORDER BY timestamp DESC, id DESC LIMIT 1),
+        launch_date = (SELECT MIN(timestamp) FROM events WHERE events.escrow_pubkey = packages.escrow_pubkey),
+        last_event_at = (SELECT MAX(timestamp) FROM events WHERE events.escrow_pubkey = packages.escrow_pubkey)'''
+
+# Set the position of packages to the last known position of their events.
+BACKFILL_PACKAGES_POSITION = '''
+    UPDATE packages SET
+        latitude = (
+            SELECT latitude FROM events
+            WHERE events.escrow_pubkey = packages.escrow_pubkey AND latitude IS NOT NULL
+            ORDER BY timestamp DESC, id DESC LIMIT 1),
+        longitude = (
+            SELECT longitude FROM events
+            WHERE events.escrow_pubkey = packages.escrow_pubkey AND latitude IS NOT NULL
+            ORDER BY timestamp DESC, id DESC LIMIT 1)'''
+
+
+# The region of located events: the south west corner of their cell in a grid of 1 by 1 degrees, like "51,-1".
+EVENT_REGION = {
+    'mysql': "CONCAT(CAST(FLOOR(latitude) AS SIGNED), ',', CAST(FLOOR(longitude) AS SIGNED))",
+    # SQLite has no FLOOR, and its integer casts truncate toward zero.
+    'sqlite': """
+            (CAST(latitude AS INTEGER) - (latitude < CAST(latitude AS INTEGER))) || ',' ||
+            (CAST(longitude AS INTEGER) - (longitude < CAST(longitude AS INTEGER)))"""}
+
+# Count all events in the daily rollups of all regions ('*'), and located events in the rollups of their region too.
+FILL_EVENT_ROLLUP_USERS = '''
+        INSERT INTO event_rollup_users (region, day, event_type, user_pubkey)
+        SELECT DISTINCT {region}, DATE(timestamp), event_type, user_pubkey FROM events
+        WHERE user_pubkey IS NOT NULL AND {condition}'''
+FILL_EVENT_ROLLUPS = '''
+        INSERT INTO event_rollups (region, day, event_type, events_num, users_num)
+        SELECT {region}, DATE(timestamp), event_type, COUNT(*), COUNT(DISTINCT user_pubkey) FROM events
+        WHERE {condition}
+        GROUP BY 1, 2, 3'''
+FILL_EVENT_ROLLUPS_STATEMENTS = {
+    dialect: [
+        statement.format(region=region, condition=condition)
+        for statement in (FILL_EVENT_ROLLUP_USERS, FILL_EVENT_ROLLUPS)
+        for region, condition in (("'*'", '1 = 1'), (event_region, 'latitude IS NOT NULL'))]
+    for dialect, event_region in EVENT_REGION.items()}
+
+
+def backfill_events_coordinates(sql):
+    """Parse the location strings of events into coordinates."""
+    sql.execute('SELECT id, location FROM events WHERE location IS NOT NULL AND latitude IS NULL')
+    for event in sql.fetchall():
+        latitude, longitude = geo.parse_location(event['location'])
+        if latitude is not None:
+            sql.execute(
+                'UPDATE events SET latitude = %s, longitude = %s WHERE id = %s', (latitude, longitude, event['id']))
+
+
+# Creation statement of the events table, whose id column and timestamp default depend on the dialect.
+CREATE_EVENTS_TABLE = """
+        CREATE TABLE {table}(
+            {id_column}timestamp TIMESTAMP(6) NOT NULL DEFAULT {default_timestamp},
+            escrow_pubkey VARCHAR(56) NULL,
+            user_pubkey VARCHAR(56),
+            event_type VARCHAR(20),
+            location VARCHAR(24),
+            FOREIGN KEY(escrow_pubkey) REFERENCES packages(escrow_pubkey))"""
+
+# Creation statement of the transaction submissions table. Timestamps get explicit defaults, or MySQL would set the
+# first one to the current time on every update.
+CREATE_SUBMISSIONS_TABLE = """
+        CREATE TABLE transaction_submissions(
+            submission_id VARCHAR(32) NOT NULL PRIMARY KEY,
+            transaction_envelope TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP(6) NOT NULL DEFAULT {default_timestamp},
+            created_at TIMESTAMP(6) NOT NULL DEFAULT {default_timestamp},
+            updated_at TIMESTAMP(6) NOT NULL DEFAULT {default_timestamp},
+            response TEXT NULL,
+            error TEXT NULL)"""
+
+# Ordered list of (version, description, statements).
+# A statement is either shared by all dialects, or a dict of statements (or statement lists) by dialect.
+# Statements that can not be expressed in SQL are functions, called with a cursor.
+# Never edit a migration that has already been released - add a new one instead.
+MIGRATIONS = [
+    (1, 'create packages and events tables', [
+        '''
+        CREATE TABLE packages(
+            escrow_pubkey VARCHAR(56) UNIQUE,
+            launcher_pubkey VARCHAR(56),
+            recipient_pubkey VARCHAR(56),
+            deadline INTEGER,
+            payment INTEGER,
+            collateral INTEGER,
+            set_options_transaction VARCHAR(1024),
+            refund_transaction VARCHAR(1024),
+            merge_transaction VARCHAR(1024),
+            payment_transaction VARCHAR(1024))''',
+        {
+            'mysql': CREATE_EVENTS_TABLE.format(
+                table='events', id_column='', default_timestamp='CURRENT_TIMESTAMP(6)'),
+            'sqlite': CREATE_EVENTS_TABLE.format(
+                table='events', id_column='', default_timestamp='CURRENT_TIMESTAMP')}]),
+    (2, 'add events primary key and lookup indexes', [
+        {
+            'mysql': 'ALTER TABLE events ADD COLUMN id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST',
+            # SQLite can not add a primary key to an existing table, so the table is rebuilt.
+            'sqlite': [
+                CREATE_EVENTS_TABLE.format(
+                    table='events_with_id', id_column='id INTEGER PRIMARY KEY AUTOINCREMENT,\n            ',
+                    default_timestamp='CURRENT_TIMESTAMP'),
+                '''
+                INSERT INTO events_with_id (timestamp, escrow_pubkey, user_pubkey, event_type, location)
+                SELECT timestamp, escrow_pubkey, user_pubkey, event_type, location FROM events ORDER BY rowid''',
+                'DROP TABLE events',
+                'ALTER TABLE events_with_id RENAME TO events']},
+        'CREATE INDEX events_escrow_pubkey_timestamp ON events (escrow_pubkey, timestamp)',
+        'CREATE INDEX events_user_pubkey_event_type ON events (user_pubkey, event_type, escrow_pubkey)',
+        'CREATE INDEX packages_launcher_pubkey ON packages (launcher_pubkey)',
+        'CREATE INDEX packages_recipient_pubkey ON packages (recipient_pubkey)']),
+    (3, 'store package state on the packages row', [
+        {
+            'mysql': '''
+                ALTER TABLE packages
+                    ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'unknown',
+                    ADD COLUMN custodian_pubkey VARCHAR(56) NULL,
+                    ADD COLUMN launch_date TIMESTAMP(6) NULL DEFAULT NULL,
+                    ADD COLUMN last_event_at TIMESTAMP(6) NULL DEFAULT NULL''',
+            # SQLite adds a single column per statement.
+            'sqlite': [
+                "ALTER TABLE packages ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'unknown'",
+                'ALTER TABLE packages ADD COLUMN custodian_pubkey VARCHAR(56) NULL',
+                'ALTER TABLE packages ADD COLUMN launch_date TIMESTAMP(6) NULL DEFAULT NULL',
+                'ALTER TABLE packages ADD COLUMN last_event_at TIMESTAMP(6) NULL DEFAULT NULL']},
+        'CREATE INDEX packages_status_launch_date ON packages (status, launch_date)',
+        'CREATE INDEX packages_custodian_pubkey ON packages (custodian_pubkey)',
+        BACKFILL_PACKAGES_STATE]),
+    (4, 'add keyset pagination indexes', [
+        'CREATE INDEX events_timestamp_id ON events (timestamp, id)',
+        'CREATE INDEX packages_launch_date_escrow_pubkey ON packages (launch_date, escrow_pubkey)',
+        'CREATE INDEX packages_launcher_pubkey_launch_date ON packages (launcher_pubkey, launch_date, escrow_pubkey)',
+        {'mysql': 'DROP INDEX packages_launcher_pubkey ON packages', 'sqlite': 'DROP INDEX packages_launcher_pubkey'},
+        'CREATE INDEX packages_recipient_pubkey_launch_date ON packages (recipient_pubkey, launch_date, escrow_pubkey)',
+        {
+            'mysql': 'DROP INDEX packages_recipient_pubkey ON packages',
+            'sqlite': 'DROP INDEX packages_recipient_pubkey'}]),
+    (5, 'add event filter indexes', [
+        'CREATE INDEX events_event_type_timestamp ON events (event_type, timestamp, id)',
+        'CREATE INDEX events_user_pubkey_timestamp ON events (user_pubkey, timestamp, id)']),
+    (6, 'store coordinates of events and packages', [
+        {
+            'mysql': '''
+                ALTER TABLE events
+                    ADD COLUMN latitude DOUBLE NULL DEFAULT NULL,
+                    ADD COLUMN longitude DOUBLE NULL DEFAULT NULL''',
+            'sqlite': [
+                'ALTER TABLE events ADD COLUMN latitude DOUBLE NULL DEFAULT NULL',
+                'ALTER TABLE events ADD COLUMN longitude DOUBLE NULL DEFAULT NULL']},
+        {
+            'mysql': '''
+                ALTER TABLE packages
+                    ADD COLUMN latitude DOUBLE NULL DEFAULT NULL,
+                    ADD COLUMN longitude DOUBLE NULL DEFAULT NULL''',
+            'sqlite': [
+                'ALTER TABLE packages ADD COLUMN latitude DOUBLE NULL DEFAULT NULL',
+                'ALTER TABLE packages ADD COLUMN longitude DOUBLE NULL DEFAULT NULL']},
+        'CREATE INDEX packages_status_latitude_longitude ON packages (status, latitude, longitude)',
+        backfill_events_coordinates,
+        BACKFILL_PACKAGES_POSITION]),
+    (7, 'add daily event rollups', [
+        '''
+        CREATE TABLE event_rollups(
+            region VARCHAR(16) NOT NULL,
+            day DATE NOT NULL,
+            event_type VARCHAR(20) NOT NULL,
+            events_num BIGINT NOT NULL DEFAULT 0,
+            users_num BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (region, day, event_type))''',
+        '''
+        CREATE TABLE event_rollup_users(
+            region VARCHAR(16) NOT NULL,
+            day DATE NOT NULL,
+            event_type VARCHAR(20) NOT NULL,
+            user_pubkey VARCHAR(56) NOT NULL,
+            PRIMARY KEY (region, day, event_type, user_pubkey))''',
+        FILL_EVENT_ROLLUPS_STATEMENTS]),
+    (8, 'add transaction submissions queue', [
+        {
+            'mysql': CREATE_SUBMISSIONS_TABLE.format(default_timestamp='CURRENT_TIMESTAMP(6)'),
+            'sqlite': CREATE_SUBMISSIONS_TABLE.format(default_timestamp='CURRENT_TIMESTAMP')},
+        '''
+        CREATE INDEX transaction_submissions_status_next_attempt_at
+            ON transaction_submissions (status, next_attempt_at)''']),
+    (9, 'add package state versions', [
+        'ALTER TABLE packages ADD COLUMN state_version BIGINT NOT NULL DEFAULT 0'])]
+LATEST_VERSION = MIGRATIONS[-1][0]
+DIALECTS = ('mysql', 'sqlite')
+
+
+def dialect_statements(statements, dialect):
+    """Get the list of statements of a migration in a specific dialect."""
+    if dialect not in DIALECTS:
+        raise ValueError("unknown SQL dialect {}".format(dialect))
+    dialect_specific = []
+    for statement in statements:
+        if isinstance(statement, dict):
+            statement = statement[dialect]
+        dialect_specific.extend(statement if isinstance(statement, list) else [statement])
+    return dialect_specific
+
+
+def table_exists(sql, table_name, dialect='mysql'):
+    """Check if a table exists in the current database."""
+    if dialect == 'sqlite':
+        sql.execute(
+            "SELECT COUNT(*) AS tables_num FROM sqlite_master WHERE type = 'table' AND name = %s", (table_name,))
+    else:
+        sql.execute("""
+            SELECT COUNT(*) AS tables_num FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = %s""", (table_name,))
+    return sql.fetchone()['tables_num'] > 0
+
+
+def get_schema_version(sql_connection, dialect='mysql'):
+    """
+    Get the current schema version of the database.
+    Databases created before versioning was introduced are stamped as version 1.
+    """
+    with sql_connection() as sql:
+        if not table_exists(sql, 'schema_version', dialect):
+            sql.execute('''
+                CREATE TABLE schema_version(
+                    version INTEGER NOT NULL PRIMARY KEY,
+                    description VARCHAR(255),
+                    applied_at TIMESTAMP(6) NOT NULL DEFAULT {})'''.format(
+                        'CURRENT_TIMESTAMP' if dialect == 'sqlite' else 'CURRENT_TIMESTAMP(6)'))
+            LOGGER.debug('schema_version table created')
+            if table_exists(sql, 'packages', dialect):
+                LOGGER.info('stamping unversioned database as version 1')
+                sql.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                    MIGRATIONS[0][:2])
+        sql.execute('SELECT MAX(version) AS version FROM schema_version')
+        return sql.fetchone()['version'] or 0
+
+
+def migrate(sql_connection, target_version=None, dialect='mysql'):
+    """
+    Apply all pending migrations up to target_version (default is latest).
+    Each migration is recorded in the schema_version table once all its statements have run.
+    Note that MySQL commits DDL statements implicitly, so a failed migration may leave some of its statements applied.
+    Statements are run in the SQL dialect of the database ('mysql' or 'sqlite').
+    """
+    target_version = LATEST_VERSION if target_version is None else target_version
+    current_version = get_schema_version(sql_connection, dialect)
+    for version, description, statements in MIGRATIONS:
+        if current_version < version <= target_version:
+            LOGGER.info("applying migration %s: %s", version, description)
+            with sql_connection() as sql:
+                for statement in dialect_statements(statements, dialect):
+                    if callable(statement):
+                        statement(sql)
+                    else:
+                        sql.execute(statement)
+                sql.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (%s, %s)', (version, description))
+            current_version = version
+    return current_version
+
+
+def backfill_packages_state(sql_connection):
+    """Recompute the state columns of all packages from their events. Returns the number of updated rows."""
+    with sql_connection() as sql:
+        sql.execute(BACKFILL_PACKAGES_STATE)
+        updated_rows = sql.rowcount
+        sql.execute(BACKFILL_PACKAGES_POSITION)
+        return updated_rows
+
+
+if __name__ == '__main__':
+    # pylint: disable=wrong-import-position
+    import db
+    # pylint: enable=wrong-import-position
+    if sys.argv[1:] == ['backfill']:
+        print("backfilled {} packages".format(db.backfill_packages_state()))
+    elif sys.argv[1:] == ['rebuild_rollups']:
+        print("rolled up {} events".format(db.rebuild_rollups()))
+    else:
+        print("database is at schema version {}".format(
+            db.migrate_db(int(sys.argv[1]) if len(sys.argv) > 1 else None)))
@@ -0,0 +1,245 @@
+"""Bounded, thread-safe SQL connection pool."""
+import contextlib
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('pkt.db')
+
+
+class PoolExhausted(Exception):
+    """No connection became available within the checkout timeout."""
+
+
+# pylint: disable=too-few-public-methods
+# A plain record of a connection and its timestamps, managed by the pool.
+class PooledConnection:
+    """A connection along with its pool bookkeeping."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = self.last_used_at = time.monotonic()
+# pylint: enable=too-few-public-methods
+
+
+# pylint: disable=too-many-instance-attributes
+# The pool settings sit next to its state, which the reaper and the checkouts share under one condition.
+class ConnectionPool:
+    """
+    A bounded pool of database connections.
+    min_size connections are opened up front, and more are opened on demand, up to max_size. Idle connections beyond
+    min_size are closed after idle_timeout seconds, and any connection is closed once it is older than max_lifetime
+    seconds - by a reaper thread checking idle connections every reap_interval seconds, and on checkout and checkin.
+    If health_check is set, connections are checked with is_alive before being handed out.
+    """
+
+    def __init__(
+            self, connect, min_size=1, max_size=10, idle_timeout=300, max_lifetime=3600, checkout_timeout=10,
+            health_check=True, is_alive=None, reap_interval=30):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("invalid pool size bounds: min {}, max {}".format(min_size, max_size))
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+        self.is_alive = is_alive or (lambda connection: connection.is_connected())
+        self.condition = threading.Condition()
+        self.idle = []
+        self.size = 0
+        self.counters = dict(
+            in_use=0, waiting=0, checkouts=0, timeouts=0, created=0, discarded=0, reaped=0,
+            checkout_seconds_total=0.0, checkout_seconds_max=0.0)
+        self.closed = threading.Event()
+        self.fill()
+        self.reaper = None
+        if reap_interval:
+            self.reaper = threading.Thread(
+                target=self.run_reaper, args=(reap_interval,), name='connection-pool-reaper', daemon=True)
+            self.reaper.start()
+
+    def is_expired(self, pooled, now):
+        """Check if a connection has outlived its maximal lifetime, or idled for too long."""
+        if self.max_lifetime and now - pooled.created_at > self.max_lifetime:
+            return True
+        return bool(
+            self.idle_timeout and now - pooled.last_used_at > self.idle_timeout and self.size > self.min_size)
+
+    def discard(self, pooled):
+        """Close a connection and remove it from the pool. Must be called while holding the condition."""
+        self.size -= 1
+        self.counters['discarded'] += 1
+        self.condition.notify()
+        try:
+            pooled.connection.close()
+        # pylint: disable=broad-except
+        # Closing a broken connection can fail in any number of ways, none of which matter.
+        except Exception as exception:
+            LOGGER.debug("error closing pooled connection: %s", exception)
+        # pylint: enable=broad-except
+
+    def fill(self):
+        """
+        Open connections until min_size connections are open. Failures are logged, and the missing connections
+        are opened on demand instead.
+        """
+        while not self.closed.is_set():
+            with self.condition:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                pooled = PooledConnection(self.connect())
+            # pylint: disable=broad-except
+            # Whatever prevents connecting now, checkouts will try again (and raise).
+            except Exception as exception:
+                with self.condition:
+                    self.size -= 1
+                    self.condition.notify()
+                LOGGER.warning("could not open pooled connection: %s", exception)
+                return
+            # pylint: enable=broad-except
+            with self.condition:
+                self.counters['created'] += 1
+                self.idle.insert(0, pooled)
+                self.condition.notify()
+
+    def reap(self):
+        """Close the idle connections that expired, and open connections up to min_size again."""
+        with self.condition:
+            now = time.monotonic()
+            for pooled in list(self.idle):
+                if self.is_expired(pooled, now):
+                    self.idle.remove(pooled)
+                    self.counters['reaped'] += 1
+                    self.discard(pooled)
+        self.fill()
+
+    def run_reaper(self, interval):
+        """Reaper loop: reap the pool every interval seconds, until it is closed."""
+        while not self.closed.wait(interval):
+            try:
+                self.reap()
+            # pylint: disable=broad-except
+            # The reaper must survive anything, connections are checked again on checkout anyway.
+            except Exception:
+                LOGGER.exception('connection pool reaper failed')
+            # pylint: enable=broad-except
+
+    def take_idle(self):
+        """Take a usable idle connection, discarding expired and dead ones. Must be called holding the condition."""
+        while self.idle:
+            pooled = self.idle.pop()
+            if self.is_expired(pooled, time.monotonic()):
+                self.discard(pooled)
+                continue
+            if self.health_check and not self.is_alive(pooled.connection):
+                LOGGER.warning('discarding dead pooled connection')
+                self.discard(pooled)
+                continue
+            return pooled
+        return None
+
+    def checkout(self):
+        """Get a connection from the pool, opening a new one if needed and allowed."""
+        start_time = time.monotonic()
+        deadline = start_time + self.checkout_timeout
+        with self.condition:
+            self.counters['waiting'] += 1
+            try:
+                while True:
+                    pooled = self.take_idle()
+                    if pooled is not None:
+                        break
+                    if self.size < self.max_size:
+                        # Reserve the slot before connecting, and connect outside of the lock.
+                        self.size += 1
+                        self.condition.release()
+                        try:
+                            pooled = PooledConnection(self.connect())
+                        except Exception:
+                            self.condition.acquire()
+                            self.size -= 1
+                            self.condition.notify()
+                            raise
+                        self.condition.acquire()
+                        self.counters['created'] += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters['timeouts'] += 1
+                        raise PoolExhausted("no connection available after {} seconds ({} in use)".format(
+                            self.checkout_timeout, self.counters['in_use']))
+                    self.condition.wait(remaining)
+            finally:
+                self.counters['waiting'] -= 1
+            checkout_seconds = time.monotonic() - start_time
+            self.counters['in_use'] += 1
+            self.counters['checkouts'] += 1
+            self.counters['checkout_seconds_total'] += checkout_seconds
+            self.counters['checkout_seconds_max'] = max(self.counters['checkout_seconds_max'], checkout_seconds)
+        return pooled
+
+    def checkin(self, pooled, broken=False):
+        """Return a connection to the pool, or close it if it is broken or expired."""
+        with self.condition:
+            self.counters['in_use'] -= 1
+            pooled.last_used_at = time.monotonic()
+            if broken or self.is_expired(pooled, pooled.last_used_at):
+                self.discard(pooled)
+            else:
+                self.idle.append(pooled)
+                self.condition.notify()
+
+    @contextlib.contextmanager
+    def sql_connection(self):
+        """
+        Context manager yielding a dictionary cursor on a pooled connection.
+        The transaction is committed on success and rolled back on error, as with util.db.custom_sql_connection.
+        """
+        pooled = self.checkout()
+        broken = False
+        cursor = None
+        try:
+            cursor = pooled.connection.cursor(dictionary=True)
+            yield cursor
+            pooled.connection.commit()
+        except Exception:
+            try:
+                pooled.connection.rollback()
+            # pylint: disable=broad-except
+            # A failed rollback means the connection is unusable - it is discarded and the original error raised.
+            except Exception:
+                broken = True
+            # pylint: enable=broad-except
+            raise
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                # pylint: disable=broad-except
+                except Exception:
+                    broken = True
+                # pylint: enable=broad-except
+            self.checkin(pooled, broken)
+
+    def close(self):
+        """Stop the reaper, and close all idle connections."""
+        self.closed.set()
+        if self.reaper is not None and self.reaper is not threading.current_thread():
+            self.reaper.join()
+        with self.condition:
+            while self.idle:
+                self.discard(self.idle.pop())
+
+    def stats(self):
+        """Get pool statistics."""
+        with self.condition:
+            stats = dict(self.counters, size=self.size, idle=len(self.idle), max_size=self.max_size)
+        checkout_seconds_total = stats.pop('checkout_seconds_total')
+        stats['checkout_ms_avg'] = 1000 * checkout_seconds_total / stats['checkouts'] if stats['checkouts'] else 0
+        stats['checkout_ms_max'] = 1000 * stats.pop('checkout_seconds_max')
+        return stats
+# pylint: enable=too-many-instance-attributes
@@ -0,0 +1,144 @@
+"""Routing of reads between a primary database and its read replicas."""
+import contextlib
+import itertools
+import logging
+import threading
+import time
+
+import db_rows
+
+LOGGER = logging.getLogger('pkt.db')
+
+
+def mysql_replication_lag(sql):
+    """Get the replication lag of a MySQL replica in seconds, or None if it is not replicating."""
+    sql.execute('SHOW SLAVE STATUS')
+    status = sql.fetchone()
+    if not status:
+        return None
+    return db_rows.decode_keys(status).get('Seconds_Behind_Master')
+
+
+# pylint: disable=too-few-public-methods
+# A plain record of a replica and its health, managed by the router.
+class Replica:
+    """A read replica and its health."""
+
+    def __init__(self, name, sql_connection):
+        self.name = name
+        self.sql_connection = sql_connection
+        self.lag = None
+        self.checked_at = None
+        self.down_until = 0
+# pylint: enable=too-few-public-methods
+
+
+# pylint: disable=too-many-instance-attributes
+# The routing settings sit next to the replica state the request threads share.
+class ReplicaRouter:
+    """
+    Routes reads to healthy read replicas in a round robin, falling back to the primary.
+    A replica is skipped while its replication lag exceeds max_lag seconds, and for retry_interval seconds after it
+    fails. Reads concerning keys (users, packages) that were written in the last read_your_writes_window seconds go
+    to the primary, so writers always see their own writes.
+    """
+
+    def __init__(
+            self, primary, replicas, max_lag=5, lag_check_interval=5, retry_interval=30,
+            read_your_writes_window=10, get_lag=mysql_replication_lag):
+        self.primary = primary
+        self.replicas = [Replica(name, sql_connection) for name, sql_connection in replicas]
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.retry_interval = retry_interval
+        self.read_your_writes_window = read_your_writes_window
+        self.get_lag = get_lag
+        self.lock = threading.Lock()
+        self.round_robin = itertools.cycle(range(len(self.replicas)))
+        self.recent_writes = {}
+        self.counters = dict(primary_reads=0, replica_reads=0, read_your_writes=0, failovers=0)
+
+    def mark_written(self, keys):
+        """Mark keys as recently written, sending their reads to the primary for a while."""
+        now = time.monotonic()
+        with self.lock:
+            if len(self.recent_writes) > 10000:
+                self.recent_writes = {
+                    key: expires_at for key, expires_at in self.recent_writes.items() if expires_at > now}
+            for key in keys:
+                if key is not None:
+                    self.recent_writes[key] = now + self.read_your_writes_window
+
+    def recently_written(self, keys):
+        """Check if any of the keys was recently written."""
+        now = time.monotonic()
+        with self.lock:
+            return any(self.recent_writes.get(key, 0) > now for key in keys)
+
+    def mark_down(self, replica, reason):
+        """Stop using a replica for a while."""
+        LOGGER.warning("replica %s is down: %s", replica.name, reason)
+        replica.down_until = time.monotonic() + self.retry_interval
+
+    def is_healthy(self, replica):
+        """Check if a replica is up and not lagging too far behind, checking its lag if it was not checked lately."""
+        now = time.monotonic()
+        if replica.down_until > now:
+            return False
+        if replica.checked_at is None or now - replica.checked_at > self.lag_check_interval:
+            replica.checked_at = now
+            try:
+                with replica.sql_connection() as sql:
+                    replica.lag = self.get_lag(sql)
+            # pylint: disable=broad-except
+            # Whatever the reason, a replica that can't report its lag should not be read from.
+            except Exception as exception:
+                replica.lag = None
+                self.mark_down(replica, exception)
+                return False
+            # pylint: enable=broad-except
+            if replica.lag is None or replica.lag > self.max_lag:
+                LOGGER.warning("replica %s is lagging (%s seconds)", replica.name, replica.lag)
+        return replica.lag is not None and replica.lag <= self.max_lag
+
+    def choose_replica(self, keys):
+        """Choose the replica for a read concerning keys, or None for the primary."""
+        if self.recently_written(keys):
+            self.counters['read_your_writes'] += 1
+            return None
+        with self.lock:
+            start = next(self.round_robin)
+        candidates = self.replicas[start:] + self.replicas[:start]
+        for replica in candidates:
+            if self.is_healthy(replica):
+                return replica
+        return None
+
+    @contextlib.contextmanager
+    def read_connection(self, keys=()):
+        """Context manager yielding a cursor for a read concerning keys."""
+        replica = self.choose_replica(keys)
+        with contextlib.ExitStack() as stack:
+            sql = None
+            if replica is not None:
+                try:
+                    sql = stack.enter_context(replica.sql_connection())
+                    self.counters['replica_reads'] += 1
+                # pylint: disable=broad-except
+                # Failing to connect to a replica is never fatal, the primary can serve the read.
+                except Exception as exception:
+                    self.counters['failovers'] += 1
+                    self.mark_down(replica, exception)
+                # pylint: enable=broad-except
+            if sql is None:
+                sql = stack.enter_context(self.primary())
+                self.counters['primary_reads'] += 1
+            yield sql
+
+    def stats(self):
+        """Get routing statistics."""
+        now = time.monotonic()
+        return dict(self.counters, replicas=[{
+            'name': replica.name, 'lag': replica.lag, 'down': replica.down_until > now}
+                                             for replica in self.replicas])
+# pylint: enable=too-many-instance-attributes
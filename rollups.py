@@ -0,0 +1,113 @@
+"""Daily event counts, pre-aggregated by event type and region."""
+import collections
+import datetime
+import logging
+import math
+
+import db_rows
+import geo
+
+LOGGER = logging.getLogger('pkt.db')
+# Region of the rollups counting all events, located or not.
+ALL_REGIONS = '*'
+# Regions are cells of a grid of REGION_DEGREES by REGION_DEGREES, named after their south west corner.
+REGION_DEGREES = 1
+REBUILD_BATCH_SIZE = 10000
+# Rows per multi-row statement, keeping statement parameters within the limits of both engines.
+MAX_STATEMENT_ROWS = 500
+# The distinct users of a rollup are recounted from event_rollup_users, which the same transaction has just filled.
+UPSERT_ROLLUPS = {
+    'mysql': """
+        INSERT INTO event_rollups (region, day, event_type, events_num, users_num) VALUES {}
+        ON DUPLICATE KEY UPDATE events_num = events_num + VALUES(events_num), users_num = VALUES(users_num)""",
+    'sqlite': """
+        INSERT INTO event_rollups (region, day, event_type, events_num, users_num) VALUES {}
+        ON CONFLICT (region, day, event_type) DO UPDATE SET
+            events_num = events_num + excluded.events_num, users_num = excluded.users_num"""}
+ROLLUP_VALUES = """(%s, %s, %s, %s, (
+            SELECT COUNT(*) FROM event_rollup_users WHERE region = %s AND day = %s AND event_type = %s))"""
+INSERT_ROLLUP_USERS = {
+    'mysql': """
+        INSERT IGNORE INTO event_rollup_users (region, day, event_type, user_pubkey) VALUES {}""",
+    'sqlite': """
+        INSERT OR IGNORE INTO event_rollup_users (region, day, event_type, user_pubkey) VALUES {}"""}
+
+
+def get_region(latitude, longitude):
+    """Get the region of a position, or None if it is unknown."""
+    if latitude is None or longitude is None:
+        return None
+    return "{},{}".format(
+        math.floor(latitude / REGION_DEGREES) * REGION_DEGREES, math.floor(longitude / REGION_DEGREES) * REGION_DEGREES)
+
+
+def rollup_keys(event):
+    """Get the (region, day, event_type) keys of the rollups counting an event."""
+    if 'latitude' in event:
+        latitude, longitude = event['latitude'], event['longitude']
+    else:
+        latitude, longitude = geo.parse_location(event.get('location'))
+    day = event['timestamp'].date()
+    regions = [ALL_REGIONS]
+    if get_region(latitude, longitude) is not None:
+        regions.append(get_region(latitude, longitude))
+    return [(region, day, event['event_type']) for region in regions]
+
+
+def chunks(rows, size=MAX_STATEMENT_ROWS):
+    """Split a list of rows into lists of up to size rows."""
+    return [rows[index:index + size] for index in range(0, len(rows), size)]
+
+
+def update_rollups(sql, events, dialect='mysql'):
+    """
+    Count a list of new events in the rollups, along with the users they add to each rollup, with a multi-row
+    statement adding the users and another one updating the rollups (per MAX_STATEMENT_ROWS rows).
+    """
+    events_nums = collections.Counter()
+    rollup_users = set()
+    for event in events:
+        for key in rollup_keys(event):
+            events_nums[key] += 1
+            if event['user_pubkey'] is not None:
+                rollup_users.add(key + (event['user_pubkey'],))
+    # Rows are written in key order, so concurrent updates lock them in the same order.
+    for rows in chunks(sorted(rollup_users)):
+        sql.execute(INSERT_ROLLUP_USERS[dialect].format(', '.join(['(%s, %s, %s, %s)'] * len(rows))), tuple(
+            value for row in rows for value in row))
+    for rows in chunks(sorted(events_nums.items())):
+        sql.execute(UPSERT_ROLLUPS[dialect].format(', '.join([ROLLUP_VALUES] * len(rows))), tuple(
+            value for key, events_num in rows for value in key + (events_num,) + key))
+
+
+def rebuild_rollups(sql, dialect='mysql', batch_size=REBUILD_BATCH_SIZE):
+    """Recompute all the rollups from the events table. Returns the number of counted events."""
+    sql.execute('DELETE FROM event_rollups')
+    sql.execute('DELETE FROM event_rollup_users')
+    last_id, events_num = 0, 0
+    while True:
+        sql.execute("""
+            SELECT id, timestamp, user_pubkey, event_type, latitude, longitude FROM events
+            WHERE id > %s ORDER BY id ASC LIMIT %s""", (last_id, batch_size))
+        events = db_rows.decode_rows(sql.fetchall())
+        if not events:
+            break
+        update_rollups(sql, events, dialect)
+        last_id = events[-1]['id']
+        events_num += len(events)
+        LOGGER.debug("rolled up %s events", events_num)
+    return events_num
+
+
+def get_rollups(sql, since_day, until_day, event_type=None, region=ALL_REGIONS):
+    """Get the rollups of a region from since_day (inclusive) to until_day (exclusive), by day and event type."""
+    conditions, params = ['region = %s', 'day >= %s', 'day < %s'], [region, since_day, until_day]
+    if event_type is not None:
+        conditions.append('event_type = %s')
+        params.append(event_type)
+    sql.execute("""
+        SELECT day, event_type, events_num, users_num FROM event_rollups
+        WHERE {} ORDER BY day ASC, event_type ASC""".format(' AND '.join(conditions)), tuple(params))
+    return [
+        dict(rollup, day=rollup['day'].isoformat() if isinstance(rollup['day'], datetime.date) else rollup['day'])
+        for rollup in sql.fetchall()]
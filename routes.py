@@ -1,5 +1,12 @@
 """JSON swagger API to PaKeT."""
+import atexit
+import binascii
+import concurrent.futures
+import contextlib
+import hashlib
+import json
 import os
+import time
 
 import flasgger
 import flask
@@ -9,13 +16,85 @@ import util.logger
 import util.conversion
 import webserver.validation
 
+import accounts
+import batches
 import db
+import encoding
+import logs
+import matching
+import sequences
+import submissions
 import swagger_specs
 
 LOGGER = util.logger.logging.getLogger('pkt.api')
 VERSION = swagger_specs.VERSION
 PORT = os.environ.get('PAKET_API_PORT', 8000)
 BLUEPRINT = flask.Blueprint('api', __name__)
+# Couriers with a located event in the last PAKET_MATCHING_COURIER_WINDOW seconds are considered active.
+MATCHING_COURIER_WINDOW = float(os.environ.get('PAKET_MATCHING_COURIER_WINDOW', 3600))
+MATCHING_ENGINE = matching.MatchingEngine(
+    db.get_waiting_packages_positions, lambda: db.get_users_positions(time.time() - MATCHING_COURIER_WINDOW),
+    float(os.environ.get('PAKET_MATCHING_REFRESH_INTERVAL', 30)),
+    float(os.environ.get('PAKET_MATCHING_MAX_DISTANCE_KM', 50)))
+# Long polls wait up to PACKAGE_UPDATES_MAX_TIMEOUT seconds, and event streams are closed after
+# PACKAGE_UPDATES_MAX_STREAM seconds (clients reconnect, with the id of the last event they got).
+PACKAGE_UPDATES_MAX_TIMEOUT = 60
+PACKAGE_UPDATES_MAX_STREAM = float(os.environ.get('PAKET_PACKAGE_UPDATES_MAX_STREAM', 300))
+PACKAGE_UPDATES_HEARTBEAT_INTERVAL = 15
+# Responses of PAKET_API_COMPRESSION_MIN_SIZE bytes or more are compressed, if the client accepts it.
+COMPRESSION_MIN_SIZE = int(os.environ.get('PAKET_API_COMPRESSION_MIN_SIZE', 1024))
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+# Horizon accounts are cached for PAKET_ACCOUNT_CACHE_TTL seconds. Setting the size to 0 disables the cache.
+ACCOUNT_CACHE_SIZE = int(os.environ.get('PAKET_ACCOUNT_CACHE_SIZE', 1000))
+ACCOUNT_CACHE_TTL = float(os.environ.get('PAKET_ACCOUNT_CACHE_TTL', 5))
+ACCOUNT_CACHE = accounts.AccountCache(
+    paket_stellar.get_bul_account, ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL) if ACCOUNT_CACHE_SIZE else None
+ACCOUNT_INVALIDATION_CHANNEL = 'pkt.accounts.invalidate'
+# Transactions submitted with mode=async are queued, and submitted by PAKET_SUBMISSION_SUBMITTERS_NUM background
+# threads per worker, which give up after PAKET_SUBMISSION_MAX_ATTEMPTS failed attempts.
+SUBMISSION_SUBMITTERS_NUM = int(os.environ.get('PAKET_SUBMISSION_SUBMITTERS_NUM', 2))
+SUBMISSION_MAX_ATTEMPTS = int(os.environ.get('PAKET_SUBMISSION_MAX_ATTEMPTS', 5))
+SUBMISSION_MODES = ('sync', 'async')
+# The sequence numbers of accounts are kept for PAKET_SEQUENCE_CACHE_TTL seconds after being fetched from horizon
+# or used by a prepared transaction. Setting it to 0 disables the cache.
+SEQUENCE_CACHE_TTL = float(os.environ.get('PAKET_SEQUENCE_CACHE_TTL', 30))
+SEQUENCES = sequences.SequenceManager(SEQUENCE_CACHE_TTL) if SEQUENCE_CACHE_TTL else None
+if SEQUENCES:
+    # The prepare_* transaction builders of paket_stellar look sequence numbers up through get_sequence, which only
+    # uses the cache within the cached_sequences() blocks of the prepare_* handlers. The builders take no sequence
+    # number argument, so it can't be passed to them explicitly.
+    if hasattr(paket_stellar.stellar_base.builder.Builder, 'get_sequence'):
+        SEQUENCES.hook(paket_stellar.stellar_base.builder.Builder)
+    else:
+        LOGGER.warning('transaction builder has no get_sequence - sequence numbers will not be cached')
+        SEQUENCES = None
+
+# Up to PAKET_MAX_PACKAGES_BY_IDS packages can be fetched at once by packages_by_ids.
+MAX_PACKAGES_BY_IDS = int(os.environ.get('PAKET_MAX_PACKAGES_BY_IDS', 100))
+# The debug log is read backward from its end, up to PAKET_LOG_MAX_SCAN_BYTES bytes back. Up to LOG_MAX_LINES lines
+# are returned as JSON, while streamed text is not limited.
+LOG_MAX_SCAN_BYTES = int(os.environ.get('PAKET_LOG_MAX_SCAN_BYTES', 256 * 1024 * 1024))
+LOG_MAX_LINES = 10000
+# Batches hold up to PAKET_BATCH_MAX_REQUESTS sub-requests, run by PAKET_BATCH_THREADS_NUM threads per worker.
+BATCH_MAX_REQUESTS = int(os.environ.get('PAKET_BATCH_MAX_REQUESTS', 20))
+BATCH_POOL = concurrent.futures.ThreadPoolExecutor(
+    int(os.environ.get('PAKET_BATCH_THREADS_NUM', 8)), thread_name_prefix='batch')
+atexit.register(BATCH_POOL.shutdown)
+# Batches and streams can not be batched, nor long polls (which would hold batch threads for up to a minute).
+BATCH_EXCLUDED_ENDPOINTS = (
+    'api.batch_handler', 'api.package_updates_handler', 'api.package_updates_stream_handler')
+
+
+def drop_account(pubkey):
+    """Drop an account from the account cache of this worker (all accounts if pubkey is None)."""
+    if pubkey is None:
+        ACCOUNT_CACHE.clear()
+    else:
+        ACCOUNT_CACHE.invalidate(pubkey)
+
+
+if ACCOUNT_CACHE:
+    db.BROKER.subscribe(ACCOUNT_INVALIDATION_CHANNEL, drop_account)
 
 
 # Input validators and fixers.
@@ -24,13 +103,168 @@ webserver.validation.KWARGS_CHECKERS_AND_FIXERS['_buls'] = webserver.validation.
 webserver.validation.KWARGS_CHECKERS_AND_FIXERS['_num'] = webserver.validation.check_and_fix_natural
 
 
+def not_modified(version, *params):
+    """
+    Tag the successful response of the current request with an ETag derived from a version marker of the data and
+    from the params shaping the response, and check whether the client already has it (If-None-Match).
+    Handlers returning {'status': 304} on a match skip building and serializing the response.
+    """
+    if version is None:
+        return False
+    etag = hashlib.sha1(json.dumps([flask.request.path, version] + list(params)).encode()).hexdigest()
+
+    @flask.after_this_request
+    def set_etag(response):
+        """Tag successful responses, including 304 ones."""
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+        return response
+
+    return flask.request.if_none_match.contains_weak(etag)
+
+
+# Response encoding.
+
+
+class JSONEncoder(json.JSONEncoder):
+    """JSON encoder of Flask versions before 2.2, delegating to encoding.dumps."""
+
+    def encode(self, o):
+        return encoding.dumps(o)
+
+
+@BLUEPRINT.record_once
+def use_fast_json(state):
+    """Encode the JSON responses of the app with encoding.dumps."""
+    if hasattr(state.app, 'json'):
+        state.app.json.dumps = lambda obj, **kwargs: encoding.dumps(obj)
+    else:
+        state.app.json_encoder = JSONEncoder
+
+
+def should_compress(response):
+    """Check if a response is worth compressing: a large enough, not yet encoded, successful one, not streamed."""
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+        return False
+    if 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return False
+    return response.calculate_content_length() >= COMPRESSION_MIN_SIZE
+
+
+@BLUEPRINT.after_request
+def compress_response(response):
+    """Compress large responses with the best encoding the client accepts (streamed responses are left alone)."""
+    if not should_compress(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    content_encoding = encoding.negotiate(flask.request.headers.get('Accept-Encoding'))
+    if content_encoding is None:
+        return response
+    response.set_data(encoding.compress(response.get_data(), content_encoding))
+    response.headers['Content-Encoding'] = content_encoding
+    # The compressed body is a different representation, so its ETag can only be a weak one.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
 # Wallet routes.
 
 
+def get_bul_account(pubkey):
+    """Get the details of a Stellar BUL account, from the account cache if possible."""
+    return ACCOUNT_CACHE.get(pubkey) if ACCOUNT_CACHE else paket_stellar.get_bul_account(pubkey)
+
+
+def transaction_accounts(transaction):
+    """
+    Get the pubkeys of the accounts a transaction envelope may change: its source, and the sources and destinations
+    of its operations. Returns None if the envelope can not be parsed.
+    """
+    try:
+        envelope = paket_stellar.stellar_base.transaction_envelope.TransactionEnvelope.from_xdr(transaction)
+        pubkeys = {envelope.tx.source}
+        for operation in envelope.tx.operations:
+            pubkeys.update((getattr(operation, 'source', None), getattr(operation, 'destination', None)))
+    # pylint: disable=broad-except
+    # stellar_base throws all kinds of exceptions on unexpected envelopes.
+    except Exception as exception:
+        LOGGER.warning("can not parse transaction envelope: %s", exception)
+        return None
+    # pylint: enable=broad-except
+    return {pubkey.decode() if isinstance(pubkey, bytes) else pubkey for pubkey in pubkeys - {None}}
+
+
+def invalidate_accounts(pubkeys):
+    """Drop accounts from the account cache of all workers (all accounts if pubkeys is None)."""
+    if ACCOUNT_CACHE:
+        for pubkey in [None] if pubkeys is None else pubkeys:
+            db.BROKER.publish(ACCOUNT_INVALIDATION_CHANNEL, pubkey)
+
+
+@contextlib.contextmanager
+def cached_sequences():
+    """
+    Serve the sequence numbers looked up by the transaction builders called in the block from the sequence cache
+    (without the cache, the builders look them up on Horizon). The accounts they are looked up for are held until the
+    block ends, so the block must call track_sequences with the transactions it prepares.
+    """
+    if not SEQUENCES:
+        yield
+        return
+    with SEQUENCES.serving():
+        yield
+
+
+def track_sequences(*transactions):
+    """Record the sequence numbers used by prepared transactions, so the next ones prepared follow them."""
+    if SEQUENCES:
+        SEQUENCES.advance_envelopes(*transactions)
+
+
+def resync_bad_sequence(transaction):
+    """Drop the cached sequence number of the source of a transaction rejected by horizon with tx_bad_seq."""
+    if SEQUENCES:
+        source_and_sequence = sequences.envelope_source_and_sequence(transaction)
+        if source_and_sequence:
+            SEQUENCES.resync(source_and_sequence[0])
+
+
+def find_transaction(transaction):
+    """Look a signed transaction envelope up on Horizon by its hash: get its record if applied, None otherwise."""
+    transaction_hash = paket_stellar.stellar_base.transaction_envelope.TransactionEnvelope.from_xdr(
+        transaction).hash_meta()
+    record = paket_stellar.stellar_base.horizon.Horizon(paket_stellar.HORIZON_SERVER).transaction(
+        binascii.hexlify(transaction_hash).decode())
+    if isinstance(record, dict) and record.get('status') == 404:
+        return None
+    return record
+
+
+def submit_transaction(transaction):
+    """
+    Submit a signed transaction envelope to Horizon (see submissions.submit_envelope), and drop the accounts it
+    involves from the account cache.
+    """
+    response = submissions.submit_envelope(
+        transaction, paket_stellar.submit_transaction_envelope, find_transaction, resync_bad_sequence)
+    invalidate_accounts(transaction_accounts(transaction))
+    return response
+
+
+SUBMISSION_QUEUE = submissions.SubmissionQueue(
+    db.SQL_CONNECTION, submit_transaction, SUBMISSION_SUBMITTERS_NUM, SUBMISSION_MAX_ATTEMPTS,
+    lookup=find_transaction)
+# Submitters start with the worker, so submissions queued before a restart are drained without waiting for new ones.
+SUBMISSION_QUEUE.start()
+atexit.register(SUBMISSION_QUEUE.stop)
+
+
 @BLUEPRINT.route("/v{}/submit_transaction".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.SUBMIT_TRANSACTION)
 @webserver.validation.call(['transaction'])
-def submit_transaction_handler(transaction):
+def submit_transaction_handler(transaction, mode='sync'):
     """
     Submit a signed transaction.
     This call is used to submit signed transactions.
@@ -38,11 +272,35 @@ def submit_transaction_handler(transaction):
     transactions returned by other calls. You can use the
     [laboratory](https://www.stellar.org/laboratory/#txsigner?network=test) to
     sign the transaction with your private key.
+    With mode=async the transaction is queued for submission, and its submission_id is returned at once -
+    use it to poll transaction_status.
     ---
     :param transaction:
+    :param mode:
     :return:
     """
-    return {'status': 200, 'response': paket_stellar.submit_transaction_envelope(transaction)}
+    if mode not in SUBMISSION_MODES:
+        return {'status': 400, 'error': "invalid mode {}, must be one of: {}".format(mode, ', '.join(SUBMISSION_MODES))}
+    if mode == 'async':
+        return {'status': 202, 'submission_id': SUBMISSION_QUEUE.enqueue(transaction)}
+    return {'status': 200, 'response': submit_transaction(transaction)}
+
+
+@BLUEPRINT.route("/v{}/transaction_status".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.TRANSACTION_STATUS)
+@webserver.validation.call(['submission_id'])
+def transaction_status_handler(submission_id):
+    """
+    Get the status of a transaction submitted with mode=async: queued, submitting, succeeded or failed.
+    Once submitted, the horizon response is included. Failed attempts are retried, and their error is included.
+    ---
+    :param submission_id:
+    :return:
+    """
+    try:
+        return {'status': 200, 'submission': SUBMISSION_QUEUE.get_status(submission_id)}
+    except submissions.UnknownSubmission as exception:
+        return {'status': 404, 'error': str(exception)}
 
 
 @BLUEPRINT.route("/v{}/bul_account".format(VERSION), methods=['POST'])
@@ -51,11 +309,12 @@ def submit_transaction_handler(transaction):
 def bul_account_handler(queried_pubkey):
     """
     Get the details of a Stellar BUL account.
+    Accounts are cached for a few seconds, and dropped from the cache when a transaction involving them is submitted.
     ---
     :param queried_pubkey:
     :return:
     """
-    account = paket_stellar.get_bul_account(queried_pubkey)
+    account = get_bul_account(queried_pubkey)
     return dict(status=200, **account)
 
 
@@ -72,8 +331,10 @@ def prepare_account_handler(from_pubkey, new_pubkey, starting_balance=50000000):
     :return:
     """
     try:
-        return {'status': 200, 'transaction': paket_stellar.prepare_create_account(
-            from_pubkey, new_pubkey, starting_balance)}
+        with cached_sequences():
+            transaction = paket_stellar.prepare_create_account(from_pubkey, new_pubkey, starting_balance)
+            track_sequences(transaction)
+        return {'status': 200, 'transaction': transaction}
     # pylint: disable=broad-except
     # stellar_base throws this as a broad exception.
     except Exception as exception:
@@ -95,7 +356,10 @@ def prepare_trust_handler(from_pubkey, limit=None):
     :param limit:
     :return:
     """
-    return {'status': 200, 'transaction': paket_stellar.prepare_trust(from_pubkey, limit)}
+    with cached_sequences():
+        transaction = paket_stellar.prepare_trust(from_pubkey, limit)
+        track_sequences(transaction)
+    return {'status': 200, 'transaction': transaction}
 
 
 @BLUEPRINT.route("/v{}/prepare_send_buls".format(VERSION), methods=['POST'])
@@ -110,7 +374,10 @@ def prepare_send_buls_handler(from_pubkey, to_pubkey, amount_buls):
     :param amount_buls:
     :return:
     """
-    return {'status': 200, 'transaction': paket_stellar.prepare_send_buls(from_pubkey, to_pubkey, amount_buls)}
+    with cached_sequences():
+        transaction = paket_stellar.prepare_send_buls(from_pubkey, to_pubkey, amount_buls)
+        track_sequences(transaction)
+    return {'status': 200, 'transaction': transaction}
 
 
 # Package routes.
@@ -138,9 +405,13 @@ def prepare_escrow_handler(
     :param location:
     :return:
     """
-    package_details = paket_stellar.prepare_escrow(
-        user_pubkey, launcher_pubkey, courier_pubkey, recipient_pubkey,
-        payment_buls, collateral_buls, deadline_timestamp)
+    # The escrow transactions all follow a single sequence number of the escrow account, which stays held until the
+    # cache is moved past the last of them, so concurrent prepares can't reuse their numbers.
+    with cached_sequences():
+        package_details = paket_stellar.prepare_escrow(
+            user_pubkey, launcher_pubkey, courier_pubkey, recipient_pubkey,
+            payment_buls, collateral_buls, deadline_timestamp)
+        track_sequences(*[value for key, value in package_details.items() if key.endswith('_transaction')])
     db.create_package(**dict(package_details, location=location))
     return dict(status=201, **package_details)
 
@@ -161,38 +432,208 @@ def accept_package_handler(user_pubkey, escrow_pubkey, location=None):
     """
     package = db.get_package(escrow_pubkey)
     event_type = 'received' if package['recipient_pubkey'] == user_pubkey else 'couriered'
-    db.add_event(escrow_pubkey, user_pubkey, event_type, location)
+    db.add_event(escrow_pubkey, user_pubkey, event_type, location, sync=True)
     return {'status': 200}
 
 
 @BLUEPRINT.route("/v{}/my_packages".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.MY_PACKAGES)
 @webserver.validation.call(require_auth=True)
-def my_packages_handler(user_pubkey):
+def my_packages_handler(user_pubkey, max_packages_num=None, cursor=None, view=None, fields=None):
     """
     Get list of packages concerning the user.
+    Use max_packages_num to get a page of packages, and pass the returned next_cursor as cursor to get the next one.
+    Use view=summary, or a comma separated list of fields, to get lean packages.
+    Responses carry an ETag, and requests with a matching If-None-Match header get an empty 304 response.
     ---
     :param user_pubkey:
+    :param max_packages_num:
+    :param cursor:
+    :param view:
+    :param fields:
     :return:
     """
-    packages = db.get_packages(user_pubkey)
-    return {'status': 200, 'packages': packages}
+    if not_modified(db.get_packages_version(user_pubkey), user_pubkey, max_packages_num, cursor, view, fields):
+        return {'status': 304}
+    try:
+        packages, next_cursor = db.get_packages_page(user_pubkey, max_packages_num, cursor, view, fields)
+    except (db.InvalidCursor, db.UnknownField) as exception:
+        return {'status': 400, 'error': str(exception)}
+    return {'status': 200, 'packages': packages, 'next_cursor': next_cursor}
 
 
 @BLUEPRINT.route("/v{}/package".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.PACKAGE)
 @webserver.validation.call(['escrow_pubkey'])
-def package_handler(escrow_pubkey):
+def package_handler(escrow_pubkey, view=None, fields=None):
     """
     Get a full info about a single package.
+    Use view=summary, or a comma separated list of fields, to get a lean package.
+    Responses carry an ETag, and requests with a matching If-None-Match header get an empty 304 response.
     ---
     :param escrow_pubkey:
+    :param view:
+    :param fields:
     :return:
     """
-    package = db.get_package(escrow_pubkey)
+    version = db.get_package_version(escrow_pubkey)
+    if not_modified(version, escrow_pubkey, view, fields):
+        return {'status': 304}
+    try:
+        # A cached package older than the version would be served with the ETag of a newer one.
+        package = db.get_package(escrow_pubkey, view, fields, version)
+    except db.UnknownField as exception:
+        return {'status': 400, 'error': str(exception)}
     return {'status': 200, 'package': package}
 
 
+@BLUEPRINT.route("/v{}/packages_by_ids".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.PACKAGES_BY_IDS)
+@webserver.validation.call(['escrow_pubkeys'])
+def packages_by_ids_handler(escrow_pubkeys, view=None, fields=None):
+    """
+    Get a full info about several packages, given a comma separated list of escrow pubkeys.
+    Packages are returned in the order of escrow_pubkeys, and unknown ones are reported in place with an error.
+    Use view=summary, or a comma separated list of fields, to get lean packages.
+    ---
+    :param escrow_pubkeys:
+    :param view:
+    :param fields:
+    :return:
+    """
+    escrow_pubkeys = [escrow_pubkey.strip() for escrow_pubkey in escrow_pubkeys.split(',') if escrow_pubkey.strip()]
+    if not escrow_pubkeys:
+        return {'status': 400, 'error': 'at least one escrow pubkey is required'}
+    if len(escrow_pubkeys) > MAX_PACKAGES_BY_IDS:
+        return {'status': 400, 'error': "can not get more than {} packages at once".format(MAX_PACKAGES_BY_IDS)}
+    try:
+        packages = db.get_packages_by_ids(escrow_pubkeys, view, fields)
+    except db.UnknownField as exception:
+        return {'status': 400, 'error': str(exception)}
+    return {'status': 200, 'packages': [
+        {'escrow_pubkey': escrow_pubkey, 'package': package} if package is not None else
+        {'escrow_pubkey': escrow_pubkey, 'error': "paket {} is not valid".format(escrow_pubkey)}
+        for escrow_pubkey, package in zip(escrow_pubkeys, packages)]}
+
+
+def split_escrow_pubkeys(escrow_pubkeys):
+    """Split a comma separated list of escrow pubkeys."""
+    escrow_pubkeys = {escrow_pubkey.strip() for escrow_pubkey in escrow_pubkeys.split(',')} - {''}
+    if not escrow_pubkeys:
+        raise ValueError('at least one escrow pubkey is required')
+    return escrow_pubkeys
+
+
+@BLUEPRINT.route("/v{}/package_updates".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.PACKAGE_UPDATES)
+@webserver.validation.call(['escrow_pubkeys'])
+def package_updates_handler(escrow_pubkeys, cursor=None, timeout=25):
+    """
+    Wait for new events of some packages (long poll).
+    Returns as soon as there are events following cursor, or after timeout seconds with no events.
+    Pass the returned next_cursor as cursor to the next call, so no event is missed.
+    ---
+    :param escrow_pubkeys:
+    :param cursor:
+    :param timeout:
+    :return:
+    """
+    try:
+        events, next_cursor = db.wait_package_updates(
+            split_escrow_pubkeys(escrow_pubkeys), cursor, min(max(float(timeout), 0), PACKAGE_UPDATES_MAX_TIMEOUT))
+    except (db.InvalidCursor, ValueError) as exception:
+        return {'status': 400, 'error': str(exception)}
+    return {'status': 200, 'events': events, 'next_cursor': next_cursor}
+
+
+@BLUEPRINT.route("/v{}/package_updates/stream".format(VERSION), methods=['GET'])
+@flasgger.swag_from(swagger_specs.PACKAGE_UPDATES_STREAM)
+def package_updates_stream_handler():
+    """
+    Stream new events of some packages as Server-Sent Events.
+    The stream starts with a message holding only the cursor of its start as id, and the last event of each batch
+    carries the cursor following it, so reconnecting clients (sending Last-Event-ID) miss nothing.
+    Comments are sent periodically to keep idle connections open.
+    ---
+    :return:
+    """
+    cursor = flask.request.headers.get('Last-Event-ID') or flask.request.args.get('cursor')
+    try:
+        escrow_pubkeys = split_escrow_pubkeys(flask.request.args.get('escrow_pubkeys', ''))
+        if cursor:
+            db.decode_package_update_cursor(cursor)
+    except (db.InvalidCursor, ValueError) as exception:
+        return flask.jsonify({'status': 400, 'error': str(exception)}), 400
+
+    def generate_messages():
+        """Generate the messages of the stream."""
+        yield "retry: 1000\n\n"
+        started = False
+        for events, next_cursor in db.stream_package_updates(
+                escrow_pubkeys, cursor, PACKAGE_UPDATES_HEARTBEAT_INTERVAL, PACKAGE_UPDATES_MAX_STREAM):
+            if not events:
+                yield ": keepalive\n\n" if started else "id: {}\n\n".format(next_cursor)
+            for index, event in enumerate(events):
+                yield "{}event: package_event\ndata: {}\n\n".format(
+                    "id: {}\n".format(next_cursor) if index == len(events) - 1 else '', json.dumps(event))
+            started = True
+
+    return flask.Response(
+        flask.stream_with_context(generate_messages()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@BLUEPRINT.route("/v{}/nearby_packages".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.NEARBY_PACKAGES)
+@webserver.validation.call
+def nearby_packages_handler(
+        latitude=None, longitude=None, radius_km=None, min_latitude=None, max_latitude=None, min_longitude=None,
+        max_longitude=None, max_packages_num=None, view=None, fields=None):
+    """
+    Get packages waiting for pickup near a position, closest first, or within a bounding box.
+    ---
+    :param latitude:
+    :param longitude:
+    :param radius_km:
+    :param min_latitude:
+    :param max_latitude:
+    :param min_longitude:
+    :param max_longitude:
+    :param max_packages_num:
+    :param view:
+    :param fields:
+    :return:
+    """
+    try:
+        return {'status': 200, 'packages': db.get_nearby_packages(
+            latitude, longitude, radius_km, min_latitude, max_latitude, min_longitude, max_longitude,
+            max_packages_num=max_packages_num, view=view, fields=fields)}
+    except (db.InvalidFilter, db.UnknownField) as exception:
+        return {'status': 400, 'error': str(exception)}
+
+
+@BLUEPRINT.route("/v{}/suggest_packages".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.SUGGEST_PACKAGES)
+@webserver.validation.call(require_auth=True)
+def suggest_packages_handler(user_pubkey, latitude=None, longitude=None, max_packages_num=10):
+    """
+    Suggest packages waiting for pickup to a courier, best first.
+    Packages are scored by distance from the courier, payment, collateral and deadline. The position of the courier
+    defaults to the location of their last event.
+    ---
+    :param user_pubkey:
+    :param latitude:
+    :param longitude:
+    :param max_packages_num:
+    :return:
+    """
+    try:
+        return {'status': 200, 'packages': MATCHING_ENGINE.suggest_for_courier(
+            user_pubkey, latitude, longitude, max_packages_num)}
+    except (matching.UnknownCourier, ValueError) as exception:
+        return {'status': 400, 'error': str(exception)}
+
+
 @BLUEPRINT.route("/v{}/add_event".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.ADD_EVENT)
 @webserver.validation.call(['escrow_pubkey', 'event_type', 'location'], require_auth=True)
@@ -225,6 +666,38 @@ def changed_location_handler(user_pubkey, escrow_pubkey, location):
     return {'status': 200}
 
 
+# Batch routes.
+
+
+@BLUEPRINT.route("/v{}/batch".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.BATCH)
+@webserver.validation.call(['requests'])
+def batch_handler(requests):
+    """
+    Run several API calls in a single round trip.
+    requests is a JSON list of objects with the path of a call (like "/v3/package"), and optionally its data and
+    its headers (with the Pubkey, Fingerprint and Signature of authenticated calls, fingerprinting the call's own
+    URL and data). The calls run in parallel, and their responses are returned in order, each with its status.
+    ---
+    :param requests:
+    :return:
+    """
+    try:
+        subrequests = batches.parse_batch(requests, BATCH_MAX_REQUESTS)
+    except ValueError as exception:
+        return {'status': 400, 'error': str(exception)}
+    # pylint: disable=protected-access
+    # The pool threads have no app context, so they get the app itself.
+    app = flask.current_app._get_current_object()
+    # pylint: enable=protected-access
+    futures = [
+        BATCH_POOL.submit(
+            batches.dispatch_subrequest, app, flask.request.url_root, subrequest, BLUEPRINT.name,
+            BATCH_EXCLUDED_ENDPOINTS)
+        for subrequest in subrequests]
+    return {'status': 200, 'responses': [future.result() for future in futures]}
+
+
 # Debug routes.
 
 
@@ -237,7 +710,9 @@ def fund_handler(funded_pubkey, funded_buls=1000000000):
     ---
     :return:
     """
-    return {'status': 200, 'response': paket_stellar.fund_from_issuer(funded_pubkey, funded_buls)}
+    response = paket_stellar.fund_from_issuer(funded_pubkey, funded_buls)
+    invalidate_accounts([funded_pubkey])
+    return {'status': 200, 'response': response}
 
 
 @BLUEPRINT.route("/v{}/debug/create_mock_package".format(VERSION), methods=['POST'])
@@ -260,28 +735,93 @@ def create_mock_package_handler(
 @BLUEPRINT.route("/v{}/debug/packages".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.PACKAGES)
 @webserver.validation.call
-def packages_handler():
+def packages_handler(status=None, custodian_pubkey=None, view=None, fields=None):
     """
     Get list of packages - for debug only.
+    Optionally filter by package status and/or current custodian.
+    Use view=summary, or a comma separated list of fields, to get lean packages.
     ---
+    :param status:
+    :param custodian_pubkey:
+    :param view:
+    :param fields:
     :return:
     """
-    return {'status': 200, 'packages': db.get_packages()}
+    try:
+        if status is None and custodian_pubkey is None:
+            return {'status': 200, 'packages': db.get_packages(view=view, fields=fields)}
+        return {'status': 200, 'packages': db.get_packages_by_state(status, custodian_pubkey, view, fields)}
+    except db.UnknownField as exception:
+        return {'status': 400, 'error': str(exception)}
+
+
+@BLUEPRINT.route("/v{}/stats".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.STATS)
+@webserver.validation.call
+def stats_handler(since_timestamp=None, until_timestamp=None, event_type=None, region=None):
+    """
+    Get daily statistics: the number of events and of distinct users per day and event type.
+    ---
+    :param since_timestamp:
+    :param until_timestamp:
+    :param event_type:
+    :param region:
+    :return:
+    """
+    try:
+        return {'status': 200, 'stats': db.get_stats(since_timestamp, until_timestamp, event_type, region)}
+    except db.InvalidFilter as exception:
+        return {'status': 400, 'error': str(exception)}
+
+
+@BLUEPRINT.route("/v{}/debug/db_stats".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.DB_STATS)
+@webserver.validation.call
+def db_stats_handler():
+    """
+    Get connection pool, event buffer, caches, replica, package updates and submission statistics - for
+    debug only.
+    ---
+    :return:
+    """
+    return {
+        'status': 200, 'pool': db.get_pool_stats(), 'event_buffer': db.get_event_buffer_stats(),
+        'package_cache': db.get_package_cache_stats(),
+        'replicas': db.get_replica_stats(), 'package_updates': db.get_updates_stats(),
+        'account_cache': ACCOUNT_CACHE.stats() if ACCOUNT_CACHE else {},
+        'submissions': SUBMISSION_QUEUE.stats(), 'sequences': SEQUENCES.stats() if SEQUENCES else {}}
 
 
 @BLUEPRINT.route("/v{}/events".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.EVENTS)
 @webserver.validation.call
-def events_handler(max_events_num=100, mock=None):
+def events_handler(
+        max_events_num=100, mock=None, cursor=None, event_type=None, user_pubkey=None, escrow_pubkey=None,
+        since_timestamp=None, until_timestamp=None, scope=None):
     """
-    Get all events.
+    Get all events, or the events matching some filters.
+    Events are ordered by time. Pass the returned next_cursor as cursor to get the next page.
     ---
     :param max_events_num:
     :param mock:
+    :param cursor:
+    :param event_type:
+    :param user_pubkey:
+    :param escrow_pubkey:
+    :param since_timestamp:
+    :param until_timestamp:
+    :param scope:
     :return:
     """
+    next_cursor = None
     if not bool(mock):
-        events = db.get_events(max_events_num)
+        try:
+            events = db.get_events(
+                max_events_num, cursor, event_type, user_pubkey, escrow_pubkey, since_timestamp, until_timestamp,
+                scope)
+        except (db.InvalidCursor, db.InvalidFilter) as exception:
+            return {'status': 400, 'error': str(exception)}
+        next_cursor = events.pop('next_cursor')
     # Mock data. Temporary.
     else:
         events = {
@@ -360,19 +900,65 @@ def events_handler(max_events_num=100, mock=None):
                 'escrow_pubkey': None,
                 'user_pubkey': 'GAL54ATIHYBWMKYUNQSM3QAGZGCUBJGF6KEFFSQTEV7JOOA72UEJP4UL',
                 'event_type': 'funded account', 'location': '51.0465554,-114.0752757'}]}
-    return {'status': 200, 'events': events}
+    return {'status': 200, 'events': events, 'next_cursor': next_cursor}
+
+
+def parse_lines_num(lines_num):
+    """Parse the number of log lines to get, raising ValueError unless it is a positive integer."""
+    try:
+        lines_num = int(lines_num)
+    except (ValueError, TypeError):
+        raise ValueError("invalid lines_num {}, must be a positive integer".format(lines_num))
+    if lines_num < 1:
+        raise ValueError("invalid lines_num {}, must be a positive integer".format(lines_num))
+    return lines_num
+
+
+def tail_log(lines_num, level=None, logger_name=None, substring=None):
+    """Get a generator of the last lines of the debug log, newest first, matching some filters (see logs.tail)."""
+    return logs.tail(
+        os.path.join(util.logger.LOG_DIR_NAME, util.logger.LOG_FILE_NAME), lines_num, level, logger_name,
+        substring, max_bytes=LOG_MAX_SCAN_BYTES)
 
 
 @BLUEPRINT.route("/v{}/debug/log".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.LOG)
 @webserver.validation.call
-def view_log_handler(lines_num=10):
+def view_log_handler(lines_num=10, level=None, logger_name=None, substring=None):
     """
-    Get last lines of log - for debug only.
-    Specify lines_num to get the x last lines.
+    Get last lines of log, newest first - for debug only.
+    Specify lines_num to get the x last lines, and level (the lowest one), logger_name (like pkt.db) or substring to
+    only get matching records (lines without a level, like tracebacks, go with the record above them).
+    The log is read backward from its end, only as far as needed. Use debug/log.txt to stream more lines as text.
     ---
     :param lines_num:
+    :param level:
+    :param logger_name:
+    :param substring:
     :return:
     """
-    with open(os.path.join(util.logger.LOG_DIR_NAME, util.logger.LOG_FILE_NAME)) as logfile:
-        return {'status': 200, 'log': logfile.readlines()[:-1 - lines_num:-1]}
+    try:
+        lines_num = parse_lines_num(lines_num)
+        if lines_num > LOG_MAX_LINES:
+            return {'status': 400, 'error': "can not get more than {} lines as json".format(LOG_MAX_LINES)}
+        return {'status': 200, 'log': list(tail_log(lines_num, level, logger_name, substring))}
+    except ValueError as exception:
+        return {'status': 400, 'error': str(exception)}
+
+
+@BLUEPRINT.route("/v{}/debug/log.txt".format(VERSION), methods=['GET'])
+@flasgger.swag_from(swagger_specs.LOG_TEXT)
+def view_log_text_handler():
+    """
+    Stream last lines of log as plain text, newest first - for debug only.
+    Takes the query params of debug/log, without a limit on lines_num.
+    ---
+    :return:
+    """
+    try:
+        lines = tail_log(
+            parse_lines_num(flask.request.args.get('lines_num', 10)), flask.request.args.get('level'),
+            flask.request.args.get('logger_name'), flask.request.args.get('substring'))
+    except ValueError as exception:
+        return flask.jsonify({'status': 400, 'error': str(exception)}), 400
+    return flask.Response(flask.stream_with_context(lines), mimetype='text/plain')
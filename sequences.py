@@ -0,0 +1,171 @@
+"""Local cache of the sequence numbers of Stellar accounts, for preparing transactions without asking Horizon."""
+import base64
+import binascii
+import collections
+import contextlib
+import logging
+import struct
+import threading
+import time
+
+LOGGER = logging.getLogger('pkt.api')
+# Version byte of account IDs (G...) in strkey encoding.
+ACCOUNT_ID_VERSION_BYTE = 6 << 3
+# A transaction envelope starts with the transaction's source account (a 4 bytes key type and a 32 bytes ed25519
+# key), its fee (4 bytes), and its sequence number (8 bytes).
+ENVELOPE_HEADER = struct.Struct('>i32sIq')
+
+
+def crc16_xmodem(data):
+    """Compute the CRC16-XModem checksum used by strkey encoding."""
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+    return crc & 0xffff
+
+
+def encode_account_id(ed25519_key):
+    """Encode an ed25519 public key as an account ID (G...)."""
+    payload = bytes([ACCOUNT_ID_VERSION_BYTE]) + ed25519_key
+    return base64.b32encode(payload + struct.pack('<H', crc16_xmodem(payload))).decode()
+
+
+def envelope_source_and_sequence(transaction):
+    """Get the source account and the sequence number of a transaction envelope (base64 XDR), or None."""
+    try:
+        key_type, ed25519_key, _, sequence = ENVELOPE_HEADER.unpack_from(base64.b64decode(transaction))
+    except (binascii.Error, struct.error, TypeError, ValueError):
+        return None
+    if key_type != 0:
+        return None
+    return encode_account_id(ed25519_key), sequence
+
+
+class SequenceManager:
+    """
+    Caches the sequence number of accounts: fetched from Horizon once, and then advanced by every transaction
+    prepared here, so consecutive transactions prepared for an account get consecutive sequence numbers.
+    Entries expire ttl seconds after they were last fetched or advanced (dropping the sequence numbers of prepared
+    transactions that were never submitted), and are dropped when Horizon rejects a transaction with tx_bad_seq.
+    """
+
+    def __init__(self, ttl=30, lock_timeout=10):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.lock = threading.Lock()
+        self.sequences = {}
+        # Each account is held by a single serving() block at a time, from its first lookup to the end of the block.
+        self.account_locks = collections.defaultdict(threading.Lock)
+        self.counters = dict(hits=0, misses=0, advances=0, resyncs=0, lock_timeouts=0)
+        # The sequence numbers looked up and the accounts held by the serving() block of each thread.
+        self.scopes = threading.local()
+
+    def cached(self, pubkey):
+        """Get the cached sequence number of an account, or None if it is missing or expired (hold the lock)."""
+        sequence, expires_at = self.sequences.get(pubkey, (None, 0))
+        return sequence if expires_at > time.monotonic() else None
+
+    def lookup(self, pubkey, fetch):
+        """
+        Get the last sequence number used by an account, calling fetch to get it from Horizon if it is not cached.
+        Returns None if the account has no sequence number (it is not funded), caching nothing.
+        """
+        with self.lock:
+            sequence = self.cached(pubkey)
+            if sequence is not None:
+                self.counters['hits'] += 1
+                return sequence
+            self.counters['misses'] += 1
+        sequence = fetch()
+        if sequence is None:
+            return None
+        sequence = int(sequence)
+        with self.lock:
+            # Transactions may have been prepared while fetching.
+            cached_sequence = self.cached(pubkey)
+            if cached_sequence is not None and cached_sequence > sequence:
+                sequence = cached_sequence
+            self.sequences[pubkey] = sequence, time.monotonic() + self.ttl
+        return sequence
+
+    def advance(self, pubkey, sequence):
+        """Record that a transaction with a sequence number was prepared for an account."""
+        with self.lock:
+            cached_sequence = self.cached(pubkey)
+            if cached_sequence is not None and cached_sequence >= sequence:
+                return
+            self.sequences[pubkey] = sequence, time.monotonic() + self.ttl
+            self.counters['advances'] += 1
+
+    def advance_envelopes(self, *transactions):
+        """Record the sequence numbers of prepared transaction envelopes (base64 XDR), skipping unparsable ones."""
+        for transaction in transactions:
+            source_and_sequence = envelope_source_and_sequence(transaction) if transaction else None
+            if source_and_sequence:
+                self.advance(*source_and_sequence)
+
+    def resync(self, pubkey):
+        """Drop the sequence number of an account, to get it from Horizon next time."""
+        with self.lock:
+            self.sequences.pop(pubkey, None)
+            self.counters['resyncs'] += 1
+        LOGGER.info("resyncing sequence number of %s", pubkey)
+
+    def hold(self, pubkey):
+        """Hold an account until the end of the current serving() block. Returns False if it stayed held elsewhere."""
+        with self.lock:
+            account_lock = self.account_locks[pubkey]
+        if not account_lock.acquire(timeout=self.lock_timeout):
+            with self.lock:
+                self.counters['lock_timeouts'] += 1
+            LOGGER.warning("sequence number of %s held for over %s seconds - using horizon", pubkey, self.lock_timeout)
+            return False
+        self.scopes.held.append(account_lock)
+        return True
+
+    def hook(self, builder_class):
+        """
+        Make the sequence number lookups of a transaction builder class (get_sequence) use the cache, within serving()
+        blocks only - elsewhere, and in other threads, they still go to Horizon.
+        """
+        fetch_sequence = builder_class.get_sequence
+
+        def get_sequence(builder):
+            """Get the sequence number of the builder's account, from the cache in serving() blocks."""
+            looked_up = getattr(self.scopes, 'looked_up', None)
+            if looked_up is None:
+                return fetch_sequence(builder)
+            # All the transactions a block builds for an account start from the same sequence number, as builders
+            # offset it, so the account is held until the block has advanced the cache past all of them.
+            if builder.address not in looked_up:
+                looked_up[builder.address] = self.lookup(
+                    builder.address, lambda: fetch_sequence(builder)) if self.hold(builder.address) else None
+            if looked_up[builder.address] is None:
+                return fetch_sequence(builder)
+            return looked_up[builder.address]
+
+        builder_class.get_sequence = get_sequence
+
+    @contextlib.contextmanager
+    def serving(self):
+        """
+        Serve the sequence numbers looked up by hooked builders in this thread from the cache, for a block. The block
+        holds the accounts it looks up, so it must advance the cache past the transactions it prepares before it ends.
+        """
+        self.scopes.looked_up, self.scopes.held = {}, []
+        try:
+            yield
+        finally:
+            for account_lock in self.scopes.held:
+                account_lock.release()
+            self.scopes.looked_up, self.scopes.held = None, None
+
+    def stats(self):
+        """Get cache statistics."""
+        with self.lock:
+            stats = dict(self.counters, size=len(self.sequences))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0
+        return stats
@@ -0,0 +1,116 @@
+"""Embedded SQLite database engine, exposing the SQL connection interface used with MySQL."""
+import contextlib
+import datetime
+import logging
+import sqlite3
+import threading
+
+LOGGER = logging.getLogger('pkt.db')
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def convert_timestamp(value):
+    """Convert a stored timestamp back to a datetime."""
+    return datetime.datetime.fromisoformat(value.decode())
+
+
+def convert_date(value):
+    """Convert a stored date back to a date."""
+    return datetime.date.fromisoformat(value.decode())
+
+
+def adapt(param):
+    """Convert a query param to its stored form."""
+    if isinstance(param, datetime.datetime):
+        return param.strftime(TIMESTAMP_FORMAT)
+    if isinstance(param, datetime.date):
+        return param.isoformat()
+    return param
+
+
+# Timestamps and dates are stored as fixed width text, so they compare and sort like the values they represent.
+sqlite3.register_converter('TIMESTAMP', convert_timestamp)
+sqlite3.register_converter('DATE', convert_date)
+
+
+def dict_factory(cursor, row):
+    """Build rows as dicts keyed by column name, like MySQL dictionary cursors."""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor:
+    """
+    A cursor accepting MySQL style queries.
+    The %s placeholders are translated to SQLite ones, and datetime and date params to their stored forms.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=()):
+        """Execute a query."""
+        return self.cursor.execute(
+            query.replace('%s', '?').replace('%%', '%'), tuple(adapt(param) for param in params))
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SQLiteDatabase:
+    """
+    An SQLite database file, opened in WAL mode so reads are never blocked by a writer.
+    Each thread gets its own connection, which is kept open for the life of the thread.
+    """
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connect(self):
+        """Get the connection of the current thread, opening it if needed."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+            connection.row_factory = dict_factory
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA foreign_keys=ON')
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+            LOGGER.debug("opened sqlite connection to %s", self.path)
+        return connection
+
+    @contextlib.contextmanager
+    def sql_connection(self):
+        """
+        Context manager yielding a dictionary cursor on the connection of the current thread.
+        The transaction is committed on success and rolled back on error, as with util.db.custom_sql_connection.
+        """
+        connection = self.connect()
+        cursor = connection.cursor()
+        try:
+            yield SQLiteCursor(cursor)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def close(self):
+        """Close all connections."""
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
+
+    def stats(self):
+        """Get connection statistics."""
+        with self.lock:
+            return {'engine': 'sqlite', 'path': self.path, 'connections': len(self.connections)}
@@ -0,0 +1,236 @@
+"""Durable queue of transactions submitted asynchronously to Horizon."""
+import datetime
+import json
+import logging
+import threading
+import uuid
+
+import db_rows
+
+LOGGER = logging.getLogger('pkt.api')
+QUEUED, SUBMITTING, SUCCEEDED, FAILED = 'queued', 'submitting', 'succeeded', 'failed'
+STATUS_COLUMNS = ('submission_id', 'status', 'attempts', 'created_at', 'updated_at', 'response', 'error')
+
+
+class UnknownSubmission(Exception):
+    """Unknown submission ID."""
+
+
+def is_transient(response):
+    """Check if a Horizon response reports a failure worth retrying (like a timeout while a ledger closes)."""
+    return isinstance(response, dict) and isinstance(response.get('status'), int) and response['status'] >= 500
+
+
+def is_rejected(response):
+    """Check if a Horizon response reports a transaction that will never succeed as is."""
+    return isinstance(response, dict) and isinstance(response.get('status'), int) and 400 <= response['status'] < 500
+
+
+def is_bad_sequence(response):
+    """Check if a Horizon response (or error) reports a transaction rejected with tx_bad_seq."""
+    return 'tx_bad_seq' in str(response)
+
+
+def submit_envelope(transaction, submit, lookup, resync=None):
+    """
+    Submit a signed transaction envelope with submit, and get the Horizon response.
+    A transaction rejected with tx_bad_seq may be a resubmission of an applied one (after a timeout), in which case
+    its record (from lookup, which returns None for unknown transactions) is returned instead. Otherwise resync is
+    called with the envelope, to drop the cached sequence number of its source, and the rejection goes through.
+    """
+    try:
+        response = submit(transaction)
+    # pylint: disable=broad-except
+    # Horizon rejections are raised as all kinds of exceptions - only tx_bad_seq ones are handled here.
+    except Exception as exception:
+        if not is_bad_sequence(exception):
+            raise
+        record = lookup(transaction)
+        if record is None:
+            if resync:
+                resync(transaction)
+            raise
+        return record
+    # pylint: enable=broad-except
+    if is_bad_sequence(response):
+        record = lookup(transaction)
+        if record is not None:
+            return record
+        if resync:
+            resync(transaction)
+    return response
+
+
+# pylint: disable=too-many-instance-attributes
+# The retry settings sit next to the state the submitter threads share.
+class SubmissionQueue:
+    """
+    A queue of signed transaction envelopes, stored in the transaction_submissions table and submitted by
+    background submitter threads, so that API workers do not wait for Horizon.
+    Any worker can claim a due submission. A claim is a lease: if the claiming worker dies, the submission is due
+    again lease seconds later (submitting an envelope twice is safe, the ledger applies it once).
+    Failures are retried with exponential backoff, up to max_attempts attempts.
+    As a failed attempt (like a timeout) may still have been applied, retries first call lookup (if set) with the
+    envelope, which returns Horizon's record of the transaction if the ledger has it (None otherwise), and only
+    submit it again if it has not been applied.
+    """
+
+    def __init__(
+            self, sql_connection, submit, submitters_num=2, max_attempts=5, backoff=1, max_backoff=60,
+            poll_interval=1, lease=60, lookup=None):
+        self.sql_connection = sql_connection
+        self.submit = submit
+        self.lookup = lookup
+        self.submitters_num = submitters_num
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.submitters = []
+        self.stopping = False
+        self.counters = dict(queued=0, attempts=0, retries=0, found=0, succeeded=0, failed=0)
+
+    def count(self, counter):
+        """Increment a counter."""
+        with self.lock:
+            self.counters[counter] += 1
+
+    def start(self):
+        """Start the submitter threads, if they are not already running."""
+        with self.lock:
+            if self.stopping:
+                return
+            self.submitters = [submitter for submitter in self.submitters if submitter.is_alive()]
+            while len(self.submitters) < self.submitters_num:
+                submitter = threading.Thread(
+                    target=self.run, name="transaction-submitter-{}".format(len(self.submitters)), daemon=True)
+                submitter.start()
+                self.submitters.append(submitter)
+
+    def stop(self):
+        """Stop the submitter threads once they are done with their current submissions."""
+        with self.lock:
+            self.stopping = True
+            submitters = list(self.submitters)
+        self.wakeup.set()
+        for submitter in submitters:
+            submitter.join()
+
+    def enqueue(self, transaction):
+        """Queue a signed transaction envelope for submission, and return its submission ID."""
+        submission_id = uuid.uuid4().hex
+        now = datetime.datetime.now()
+        with self.sql_connection() as sql:
+            sql.execute("""
+                INSERT INTO transaction_submissions (
+                    submission_id, transaction_envelope, status, attempts, next_attempt_at, created_at, updated_at)
+                VALUES (%s, %s, %s, 0, %s, %s, %s)""", (submission_id, transaction, QUEUED, now, now, now))
+        self.count('queued')
+        # Submitters are started on startup, this only restarts those that died.
+        self.start()
+        self.wakeup.set()
+        return submission_id
+
+    def get_status(self, submission_id):
+        """Get the status of a submission, with the Horizon response once it is submitted."""
+        with self.sql_connection() as sql:
+            sql.execute("SELECT {} FROM transaction_submissions WHERE submission_id = %s".format(
+                ', '.join(STATUS_COLUMNS)), (submission_id,))
+            submission = sql.fetchone()
+        if submission is None:
+            raise UnknownSubmission("submission {} is not valid".format(submission_id))
+        submission = db_rows.decode_keys(submission)
+        if submission['response'] is not None:
+            submission['response'] = json.loads(submission['response'])
+        return submission
+
+    def claim(self):
+        """Claim the submission that has been due for the longest time, if any. Returns it, or None."""
+        now = datetime.datetime.now()
+        with self.sql_connection() as sql:
+            sql.execute("""
+                SELECT submission_id, transaction_envelope, attempts FROM transaction_submissions
+                WHERE status IN (%s, %s) AND next_attempt_at <= %s
+                ORDER BY next_attempt_at ASC LIMIT %s""", (QUEUED, SUBMITTING, now, self.submitters_num + 1))
+            candidates = db_rows.decode_rows(sql.fetchall())
+            for submission in candidates:
+                # The attempts counter doubles as a version, so only one worker wins each claim.
+                sql.execute("""
+                    UPDATE transaction_submissions
+                    SET status = %s, attempts = attempts + 1, next_attempt_at = %s, updated_at = %s
+                    WHERE submission_id = %s AND attempts = %s""", (
+                        SUBMITTING, now + datetime.timedelta(seconds=self.lease), now,
+                        submission['submission_id'], submission['attempts']))
+                if sql.rowcount == 1:
+                    return dict(submission, attempts=submission['attempts'] + 1)
+        return None
+
+    def finish(self, submission, status, response=None, error=None, next_attempt_at=None):
+        """Record the outcome of an attempt, unless the submission was claimed again in the meantime."""
+        now = datetime.datetime.now()
+        with self.sql_connection() as sql:
+            sql.execute("""
+                UPDATE transaction_submissions
+                SET status = %s, response = %s, error = %s, next_attempt_at = %s, updated_at = %s
+                WHERE submission_id = %s AND attempts = %s""", (
+                    status, None if response is None else json.dumps(response, default=str), error,
+                    next_attempt_at or now, now, submission['submission_id'], submission['attempts']))
+
+    def process(self, submission):
+        """Submit a claimed submission, and record the outcome."""
+        self.count('attempts')
+        try:
+            response = None
+            if self.lookup and submission['attempts'] > 1:
+                response = self.lookup(submission['transaction_envelope'])
+                if response is not None:
+                    self.count('found')
+            if response is None:
+                response = self.submit(submission['transaction_envelope'])
+            error = None
+        # pylint: disable=broad-except
+        # Whatever fails a submission (network errors, Horizon errors) is recorded, and retried.
+        except Exception as exception:
+            response, error = None, str(exception) or type(exception).__name__
+        # pylint: enable=broad-except
+        if error is None and not is_transient(response):
+            status = FAILED if is_rejected(response) else SUCCEEDED
+            self.count(status)
+            self.finish(submission, status, response)
+            return
+        if submission['attempts'] >= self.max_attempts:
+            LOGGER.warning("giving up on submission %s: %s", submission['submission_id'], error or response)
+            self.count('failed')
+            self.finish(submission, FAILED, response, error)
+            return
+        delay = min(self.backoff * 2 ** (submission['attempts'] - 1), self.max_backoff)
+        LOGGER.info("retrying submission %s in %s seconds: %s", submission['submission_id'], delay, error or response)
+        self.count('retries')
+        self.finish(
+            submission, QUEUED, response, error, datetime.datetime.now() + datetime.timedelta(seconds=delay))
+
+    def run(self):
+        """Submitter loop: claim a due submission and process it, or wait for one."""
+        while not self.stopping:
+            try:
+                submission = self.claim()
+                if submission is not None:
+                    self.process(submission)
+                    continue
+            # pylint: disable=broad-except
+            # The submitters must survive database errors, the submissions will be claimed again.
+            except Exception:
+                LOGGER.exception('transaction submitter failed')
+            # pylint: enable=broad-except
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+
+    def stats(self):
+        """Get submission statistics."""
+        with self.lock:
+            return dict(self.counters, submitters=len([
+                submitter for submitter in self.submitters if submitter.is_alive()]))
+# pylint: enable=too-many-instance-attributes
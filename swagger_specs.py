@@ -169,10 +169,27 @@ SUBMIT_TRANSACTION = {
         {
             'name': 'transaction', 'description': 'transaction to submit',
             'in': 'formData', 'required': True, 'type': 'string'
-        }
+        },
+        {
+            'name': 'mode', 'description': 'sync (default) to wait for horizon, or async to queue the transaction',
+            'in': 'formData', 'required': False, 'type': 'string'},
     ],
     'responses': {
-        '200': {'description': 'horizon response'}
+        '200': {'description': 'horizon response'},
+        '202': {'description': 'submission_id of the queued transaction, to poll transaction_status with'}
+    }
+}
+
+TRANSACTION_STATUS = {
+    'tags': ['wallet'],
+    'parameters': [
+        {
+            'name': 'submission_id', 'description': 'submission_id returned by submit_transaction in async mode',
+            'in': 'formData', 'required': True, 'type': 'string'},
+    ],
+    'responses': {
+        '200': {'description': 'status, attempts, and horizon response (once submitted) or error of the submission'},
+        '404': {'description': 'unknown submission'}
     }
 }
 
@@ -313,6 +330,21 @@ MY_PACKAGES = {
         {'name': 'Pubkey', 'in': 'header', 'required': True, 'type': 'string'},
         {'name': 'Fingerprint', 'in': 'header', 'required': True, 'type': 'string'},
         {'name': 'Signature', 'in': 'header', 'required': True, 'type': 'string'},
+        {
+            'name': 'max_packages_num', 'description': 'page size (default is all packages)',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'cursor', 'description': 'next_cursor returned with the previous page',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'view', 'description': 'full (default) or summary - without events and transactions',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'fields', 'description': 'comma separated list of package fields to return (overrides view)',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'If-None-Match', 'description': 'ETag of a previous response, to get a 304 if it is unchanged',
+            'in': 'header', 'required': False, 'type': 'string'},
     ],
     'responses': {
         '200': {
@@ -327,7 +359,8 @@ MY_PACKAGES = {
                     }
                 }
             }
-        }
+        },
+        '304': {'description': 'the packages are unchanged since the response with the If-None-Match ETag'}
     }
 }
 
@@ -337,7 +370,16 @@ PACKAGE = {
         {
             'name': 'escrow_pubkey', 'description': 'escrow pubkey (the package ID)',
             'in': 'formData', 'required': True, 'type': 'string',
-        }
+        },
+        {
+            'name': 'view', 'description': 'full (default) or summary - without events and transactions',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'fields', 'description': 'comma separated list of package fields to return (overrides view)',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'If-None-Match', 'description': 'ETag of a previous response, to get a 304 if it is unchanged',
+            'in': 'header', 'required': False, 'type': 'string'},
     ],
     'definitions': {
         'Event': {
@@ -402,7 +444,122 @@ PACKAGE = {
             'schema': {
                 '$ref': '#/definitions/Package-info'
             }
-        }
+        },
+        '304': {'description': 'the package is unchanged since the response with the If-None-Match ETag'}
+    }
+}
+
+PACKAGES_BY_IDS = {
+    'tags': ['packages'],
+    'parameters': [
+        {
+            'name': 'escrow_pubkeys', 'description': 'comma separated list of escrow pubkeys of the packages to get',
+            'in': 'formData', 'required': True, 'type': 'string'},
+        {
+            'name': 'view', 'description': 'full (default) or summary - without events and transactions',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'fields', 'description': 'comma separated list of package fields to return (overrides view)',
+            'in': 'formData', 'required': False, 'type': 'string'},
+    ],
+    'responses': {
+        '200': {'description': 'the packages, in the order of escrow_pubkeys - unknown ones with an error instead'},
+        '400': {'description': 'no escrow pubkeys, too many of them, or unknown field or view'}
+    }
+}
+
+PACKAGE_UPDATES = {
+    'tags': ['packages'],
+    'parameters': [
+        {
+            'name': 'escrow_pubkeys', 'description': 'comma separated list of escrow pubkeys of packages to follow',
+            'in': 'formData', 'required': True, 'type': 'string'},
+        {
+            'name': 'cursor', 'description': 'next_cursor returned by the previous call',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'timeout', 'description': 'seconds to wait for new events (default 25, at most 60)',
+            'in': 'formData', 'required': False, 'type': 'number'},
+    ],
+    'responses': {
+        '200': {'description': 'new events of the packages (possibly none), and the cursor of the next call'}
+    }
+}
+
+PACKAGE_UPDATES_STREAM = {
+    'tags': ['packages'],
+    'produces': ['text/event-stream'],
+    'parameters': [
+        {
+            'name': 'escrow_pubkeys', 'description': 'comma separated list of escrow pubkeys of packages to follow',
+            'in': 'query', 'required': True, 'type': 'string'},
+        {
+            'name': 'cursor', 'description': 'last event id received (overridden by Last-Event-ID)',
+            'in': 'query', 'required': False, 'type': 'string'},
+        {'name': 'Last-Event-ID', 'in': 'header', 'required': False, 'type': 'string'},
+    ],
+    'responses': {
+        '200': {'description': 'a stream of package_event Server-Sent Events'}
+    }
+}
+
+NEARBY_PACKAGES = {
+    'tags': ['packages'],
+    'parameters': [
+        {
+            'name': 'latitude', 'description': 'latitude of the position to search around',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'longitude', 'description': 'longitude of the position to search around',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'radius_km', 'description': 'search radius in kilometers (default 10)',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'min_latitude', 'description': 'southern edge of a bounding box to search in',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'max_latitude', 'description': 'northern edge of a bounding box to search in',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'min_longitude', 'description': 'western edge of a bounding box to search in',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'max_longitude', 'description': 'eastern edge of a bounding box to search in',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'max_packages_num', 'description': 'limit of returned packages',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'view', 'description': 'full (default) or summary - without events and transactions',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'fields', 'description': 'comma separated list of package fields to return (overrides view)',
+            'in': 'formData', 'required': False, 'type': 'string'},
+    ],
+    'responses': {
+        '200': {'description': 'a list of packages, with their distance_km if a position was given'}
+    }
+}
+
+SUGGEST_PACKAGES = {
+    'tags': ['packages'],
+    'parameters': [
+        {'name': 'Pubkey', 'in': 'header', 'required': True, 'type': 'string'},
+        {'name': 'Fingerprint', 'in': 'header', 'required': True, 'type': 'string'},
+        {'name': 'Signature', 'in': 'header', 'required': True, 'type': 'string'},
+        {
+            'name': 'latitude', 'description': 'latitude of the courier (defaults to the last known one)',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'longitude', 'description': 'longitude of the courier (defaults to the last known one)',
+            'in': 'formData', 'required': False, 'type': 'number'},
+        {
+            'name': 'max_packages_num', 'description': 'limit of suggested packages (default 10)',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+    ],
+    'responses': {
+        '200': {'description': 'a list of suggested packages, with their distance_km and score'}
     }
 }
 
@@ -453,7 +610,28 @@ EVENTS = {
             'in': 'formData', 'required': False, 'type': 'integer'},
         {
             'name': 'mock', 'description': 'allow mock data in case of empty db',
-            'in': 'formData', 'required': False, 'type': 'integer'}
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'cursor', 'description': 'next_cursor returned with the previous page',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'event_type', 'description': 'only get events of this type',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'user_pubkey', 'description': 'only get events of this user',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'escrow_pubkey', 'description': 'only get events of this package',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'since_timestamp', 'description': 'only get events from this time on (unix timestamp)',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'until_timestamp', 'description': 'only get events before this time (unix timestamp)',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'scope', 'description': 'only get package events (package) or user events (user)',
+            'in': 'formData', 'required': False, 'type': 'string'}
     ],
     'responses': {
         '200': {'description': 'a list of events'}
@@ -508,11 +686,72 @@ CREATE_MOCK_PACKAGE = {
 
 PACKAGES = {
     'tags': ['debug'],
+    'parameters': [
+        {
+            'name': 'status', 'description': 'only packages with this status (e.g. "waiting pickup")',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'custodian_pubkey', 'description': 'only packages currently held by this user',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'view', 'description': 'full (default) or summary - without events and transactions',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'fields', 'description': 'comma separated list of package fields to return (overrides view)',
+            'in': 'formData', 'required': False, 'type': 'string'},
+    ],
     'responses': {
         '200': {'description': 'a list of packages'}
     }
 }
 
+STATS = {
+    'tags': ['packages'],
+    'parameters': [
+        {
+            'name': 'since_timestamp', 'description': 'first day to get (unix timestamp, default is 30 days ago)',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'until_timestamp', 'description': 'last day to get (unix timestamp, default is today)',
+            'in': 'formData', 'required': False, 'type': 'integer'},
+        {
+            'name': 'event_type', 'description': 'only get statistics of this event type',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'region',
+            'description': 'only count located events in this region - the "latitude,longitude" of the south west '
+                           'corner of a one degree cell (e.g. "51,-1")',
+            'in': 'formData', 'required': False, 'type': 'string'},
+    ],
+    'responses': {
+        '200': {'description': 'number of events and of distinct users per day and event type'}
+    }
+}
+
+BATCH = {
+    'tags': ['batch'],
+    'parameters': [
+        {
+            'name': 'requests',
+            'description': 'JSON list of calls, each an object with the path of the call (like "/v3/package"), and '
+                           'optionally its "data" and "headers" objects (authenticated calls carry their own Pubkey, '
+                           'Fingerprint and Signature headers, fingerprinting their own URL and data)',
+            'in': 'formData', 'required': True, 'type': 'string'},
+    ],
+    'responses': {
+        '200': {'description': 'the responses of the calls, in order, each with its status, body, and ETag if any'},
+        '400': {'description': 'invalid list of calls'}
+    }
+}
+
+DB_STATS = {
+    'tags': ['debug'],
+    'responses': {
+        '200': {'description': 'connection pool, event buffer, caches, replicas, package updates, '
+                               'submissions and sequences stats'}
+    }
+}
+
 LOG = {
     'tags': [
         'debug'
@@ -527,10 +766,43 @@ LOG = {
                 'format': 'integer'
             }
         },
+        {
+            'name': 'level', 'description': 'lowest level of the records to return (like WARNING)',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'logger_name', 'description': 'only return records of this logger and its children (like pkt.db)',
+            'in': 'formData', 'required': False, 'type': 'string'},
+        {
+            'name': 'substring', 'description': 'only return records containing this string',
+            'in': 'formData', 'required': False, 'type': 'string'},
     ],
     'responses': {
         '200': {
-            'description': 'log lines',
-        }
+            'description': 'log lines, newest first',
+        },
+        '400': {'description': 'invalid filter, or too many lines'}
+    }
+}
+
+LOG_TEXT = {
+    'tags': [
+        'debug'
+    ],
+    'produces': ['text/plain'],
+    'parameters': [
+        {'name': 'lines_num', 'in': 'query', 'required': False, 'type': 'integer'},
+        {
+            'name': 'level', 'description': 'lowest level of the records to return (like WARNING)',
+            'in': 'query', 'required': False, 'type': 'string'},
+        {
+            'name': 'logger_name', 'description': 'only return records of this logger and its children (like pkt.db)',
+            'in': 'query', 'required': False, 'type': 'string'},
+        {
+            'name': 'substring', 'description': 'only return records containing this string',
+            'in': 'query', 'required': False, 'type': 'string'},
+    ],
+    'responses': {
+        '200': {'description': 'a stream of log lines, newest first'},
+        '400': {'description': 'invalid filter'}
     }
 }
@@ -0,0 +1,116 @@
+"""Test the PAKET API Horizon account cache."""
+import threading
+import time
+import unittest
+
+import accounts
+
+
+class UnknownAccount(Exception):
+    """Unknown account."""
+
+
+class LocalHorizon:
+    """A stand-in for Horizon account lookups, counting them and taking latency seconds for each."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.accounts = {}
+        self.lookups = 0
+        self.lock = threading.Lock()
+
+    def get_bul_account(self, pubkey):
+        """Look an account up, like paket_stellar.get_bul_account."""
+        with self.lock:
+            self.lookups += 1
+        # The account is read as the request arrives, and the response takes its time to come back.
+        account = dict(self.accounts[pubkey]) if pubkey in self.accounts else None
+        time.sleep(self.latency)
+        if account is None:
+            raise UnknownAccount("no account found for {}".format(pubkey))
+        return account
+
+    def send_buls(self, from_pubkey, to_pubkey, amount_buls):
+        """Apply a BUL transfer."""
+        self.accounts[from_pubkey]['bul_balance'] -= amount_buls
+        self.accounts[to_pubkey]['bul_balance'] += amount_buls
+
+
+class AccountCacheTest(unittest.TestCase):
+    """Account cache test."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.horizon = LocalHorizon()
+        self.horizon.accounts = {'alice': {'bul_balance': 100}, 'bob': {'bul_balance': 0}}
+        self.account_cache = accounts.AccountCache(self.horizon.get_bul_account, ttl=60)
+
+    def test_cache(self):
+        """Test that accounts are looked up once, and that callers can not change cached accounts."""
+        for _ in range(10):
+            account = self.account_cache.get('alice')
+            account['bul_balance'] = 0
+        self.assertEqual(self.account_cache.get('alice'), {'bul_balance': 100})
+        self.assertEqual(self.horizon.lookups, 1)
+        stats = self.account_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (10, 1))
+        self.assertEqual(stats['lookups']['calls'], 1)
+
+    def test_expiry(self):
+        """Test that accounts are looked up again after ttl seconds."""
+        self.account_cache = accounts.AccountCache(self.horizon.get_bul_account, ttl=0.01)
+        self.account_cache.get('alice')
+        time.sleep(0.02)
+        self.account_cache.get('alice')
+        self.assertEqual(self.horizon.lookups, 2)
+
+    def test_unknown_account(self):
+        """Test that failed lookups are not cached."""
+        for _ in range(2):
+            with self.assertRaises(UnknownAccount):
+                self.account_cache.get('carol')
+        self.assertEqual(self.horizon.lookups, 2)
+
+    def test_coalescing(self):
+        """Test that concurrent requests for an account share a single lookup."""
+        self.horizon.latency = 0.1
+        balances = []
+        threads = [
+            threading.Thread(target=lambda: balances.append(self.account_cache.get('alice')['bul_balance']))
+            for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((self.horizon.lookups, balances), (1, [100] * 20))
+        self.assertEqual(self.account_cache.stats()['lookups']['coalesced'], 19)
+
+    def test_invalidation(self):
+        """Test that changed accounts are looked up again, even while a lookup predating the change is in flight."""
+        self.account_cache.get('alice')
+        self.horizon.send_buls('alice', 'bob', 10)
+        self.account_cache.invalidate('alice')
+        self.assertEqual(self.account_cache.get('alice'), {'bul_balance': 90})
+
+        self.horizon.latency = 0.1
+        stale_lookup = threading.Thread(target=self.account_cache.get, args=('bob',))
+        stale_lookup.start()
+        time.sleep(0.05)
+        self.horizon.accounts['bob']['bul_balance'] = 50
+        self.account_cache.invalidate('bob')
+        self.assertEqual(self.account_cache.get('bob'), {'bul_balance': 50})
+        stale_lookup.join()
+        self.assertEqual(self.account_cache.get('bob'), {'bul_balance': 50})
+
+    def test_clear(self):
+        """Test that clearing the cache drops all accounts, including ones being looked up."""
+        self.account_cache.get('alice')
+        self.horizon.latency = 0.1
+        stale_lookup = threading.Thread(target=self.account_cache.get, args=('bob',))
+        stale_lookup.start()
+        time.sleep(0.05)
+        self.horizon.send_buls('alice', 'bob', 10)
+        self.account_cache.clear()
+        stale_lookup.join()
+        self.assertEqual(self.account_cache.get('alice'), {'bul_balance': 90})
+        self.assertEqual(self.account_cache.get('bob'), {'bul_balance': 10})
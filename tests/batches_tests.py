@@ -0,0 +1,26 @@
+"""Test parsing batches of API calls."""
+import json
+import unittest
+
+import batches
+
+
+class ParseBatchTest(unittest.TestCase):
+    """Batch parsing test."""
+
+    def test_parse(self):
+        """Test that sub-requests get string data and headers, without accept-encoding."""
+        subrequests = batches.parse_batch(json.dumps([
+            {'path': '/v3/package', 'data': {'escrow_pubkey': 'GESCROW', 'view': None, 'num': 1}},
+            {'path': '/v3/my_packages', 'headers': {'Pubkey': 'GUSER', 'Accept-Encoding': 'gzip'}}]), 2)
+        self.assertEqual(subrequests, [
+            {'path': '/v3/package', 'data': {'escrow_pubkey': 'GESCROW', 'num': '1'}, 'headers': {}},
+            {'path': '/v3/my_packages', 'data': {}, 'headers': {'Pubkey': 'GUSER'}}])
+
+    def test_invalid(self):
+        """Test that invalid batches are rejected."""
+        for requests in (
+                'not json', '{}', '[]', json.dumps([{'path': '/v3/package'}] * 3), json.dumps([{'data': {}}]),
+                json.dumps([{'path': '/v3/package', 'headers': []}])):
+            with self.assertRaises(ValueError, msg="{} was not rejected".format(requests)):
+                batches.parse_batch(requests, 2)
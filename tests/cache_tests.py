@@ -0,0 +1,131 @@
+"""Test the PAKET API cache and broker."""
+import threading
+import time
+import unittest
+
+import broker
+import cache
+
+
+class LRUCacheTest(unittest.TestCase):
+    """LRU cache test."""
+
+    def test_hit_and_miss(self):
+        """Test getting cached and missing values."""
+        lru_cache = cache.LRUCache(10, 60)
+        self.assertIsNone(lru_cache.get('key'))
+        lru_cache.set('key', 'value')
+        self.assertEqual(lru_cache.get('key'), 'value')
+        stats = lru_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_ratio']), (1, 1, 0.5))
+
+    def test_eviction(self):
+        """Test that the least recently used entry is evicted."""
+        lru_cache = cache.LRUCache(2, 60)
+        lru_cache.set('first', 1)
+        lru_cache.set('second', 2)
+        lru_cache.get('first')
+        lru_cache.set('third', 3)
+        self.assertEqual(lru_cache.get('first'), 1)
+        self.assertIsNone(lru_cache.get('second'), 'least recently used entry was not evicted')
+        self.assertEqual(lru_cache.get('third'), 3)
+        self.assertEqual(lru_cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        """Test that entries expire."""
+        lru_cache = cache.LRUCache(10, 0.01)
+        lru_cache.set('key', 'value')
+        time.sleep(0.02)
+        self.assertIsNone(lru_cache.get('key'))
+        self.assertEqual(lru_cache.stats()['expirations'], 1)
+
+    def test_invalidation(self):
+        """Test that invalidated entries are dropped, and that loads predating the invalidation are not stored."""
+        lru_cache = cache.LRUCache(10, 60)
+        lru_cache.set('key', 'old value')
+        generation = lru_cache.generation()
+        lru_cache.invalidate('key')
+        self.assertIsNone(lru_cache.get('key'))
+        self.assertFalse(lru_cache.set('key', 'old value', generation), 'stale value was cached')
+        self.assertIsNone(lru_cache.get('key'))
+        self.assertTrue(lru_cache.set('key', 'new value', lru_cache.generation()))
+        self.assertEqual(lru_cache.get('key'), 'new value')
+
+    def test_invalidations_take_no_slots(self):
+        """Test that invalidations do not evict entries, and that forgotten ones still reject older loads."""
+        lru_cache = cache.LRUCache(2, 60)
+        lru_cache.set('first', 1)
+        lru_cache.set('second', 2)
+        generation = lru_cache.generation()
+        for index in range(10):
+            lru_cache.invalidate("invalidated {}".format(index))
+        self.assertEqual((lru_cache.get('first'), lru_cache.get('second')), (1, 2))
+        self.assertEqual(lru_cache.stats()['evictions'], 0)
+        self.assertFalse(lru_cache.set('other', 'old value', generation), 'load older than forgotten invalidations')
+        self.assertTrue(lru_cache.set('other', 'new value', lru_cache.generation()))
+
+
+class SingleFlightTest(unittest.TestCase):
+    """Call coalescing test."""
+
+    def test_coalescing(self):
+        """Test that concurrent calls for a key share a single call, and calls for other keys do not wait."""
+        single_flight = cache.SingleFlight()
+        started, release, calls, results = threading.Event(), threading.Event(), [], []
+
+        def slow_call():
+            """A call blocking until released."""
+            calls.append(None)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        leader = threading.Thread(target=lambda: results.append(single_flight.call('key', slow_call)))
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(target=lambda: results.append(single_flight.call('key', slow_call))) for _ in range(5)]
+        for follower in followers:
+            follower.start()
+        self.assertEqual(single_flight.call('other key', lambda: 'other result'), 'other result')
+        while single_flight.stats()['coalesced'] < 5:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual((len(calls), results), (1, ['result'] * 6))
+        self.assertEqual(single_flight.stats(), dict(calls=2, coalesced=5, in_flight=0))
+
+    def test_exception(self):
+        """Test that exceptions are raised to the caller, and not remembered."""
+        single_flight = cache.SingleFlight()
+        with self.assertRaises(ZeroDivisionError):
+            single_flight.call('key', lambda: 1 / 0)
+        self.assertEqual(single_flight.call('key', lambda: 1), 1)
+
+
+class BrokerTest(unittest.TestCase):
+    """Broker test."""
+
+    def test_shared_invalidation(self):
+        """Test that workers subscribed to a shared broker see each other's invalidations."""
+        shared_broker = broker.LocalBroker()
+        worker_caches = [cache.LRUCache(10, 60) for _ in range(3)]
+        for worker_cache in worker_caches:
+            worker_cache.set('key', 'value')
+            shared_broker.subscribe('invalidate', worker_cache.invalidate)
+        shared_broker.publish('invalidate', 'key')
+        for worker_cache in worker_caches:
+            self.assertIsNone(worker_cache.get('key'), 'invalidation did not reach all workers')
+
+    def test_failing_subscriber(self):
+        """Test that a failing subscriber does not prevent delivery to others."""
+        shared_broker = broker.LocalBroker()
+        received = []
+        shared_broker.subscribe('channel', lambda message: 1 / 0)
+        shared_broker.subscribe('channel', received.append)
+        shared_broker.publish('channel', 'message')
+        self.assertEqual(received, ['message'])
+        shared_broker.unsubscribe('channel', received.append)
+        shared_broker.publish('channel', 'message')
+        self.assertEqual(received, ['message'])
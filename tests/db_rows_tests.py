@@ -0,0 +1,19 @@
+"""Test the PAKET API fetched rows helpers."""
+import unittest
+
+import db_rows
+
+
+class DecodeKeysTest(unittest.TestCase):
+    """Bytes keys decoding test."""
+
+    def test_decode_keys(self):
+        """Test that bytes keys are decoded, and other keys kept."""
+        self.assertEqual(db_rows.decode_keys({b'id': 1, 'status': b'queued'}), {'id': 1, 'status': b'queued'})
+
+    def test_decode_rows(self):
+        """Test that rows are only rebuilt if their keys need it."""
+        rows = [{'id': 1}, {'id': 2}]
+        self.assertIs(db_rows.decode_rows(rows)[0], rows[0])
+        self.assertEqual(db_rows.decode_rows(({b'id': index} for index in (1, 2))), rows)
+        self.assertEqual(db_rows.decode_rows([]), [])
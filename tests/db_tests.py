@@ -1,4 +1,7 @@
 """Test the PAKET API database."""
+import contextlib
+import datetime
+import threading
 import time
 import unittest
 
@@ -6,6 +9,7 @@ import paket_stellar
 import util.logger
 
 import db
+import db_rows
 
 LOGGER = util.logger.logging.getLogger('pkt.api.test')
 
@@ -23,7 +27,45 @@ def clear_tables():
     """Clear all tables in db"""
     assert db.DB_NAME.startswith('test'), "refusing to test on db named {}".format(db.DB_NAME)
     LOGGER.info('clearing database')
-    db.util.db.clear_tables(db.SQL_CONNECTION, db.DB_NAME)
+    db.clear_tables()
+
+
+@contextlib.contextmanager
+def count_queries():
+    """
+    Count the queries executed through db.SQL_CONNECTION by this thread within the block (so background writers,
+    like the event buffer flusher, are not counted).
+    """
+    original_sql_connection = db.SQL_CONNECTION
+    executed = []
+    counting_thread = threading.get_ident()
+
+    class CountingCursor:
+        """Cursor proxy that records executed statements."""
+
+        def __init__(self, sql):
+            self.sql = sql
+
+        def execute(self, *args, **kwargs):
+            """Record and execute a statement."""
+            if threading.get_ident() == counting_thread:
+                executed.append(args[0])
+            return self.sql.execute(*args, **kwargs)
+
+        def __getattr__(self, name):
+            return getattr(self.sql, name)
+
+    @contextlib.contextmanager
+    def counting_sql_connection(*args, **kwargs):
+        """Wrap the original connection with a counting cursor."""
+        with original_sql_connection(*args, **kwargs) as sql:
+            yield CountingCursor(sql)
+
+    db.SQL_CONNECTION = counting_sql_connection
+    try:
+        yield executed
+    finally:
+        db.SQL_CONNECTION = original_sql_connection
 
 
 class DbBaseTest(unittest.TestCase):
@@ -95,6 +137,22 @@ class CreatePackageTest(DbBaseTest):
             "created event for user: {}, but must be for: {}".format(
                 events[0]['user_pubkey'], package_members['launcher'][0]))
 
+    def test_create_package_without_read_back(self):
+        """Creating package in one transaction test."""
+        package_members = self.prepare_package_members()
+        with count_queries() as executed:
+            created_package = db.create_package(
+                package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+                50000000, 100000000, int(time.time()), 'setopts', 'refund', 'merge', 'payment', '32.1,34.8')
+        self.assertEqual(
+            len(executed), 4,
+            "expected a package insert, an event insert and two rollup statements, got {}".format(executed))
+        stored_package = db.get_package(package_members['escrow'][0])
+        for key, value in stored_package.items():
+            self.assertEqual(
+                created_package[key], value, "created package has {} {}, but {} was stored".format(
+                    key, created_package[key], value))
+
 
 class GetPackageTest(DbBaseTest):
     """Getting package test."""
@@ -119,12 +177,85 @@ class GetPackageTest(DbBaseTest):
             "returned package with recipient_pubkey: {}, but {} expected".format(
                 package['recipient_pubkey'], package_members['recipient'][0]))
 
+    def test_package_cache(self):
+        """Test that package reads are cached, and that new events invalidate the cache."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        db.get_package(package_members['escrow'][0])
+        with count_queries() as executed:
+            package = db.get_package(package_members['escrow'][0])
+        if db.PACKAGE_CACHE:
+            self.assertEqual(executed, [], 'cached package was read from the database')
+        package['status'] = 'tampered'
+        self.assertNotEqual(db.get_package(package_members['escrow'][0])['status'], 'tampered')
+        db.add_event(package_members['escrow'][0], package_members['courier'][0], 'couriered', None, sync=True)
+        package = db.get_package(package_members['escrow'][0])
+        self.assertEqual(package['status'], 'in transit', 'stale package returned after an event')
+        self.assertEqual(len(package['events']), 2)
+
+    def test_versioned_read(self):
+        """Test that cached packages older than the given version are read again."""
+        package_members = self.prepare_package_members()
+        escrow_pubkey = package_members['escrow'][0]
+        db.create_package(
+            escrow_pubkey, package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        version = db.get_package_version(escrow_pubkey)
+        self.assertEqual(db.package_version(db.get_package(escrow_pubkey, version=version)), version)
+        # Write an event without invalidating the cache, as if the invalidation was missed.
+        with db.SQL_CONNECTION() as sql:
+            db.insert_events(sql, [dict(
+                timestamp=datetime.datetime.now(), escrow_pubkey=escrow_pubkey,
+                user_pubkey=package_members['courier'][0], event_type='couriered', location=None)])
+        new_version = db.get_package_version(escrow_pubkey)
+        self.assertNotEqual(new_version, version)
+        package = db.get_package(escrow_pubkey, 'summary', version=new_version)
+        self.assertEqual((package['status'], db.package_version(package)), ('in transit', new_version))
+
     def test_invalid_package(self):
         """Getting package with invalid pubkey"""
         with self.assertRaises(db.UnknownPaket, msg='UnknownPaket was not raised on invalid pubkey'):
             db.get_package('invalid pubkey')
 
 
+class GetPackagesByIdsTest(DbBaseTest):
+    """Getting packages by escrow pubkeys test."""
+
+    def test_get_packages_by_ids(self):
+        """Test that packages are returned in order, with None for unknown ones, in two queries at most."""
+        escrow_pubkeys = []
+        for _ in range(3):
+            package_members = self.prepare_package_members()
+            db.create_package(
+                package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+                50000000, 100000000, time.time(), None, None, None, None)
+            db.add_event(package_members['escrow'][0], package_members['courier'][0], 'couriered', None, sync=True)
+            escrow_pubkeys.append(package_members['escrow'][0])
+        requested_pubkeys = [escrow_pubkeys[2], 'invalid pubkey', escrow_pubkeys[0], escrow_pubkeys[1]]
+        if db.PACKAGE_CACHE:
+            db.PACKAGE_CACHE.clear()
+        with count_queries() as executed:
+            packages = db.get_packages_by_ids(requested_pubkeys)
+        self.assertLessEqual(len(executed), 2)
+        self.assertIsNone(packages[1])
+        for escrow_pubkey, package in zip(requested_pubkeys, packages):
+            if package is not None:
+                self.assertEqual(package, db.get_package(escrow_pubkey))
+                self.assertEqual([event['event_type'] for event in package['events']], ['launched', 'couriered'])
+        with count_queries() as executed:
+            db.get_packages_by_ids(escrow_pubkeys)
+        if db.PACKAGE_CACHE:
+            self.assertEqual(executed, [], 'cached packages were read from the database')
+        summaries = db.get_packages_by_ids(requested_pubkeys, view='summary')
+        self.assertEqual([summary and summary['escrow_pubkey'] for summary in summaries], [
+            package and package['escrow_pubkey'] for package in packages])
+        self.assertNotIn('events', summaries[0])
+        with self.assertRaises(db.UnknownField):
+            db.get_packages_by_ids(escrow_pubkeys, fields='no such field')
+
+
 class GetPackagesTest(DbBaseTest):
     """Getting packages test."""
 
@@ -138,6 +269,28 @@ class GetPackagesTest(DbBaseTest):
         packages = db.get_packages()
         self.assertEqual(len(packages), 5, "expected 5 packages, {} got instead".format(len(packages)))
 
+    def test_get_packages_query_count(self):
+        """Getting packages must not run a query per package."""
+        query_counts = []
+        for packages_num in (1, 6):
+            for _ in range(packages_num - len(db.get_packages())):
+                package_members = self.prepare_package_members()
+                db.create_package(
+                    package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+                    50000000, 100000000, time.time(), None, None, None, None)
+                db.add_event(package_members['escrow'][0], package_members['courier'][0], 'couriered', None)
+            with count_queries() as executed:
+                packages = db.get_packages()
+            self.assertEqual(len(packages), packages_num)
+            for package in packages:
+                self.assertEqual(
+                    [event['event_type'] for event in package['events']], ['launched', 'couriered'],
+                    "wrong events attached to package {}".format(package['escrow_pubkey']))
+            query_counts.append(len(executed))
+        self.assertEqual(
+            query_counts[0], query_counts[1],
+            "query count grew from {} to {} with the number of packages".format(*query_counts))
+
     def test_get_user_packages(self):
         """Getting user packages test."""
         user = self.generate_keypair()
@@ -181,6 +334,62 @@ class GetPackagesTest(DbBaseTest):
         self.assertEqual(package['custodian_pubkey'], user[0],
                          "{} expected as custodian, {} got instead".format(user[0], package['custodian_pubkey']))
 
+    def test_multiple_roles(self):
+        """Test that a package where the user has several roles is returned once, with all the roles."""
+        user = self.generate_keypair()
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], user[0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        db.add_event(package_members['escrow'][0], user[0], 'couriered', None)
+        db.add_event(package_members['escrow'][0], user[0], 'couriered', None)
+        with count_queries() as executed:
+            packages = db.get_packages(user[0])
+        self.assertEqual(len(packages), 1, "1 package expected, {} got instead".format(len(packages)))
+        self.assertEqual(packages[0]['user_roles'], ['launcher', 'courier'])
+        self.assertEqual(packages[0]['user_role'], 'launcher')
+        self.assertEqual(len(executed), 2, "expected a packages query and an events query, got {}".format(executed))
+
+
+class ProjectionTest(DbBaseTest):
+    """Package projection test."""
+
+    def setUp(self):
+        """Create a package."""
+        super().setUp()
+        self.package_members = self.prepare_package_members()
+        db.create_package(
+            self.package_members['escrow'][0], self.package_members['launcher'][0],
+            self.package_members['recipient'][0], 50000000, 100000000, time.time(),
+            'setopts', 'refund', 'merge', 'payment')
+
+    def test_summary(self):
+        """Test that summary views select neither transactions nor events."""
+        with count_queries() as executed:
+            packages = db.get_packages(self.package_members['launcher'][0], view='summary')
+        self.assertEqual(len(executed), 1, "expected a single query, got {}".format(executed))
+        self.assertNotIn('events', packages[0])
+        self.assertNotIn('refund_transaction', packages[0])
+        self.assertEqual(packages[0]['status'], 'waiting pickup')
+        package = db.get_package(self.package_members['escrow'][0], view='summary')
+        self.assertEqual(set(package) - {'blockchain_url', 'paket_url'}, set(db.PACKAGE_SUMMARY_COLUMNS))
+
+    def test_fields(self):
+        """Test selecting specific fields."""
+        for package in (
+                db.get_package(self.package_members['escrow'][0], fields='payment,events'),
+                db.get_packages(fields='payment, events')[0]):
+            self.assertEqual(set(package) - {'blockchain_url', 'paket_url'}, {
+                'escrow_pubkey', 'launch_date', 'payment', 'events'})
+            self.assertEqual(len(package['events']), 1)
+
+    def test_unknown_field(self):
+        """Test that unknown fields and views are rejected."""
+        with self.assertRaises(db.UnknownField):
+            db.get_packages(fields='payment,password')
+        with self.assertRaises(db.UnknownField):
+            db.get_package(self.package_members['escrow'][0], view='everything')
+
 
 class AddEventTest(DbBaseTest):
     """Adding event test."""
@@ -201,6 +410,176 @@ class AddEventTest(DbBaseTest):
             "expected event with user_pubkey: {}, but {} got instead".format(
                 package_members['courier'][0], couriered_event['user_pubkey']))
 
+    def test_buffered_publish_failure(self):
+        """Test that a failure to publish buffered events, after they are committed, does not write them again."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+
+        def failing_publish(events):
+            raise ValueError("broker is down, can't publish {} events".format(len(events)))
+
+        publish_package_events = db.publish_package_events
+        db.publish_package_events = failing_publish
+        buffer = db.event_buffer.EventBuffer(
+            db.commit_events, max_batch_size=3, max_delay=60, on_written=db.events_written)
+        try:
+            for user, event_type in (
+                    (package_members['courier'][0], 'couriered'), (package_members['courier'][0], 'changed location'),
+                    (package_members['recipient'][0], 'received')):
+                buffer.put(dict(
+                    timestamp=db.datetime.datetime.now(), escrow_pubkey=package_members['escrow'][0],
+                    user_pubkey=user, event_type=event_type, location=None))
+            buffer.stop()
+        finally:
+            db.publish_package_events = publish_package_events
+        events = db.get_package_events(package_members['escrow'][0])
+        self.assertEqual(
+            [event['event_type'] for event in events], ['launched', 'couriered', 'changed location', 'received'])
+        self.assertEqual(buffer.stats()['dropped'], 0)
+        self.assertEqual(db.get_package(package_members['escrow'][0])['state_version'], 2)
+
+
+class PackageStateTest(DbBaseTest):
+    """Stored package state test."""
+
+    def test_state_follows_events(self):
+        """Test that status, custodian and dates are updated with each event."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        for user, event_type, status in (
+                (package_members['courier'][0], 'couriered', 'in transit'),
+                (package_members['courier'][0], 'changed location', 'in transit'),
+                (package_members['recipient'][0], 'received', 'delivered')):
+            db.add_event(package_members['escrow'][0], user, event_type, None)
+            package = db.get_package(package_members['escrow'][0])
+            self.assertEqual(package['status'], status, "expected status '{}' after '{}' event, got '{}'".format(
+                status, event_type, package['status']))
+            self.assertEqual(package['custodian_pubkey'], user)
+            self.assertEqual(package['launch_date'], package['events'][0]['timestamp'])
+            self.assertEqual(package['last_event_at'], package['events'][-1]['timestamp'])
+        self.assertEqual(len(db.get_packages_by_state(status='delivered')), 1)
+        self.assertEqual(len(db.get_packages_by_state(custodian_pubkey=package_members['courier'][0])), 0)
+
+    def test_batched_events(self):
+        """Test writing a batch of events of several packages in one transaction."""
+        packages_members = [self.prepare_package_members() for _ in range(2)]
+        for members in packages_members:
+            db.create_package(
+                members['escrow'][0], members['launcher'][0], members['recipient'][0],
+                50000000, 100000000, time.time(), None, None, None, None)
+        events = []
+        for members in packages_members:
+            for user, event_type in (
+                    (members['courier'][0], 'couriered'), (members['recipient'][0], 'received'),
+                    (members['courier'][0], 'changed location')):
+                events.append(dict(
+                    timestamp=db.datetime.datetime.now(), escrow_pubkey=members['escrow'][0], user_pubkey=user,
+                    event_type=event_type, location=None))
+        with count_queries() as executed:
+            db.write_events(events)
+        self.assertEqual(
+            len(executed), 5,
+            "expected an insert, an update per package and two rollup statements, got {}".format(executed))
+        for members in packages_members:
+            package = db.get_package(members['escrow'][0])
+            self.assertEqual(len(package['events']), 4)
+            self.assertEqual(package['status'], 'delivered')
+            self.assertEqual(package['custodian_pubkey'], members['courier'][0])
+            self.assertEqual(package['last_event_at'], package['events'][-1]['timestamp'])
+
+    def test_late_events(self):
+        """Test that an event written after a later one (by a late buffer flush) does not set the custodian."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        queued_at = db.datetime.datetime.now()
+        db.add_event(package_members['escrow'][0], package_members['recipient'][0], 'received', None)
+        db.write_events([dict(
+            timestamp=queued_at, escrow_pubkey=package_members['escrow'][0],
+            user_pubkey=package_members['courier'][0], event_type='couriered', location=None)])
+        package = db.get_package(package_members['escrow'][0])
+        self.assertEqual(package['status'], 'delivered')
+        self.assertEqual(package['custodian_pubkey'], package_members['recipient'][0])
+        self.assertEqual(package['custodian_pubkey'], package['events'][-1]['user_pubkey'])
+
+    def test_backfill(self):
+        """Test recomputing package state from events."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        db.add_event(package_members['escrow'][0], package_members['courier'][0], 'couriered', None)
+        with db.SQL_CONNECTION() as sql:
+            sql.execute("""
+                UPDATE packages SET status = 'unknown', custodian_pubkey = NULL, launch_date = NULL,
+                last_event_at = NULL""")
+        self.assertEqual(db.backfill_packages_state(), 1)
+        package = db.get_package(package_members['escrow'][0])
+        self.assertEqual(package['status'], 'in transit')
+        self.assertEqual(package['custodian_pubkey'], package_members['courier'][0])
+        self.assertEqual(package['launch_date'], package['events'][0]['timestamp'])
+        self.assertEqual(package['last_event_at'], package['events'][-1]['timestamp'])
+
+
+class NearbyPackagesTest(DbBaseTest):
+    """Nearby packages test."""
+
+    def setUp(self):
+        """Launch packages in London and Paris, and pick up one of the London ones."""
+        super().setUp()
+        self.packages = {}
+        for name, location in (
+                ('london', '51.4983407,-0.173709'), ('london picked up', '51.5,-0.17'), ('paris', '48.8566,2.3522'),
+                ('nowhere', None)):
+            package_members = self.prepare_package_members()
+            db.create_package(
+                package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+                50000000, 100000000, time.time(), None, None, None, None, location)
+            self.packages[name] = package_members['escrow'][0]
+        self.courier_pubkey = self.generate_keypair()[0]
+        db.add_event(self.packages['london picked up'], self.courier_pubkey, 'couriered', '51.51,-0.12')
+
+    def test_couriers_positions(self):
+        """Test that the last positions of couriers are returned, and only theirs (not those of launchers)."""
+        db.add_event(None, self.courier_pubkey, 'changed location', '51.52,-0.1')
+        self.assertEqual(
+            [(user['user_pubkey'], user['latitude'], user['longitude'])
+             for user in db.get_users_positions(time.time() - 60)], [(self.courier_pubkey, 51.52, -0.1)])
+
+    def test_radius(self):
+        """Test getting packages waiting for pickup within a radius, closest first."""
+        packages = db.get_nearby_packages(51.5, -0.17, 10)
+        self.assertEqual([package['escrow_pubkey'] for package in packages], [self.packages['london']])
+        self.assertLess(packages[0]['distance_km'], 1)
+        packages = db.get_nearby_packages(50, 1, 1000, view='summary')
+        self.assertEqual(
+            [package['escrow_pubkey'] for package in packages], [self.packages['paris'], self.packages['london']])
+
+    def test_bounding_box(self):
+        """Test getting packages waiting for pickup within a bounding box."""
+        packages = db.get_nearby_packages(min_latitude=51, max_latitude=52, min_longitude=-1, max_longitude=1)
+        self.assertEqual([package['escrow_pubkey'] for package in packages], [self.packages['london']])
+
+    def test_position_follows_events(self):
+        """Test that the stored position of a package follows its events."""
+        package = db.get_package(self.packages['london picked up'], view='summary')
+        self.assertEqual((package['latitude'], package['longitude']), (51.51, -0.12))
+        db.add_event(self.packages['london picked up'], self.generate_keypair()[0], 'changed location', 'unknown')
+        package = db.get_package(self.packages['london picked up'], view='summary')
+        self.assertEqual((package['latitude'], package['longitude']), (51.51, -0.12))
+
+    def test_invalid_query(self):
+        """Test that queries without a position or a box are rejected."""
+        with self.assertRaises(db.InvalidFilter):
+            db.get_nearby_packages()
+        with self.assertRaises(db.InvalidFilter):
+            db.get_nearby_packages('north', 'west')
+
 
 class GetEventsTest(DbBaseTest):
     """Getting events test."""
@@ -243,3 +622,301 @@ class GetEventsTest(DbBaseTest):
             events = db.get_package_events(members['escrow'][0])
             self.assertEqual(len(events), index+1, "{} event expected for escrow: {}, but {} got instead".format(
                 index + 1, members['escrow'][0], len(events)))
+
+    def test_filters(self):
+        """Test filtering events by type, user, package, scope and time window."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        db.add_event(package_members['escrow'][0], package_members['courier'][0], 'couriered', None)
+        db.add_event(None, package_members['courier'][0], 'installed app', None)
+        events = db.get_events(10, event_type='couriered')
+        self.assertEqual(
+            [event['user_pubkey'] for event in events['packages_events']], [package_members['courier'][0]])
+        events = db.get_events(10, user_pubkey=package_members['courier'][0], scope='user')
+        self.assertEqual(events['packages_events'], [])
+        self.assertEqual([event['event_type'] for event in events['user_events']], ['installed app'])
+        events = db.get_events(10, escrow_pubkey=package_members['escrow'][0])
+        self.assertEqual(
+            [event['event_type'] for event in events['packages_events']], ['launched', 'couriered'])
+        self.assertEqual(events['user_events'], [])
+        self.assertEqual(len(db.get_events(10, since_timestamp=time.time() - 60)['packages_events']), 2)
+        self.assertEqual(db.get_events(10, until_timestamp=time.time() - 60)['packages_events'], [])
+        with self.assertRaises(db.InvalidFilter):
+            db.get_events(10, scope='everything')
+
+
+class StatsTest(DbBaseTest):
+    """Daily statistics test."""
+
+    def test_stats_follow_events(self):
+        """Test that the stats count new events, and survive a rebuild."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        for _ in range(2):
+            db.add_event(package_members['escrow'][0], package_members['courier'][0], 'couriered', None)
+        stats = {row['event_type']: row for row in db.get_stats()}
+        self.assertEqual((stats['launched']['events_num'], stats['launched']['users_num']), (1, 1))
+        self.assertEqual((stats['couriered']['events_num'], stats['couriered']['users_num']), (2, 1))
+        self.assertEqual(db.get_stats(until_timestamp=time.time() - 3 * 86400), [])
+        self.assertEqual(db.rebuild_rollups(), 3)
+        self.assertEqual({row['event_type']: row for row in db.get_stats()}, stats)
+
+
+class PackageUpdatesTest(DbBaseTest):
+    """Package updates long poll test."""
+
+    def test_wait_package_updates(self):
+        """Test that waiting returns new events as they are added, and the events following the given cursor."""
+        package_members = self.prepare_package_members()
+        escrow_pubkey = package_members['escrow'][0]
+        db.create_package(
+            escrow_pubkey, package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        events, start_cursor = db.wait_package_updates([escrow_pubkey], timeout=0.01)
+        self.assertEqual(events, [])
+        self.assertIsNotNone(start_cursor)
+        timer = threading.Timer(0.05, db.add_event, (escrow_pubkey, package_members['courier'][0], 'couriered', None))
+        timer.start()
+        events, cursor = db.wait_package_updates([escrow_pubkey], timeout=5)
+        timer.join()
+        self.assertEqual([event['event_type'] for event in events], ['couriered'])
+        self.assertEqual(
+            [event['event_type'] for event in db.wait_package_updates([escrow_pubkey], start_cursor)[0]],
+            ['couriered'], 'events added between calls must follow the cursor returned on timeout')
+        db.add_event(escrow_pubkey, package_members['recipient'][0], 'received', None)
+        events, next_cursor = db.wait_package_updates([escrow_pubkey], cursor, timeout=5)
+        self.assertEqual([event['event_type'] for event in events], ['received'])
+        self.assertEqual(db.wait_package_updates([escrow_pubkey], next_cursor, timeout=0.01), ([], next_cursor))
+        with self.assertRaises(db.InvalidCursor):
+            db.wait_package_updates([escrow_pubkey], 'invalid', timeout=0.01)
+        with self.assertRaises(db.InvalidCursor):
+            db.wait_package_updates([escrow_pubkey], db.encode_cursor(datetime.datetime.now(), escrow_pubkey))
+
+    def test_late_events(self):
+        """Test that events written after the cursor are returned, even with earlier (or equal) timestamps."""
+        package_members = self.prepare_package_members()
+        escrow_pubkey = package_members['escrow'][0]
+        queued_at = datetime.datetime.now()
+        db.create_package(
+            escrow_pubkey, package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        _, cursor = db.get_package_updates([escrow_pubkey])
+        db.write_events([dict(
+            timestamp=queued_at, escrow_pubkey=escrow_pubkey, user_pubkey=package_members['courier'][0],
+            event_type=event_type, location=None) for event_type in ('couriered', 'received')])
+        events, next_cursor = db.get_package_updates([escrow_pubkey], cursor)
+        self.assertEqual([event['event_type'] for event in events], ['couriered', 'received'])
+        self.assertEqual(events[1]['id'], events[0]['id'] + 1)
+        events, _ = db.get_package_updates([escrow_pubkey], db.package_update_cursor(events[0]))
+        self.assertEqual([event['event_type'] for event in events], ['received'])
+        self.assertEqual(db.get_package_updates([escrow_pubkey], next_cursor), ([], next_cursor))
+        self.assertEqual(
+            len(db.get_package_updates([escrow_pubkey], db.encode_cursor(queued_at, events[0]['id'] - 1))[0]), 1,
+            '(timestamp, id) cursors must be read by their event id')
+
+
+class VersionTest(DbBaseTest):
+    """Package version markers test."""
+
+    def test_versions_follow_events(self):
+        """Test that the version markers of packages and of the packages of a user change with every event."""
+        package_members = self.prepare_package_members()
+        escrow_pubkey, courier_pubkey = package_members['escrow'][0], package_members['courier'][0]
+        self.assertIsNone(db.get_package_version(escrow_pubkey))
+        db.create_package(
+            escrow_pubkey, package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        package_version = db.get_package_version(escrow_pubkey)
+        launcher_version = db.get_packages_version(package_members['launcher'][0])
+        courier_version = db.get_packages_version(courier_pubkey)
+        self.assertEqual(db.get_package_version(escrow_pubkey), package_version)
+        db.add_event(escrow_pubkey, courier_pubkey, 'couriered', None)
+        self.assertNotEqual(db.get_package_version(escrow_pubkey), package_version)
+        self.assertNotEqual(db.get_packages_version(package_members['launcher'][0]), launcher_version)
+        self.assertNotEqual(db.get_packages_version(courier_pubkey), courier_version)
+
+    def test_late_events(self):
+        """Test that the version markers change with events written late, carrying older timestamps."""
+        package_members = self.prepare_package_members()
+        escrow_pubkey, launcher_pubkey = package_members['escrow'][0], package_members['launcher'][0]
+        launched_at = datetime.datetime.now()
+        db.create_package(
+            escrow_pubkey, launcher_pubkey, package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        package_version = db.get_package_version(escrow_pubkey)
+        launcher_version = db.get_packages_version(launcher_pubkey)
+        db.write_events([dict(
+            timestamp=launched_at, escrow_pubkey=escrow_pubkey, user_pubkey=package_members['courier'][0],
+            event_type='couriered', location=None)])
+        self.assertNotEqual(db.get_package_version(escrow_pubkey), package_version)
+        self.assertNotEqual(db.get_packages_version(launcher_pubkey), launcher_version)
+        self.assertEqual(db.get_package(escrow_pubkey)['status'], 'in transit')
+
+
+class MigrationsTest(DbBaseTest):
+    """Schema migrations test."""
+
+    def test_schema_version(self):
+        """Test that the database is migrated to the latest version, and that migrating again is a no-op."""
+        self.assertEqual(
+            db.migrations.get_schema_version(db.SQL_CONNECTION, db.DB_ENGINE), db.migrations.LATEST_VERSION)
+        self.assertEqual(db.migrate_db(), db.migrations.LATEST_VERSION)
+
+
+class QueryPlanTest(DbBaseTest):
+    """Test that the hot queries are served by indexes."""
+
+    def setUp(self):
+        """Populate the tables so the optimizer has something to choose from."""
+        super().setUp()
+        self.user_pubkey = self.generate_keypair()[0]
+        for _ in range(5):
+            package_members = self.prepare_package_members()
+            db.create_package(
+                package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+                50000000, 100000000, time.time(), None, None, None, None)
+            db.add_event(package_members['escrow'][0], package_members['courier'][0], 'couriered', None)
+        self.escrow_pubkey = package_members['escrow'][0]
+        self.now = db.datetime.datetime.now()
+
+    def assert_uses_index(self, index_name, query, params):
+        """Assert that the query plan of a query uses a specific index."""
+        with db.SQL_CONNECTION() as sql:
+            if db.DB_ENGINE == 'sqlite':
+                sql.execute("EXPLAIN QUERY PLAN {}".format(query), params)
+                plan = sql.fetchall()
+                used_indexes = [word for row in plan for word in row['detail'].split()]
+            else:
+                sql.execute("EXPLAIN {}".format(query), params)
+                plan = db_rows.decode_rows(sql.fetchall())
+                used_indexes = [row['key'] for row in plan]
+        self.assertIn(index_name, used_indexes, "{} not used by query: {}".format(index_name, plan))
+
+    def test_package_events(self):
+        """Test getting the events of a package."""
+        self.assert_uses_index('events_escrow_pubkey_timestamp', db.PACKAGE_EVENTS_QUERY, (self.escrow_pubkey,))
+
+    def assert_user_packages_use_index(self, index_name):
+        """Assert that the query of the packages of a user, as run by get_packages, uses a specific index."""
+        self.assert_uses_index(index_name, *db.user_packages_query(self.user_pubkey, db.package_projection()[0]))
+
+    def test_launcher_packages(self):
+        """Test getting the packages of a launcher."""
+        self.assert_user_packages_use_index('packages_launcher_pubkey_launch_date')
+
+    def test_recipient_packages(self):
+        """Test getting the packages of a recipient."""
+        self.assert_user_packages_use_index('packages_recipient_pubkey_launch_date')
+
+    def test_courier_packages(self):
+        """Test getting the packages couriered by a user."""
+        self.assert_user_packages_use_index('events_user_pubkey_event_type')
+
+    def test_nearby_packages(self):
+        """Test getting the packages waiting for pickup in a bounding box."""
+        self.assert_uses_index(
+            'packages_status_latitude_longitude', db.NEARBY_PACKAGES_QUERY.format(', '.join(db.PACKAGE_COLUMNS)), (
+                'waiting pickup', 51, 52, -1, 1))
+
+    def test_packages_version(self):
+        """Test getting the version marker of the packages of a user."""
+        self.assert_uses_index('events_user_pubkey_event_type', db.PACKAGES_VERSION_QUERY, (self.user_pubkey,) * 3)
+
+    def test_events_page(self):
+        """Test getting a page of events after a cursor."""
+        self.assert_uses_index('events_timestamp_id', *db.events_page_query(2, db.encode_cursor(self.now, 0)))
+
+    def test_filtered_events_page(self):
+        """Test getting a page of events of a type."""
+        self.assert_uses_index('events_event_type_timestamp', *db.events_page_query(
+            2, db.encode_cursor(self.now, 0), event_type='couriered'))
+
+    def test_packages_page(self):
+        """Test getting a page of packages after a cursor."""
+        self.assert_uses_index('packages_launch_date_escrow_pubkey', *db.packages_page_query(
+            db.package_projection()[0], db.encode_cursor(self.now, self.escrow_pubkey), 2))
+
+    def test_user_packages_page(self):
+        """Test getting a page of the packages of a user after a cursor."""
+        for index_name in (
+                'packages_launcher_pubkey_launch_date', 'packages_recipient_pubkey_launch_date',
+                'events_user_pubkey_event_type'):
+            self.assert_uses_index(index_name, *db.user_packages_query(
+                self.user_pubkey, db.package_projection()[0], db.encode_cursor(self.now, self.escrow_pubkey), 2))
+
+
+class PaginationTest(DbBaseTest):
+    """Keyset pagination test."""
+
+    def test_events_pages(self):
+        """Test paging through all events."""
+        package_members = self.prepare_package_members()
+        db.create_package(
+            package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+            50000000, 100000000, time.time(), None, None, None, None)
+        for _ in range(4):
+            db.add_event(package_members['escrow'][0], package_members['courier'][0], 'changed location', None)
+            db.add_event(None, package_members['courier'][0], 'installed app', None)
+        events, cursor = [], None
+        while True:
+            page = db.get_events(3, cursor)
+            self.assertLessEqual(len(page['packages_events']) + len(page['user_events']), 3)
+            events.extend(page['packages_events'] + page['user_events'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(len(events), 9, "expected 9 events, {} got instead".format(len(events)))
+        self.assertEqual(len({event['id'] for event in events}), 9, 'same event returned on more than one page')
+
+    def test_packages_pages(self):
+        """Test paging through the packages of a user."""
+        user = self.generate_keypair()
+        escrow_pubkeys = []
+        for index in range(5):
+            package_members = self.prepare_package_members()
+            escrow_pubkeys.append(package_members['escrow'][0])
+            db.create_package(
+                package_members['escrow'][0], user[0] if index % 2 else package_members['launcher'][0],
+                package_members['recipient'][0] if index % 2 else user[0],
+                50000000, 100000000, time.time(), None, None, None, None)
+        packages, cursor = [], None
+        while True:
+            page, cursor = db.get_packages_page(user[0], 2, cursor)
+            self.assertLessEqual(len(page), 2)
+            packages.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(
+            [package['escrow_pubkey'] for package in packages], escrow_pubkeys,
+            'packages not returned in launch order')
+
+    def test_null_launch_dates(self):
+        """Test paging through packages without a launch date, which come first."""
+        escrow_pubkeys = []
+        for _ in range(4):
+            package_members = self.prepare_package_members()
+            escrow_pubkeys.append(package_members['escrow'][0])
+            db.create_package(
+                package_members['escrow'][0], package_members['launcher'][0], package_members['recipient'][0],
+                50000000, 100000000, time.time(), None, None, None, None)
+        undated_escrow_pubkeys = sorted(escrow_pubkeys[2:])
+        with db.SQL_CONNECTION() as sql:
+            sql.execute("UPDATE packages SET launch_date = NULL WHERE escrow_pubkey IN (%s, %s)", tuple(
+                undated_escrow_pubkeys))
+        packages, cursor = [], None
+        while True:
+            page, cursor = db.get_packages_page(None, 1, cursor, 'summary')
+            packages.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(
+            [package['escrow_pubkey'] for package in packages], undated_escrow_pubkeys + escrow_pubkeys[:2])
+
+    def test_invalid_cursor(self):
+        """Test that invalid cursors are rejected."""
+        with self.assertRaises(db.InvalidCursor):
+            db.get_events(10, 'not a cursor')
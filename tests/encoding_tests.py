@@ -0,0 +1,56 @@
+"""Test the PAKET API response encoding."""
+import datetime
+import decimal
+import gzip
+import json
+import unittest
+
+import encoding
+
+
+class DumpsTest(unittest.TestCase):
+    """JSON encoding test."""
+
+    def test_like_json(self):
+        """Test that values are encoded like the json module and Flask's default encoder do."""
+        value = {
+            'string': 'שלום', 'integer': 50000000, 'float': 51.4983407, 'none': None, 'list': [True, False],
+            'nested': {'events': [{'location': '51.4983407,-0.173709'}]}}
+        self.assertEqual(json.loads(encoding.dumps(value)), value)
+        self.assertEqual(encoding.dumps({'timestamp': datetime.datetime(2018, 8, 3, 12, 5, 7, 123)}),
+                         '{"timestamp":"Fri, 03 Aug 2018 12:05:07 GMT"}')
+        self.assertEqual(encoding.dumps([datetime.date(2018, 8, 3), decimal.Decimal('1.50')]),
+                         '["Fri, 03 Aug 2018 00:00:00 GMT","1.50"]')
+        two_hours_east = datetime.timezone(datetime.timedelta(hours=2))
+        self.assertEqual(
+            encoding.http_date(datetime.datetime(2018, 8, 3, 14, tzinfo=two_hours_east)),
+            'Fri, 03 Aug 2018 12:00:00 GMT')
+
+    def test_fallback(self):
+        """Test that values the fast encoder rejects are still encoded, and that unknown types are not."""
+        self.assertEqual(json.loads(encoding.dumps({1: 2 ** 70})), {'1': 2 ** 70})
+        with self.assertRaises(TypeError):
+            encoding.dumps({'set': {1}})
+
+
+class CompressionTest(unittest.TestCase):
+    """Compression negotiation test."""
+
+    def test_negotiate(self):
+        """Test picking the best accepted encoding."""
+        self.assertEqual(encoding.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(encoding.negotiate('gzip;q=0'), None)
+        self.assertEqual(encoding.negotiate('identity'), None)
+        self.assertEqual(encoding.negotiate(None), None)
+        self.assertEqual(encoding.negotiate('*;q=0.5'), encoding.ENCODINGS[0])
+        self.assertEqual(encoding.negotiate('br;q=0.1, GZIP;q=0.9'), 'gzip')
+        self.assertEqual(encoding.accepted_encodings('br;q=x, gzip'), {'br': 0.0, 'gzip': 1.0})
+
+    def test_compress(self):
+        """Test that compressed bodies decompress to the original one."""
+        body = encoding.dumps(encoding.benchmark_response(10)).encode()
+        compressed = encoding.compress(body, 'gzip')
+        self.assertLess(len(compressed), len(body) / 2)
+        self.assertEqual(gzip.decompress(compressed), body)
+        with self.assertRaises(ValueError):
+            encoding.compress(body, 'deflate')
@@ -0,0 +1,127 @@
+"""Test the PAKET API write-behind event buffer."""
+import threading
+import time
+import unittest
+
+import event_buffer
+
+
+class EventBufferBaseTest(unittest.TestCase):
+    """Base class for event buffer tests."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.batches = []
+        self.write_lock = threading.Lock()
+
+    def write_batch(self, events):
+        """Record a written batch, failing on events marked as bad."""
+        if any(event.get('bad') for event in events):
+            raise ValueError('bad event')
+        with self.write_lock:
+            self.batches.append(list(events))
+
+    def written(self):
+        """Get all written events, in order."""
+        return [event['index'] for batch in self.batches for event in batch]
+
+
+class BatchingTest(EventBufferBaseTest):
+    """Batching test."""
+
+    def test_batch_size(self):
+        """Test that full batches are written together."""
+        buffer = event_buffer.EventBuffer(self.write_batch, max_batch_size=10, max_delay=10)
+        for index in range(30):
+            buffer.put({'index': index})
+        buffer.flush()
+        self.assertEqual(self.written(), list(range(30)))
+        self.assertEqual([len(batch) for batch in self.batches], [10, 10, 10])
+        buffer.stop()
+
+    def test_max_delay(self):
+        """Test that a partial batch is written after the maximal delay."""
+        buffer = event_buffer.EventBuffer(self.write_batch, max_batch_size=100, max_delay=0.02)
+        for index in range(3):
+            buffer.put({'index': index})
+        deadline = time.monotonic() + 2
+        while not self.batches and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(self.written(), [0, 1, 2])
+        buffer.stop()
+
+    def test_concurrent_producers(self):
+        """Test that events from many threads are all written."""
+        buffer = event_buffer.EventBuffer(self.write_batch, max_batch_size=50, max_delay=0.01)
+        threads = [
+            threading.Thread(target=lambda base=base: [buffer.put({'index': base + index}) for index in range(100)])
+            for base in range(0, 800, 100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        buffer.stop()
+        self.assertEqual(sorted(self.written()), list(range(800)))
+        self.assertLess(len(self.batches), 800)
+        self.assertEqual(buffer.stats()['written'], 800)
+
+
+class FlushTest(EventBufferBaseTest):
+    """Flushing test."""
+
+    def test_stop_flushes(self):
+        """Test that stopping the buffer writes everything queued."""
+        buffer = event_buffer.EventBuffer(self.write_batch, max_batch_size=1000, max_delay=60)
+        for index in range(5):
+            buffer.put({'index': index})
+        buffer.stop()
+        self.assertEqual(self.written(), list(range(5)))
+        self.assertFalse(buffer.flusher.is_alive())
+
+    def test_flush_without_flusher(self):
+        """Test flushing a buffer whose flusher is not running."""
+        buffer = event_buffer.EventBuffer(self.write_batch)
+        buffer.flush()
+        self.assertEqual(self.batches, [])
+
+
+class FailureTest(EventBufferBaseTest):
+    """Failure isolation test."""
+
+    def test_bad_event(self):
+        """Test that a bad event is dropped without taking its batch down."""
+        buffer = event_buffer.EventBuffer(self.write_batch, max_batch_size=5, max_delay=60)
+        for index in range(5):
+            buffer.put({'index': index, 'bad': index == 2})
+        buffer.flush()
+        self.assertEqual(self.written(), [0, 1, 3, 4])
+        self.assertEqual(buffer.stats()['dropped'], 1)
+        buffer.stop()
+
+    def test_full(self):
+        """Test that a full buffer rejects events."""
+        release = threading.Event()
+        buffer = event_buffer.EventBuffer(
+            lambda events: release.wait(), max_batch_size=1, max_delay=0, max_queue_size=2, put_timeout=0.01)
+        with self.assertRaises(event_buffer.BufferFull):
+            for index in range(10):
+                buffer.put({'index': index})
+        release.set()
+        buffer.stop()
+
+    def test_failing_callback(self):
+        """Test that a failing on_written callback is called once per batch, without writing its events again."""
+        calls = []
+
+        def on_written(events):
+            calls.append([event['index'] for event in events])
+            raise ValueError('callback failed')
+
+        buffer = event_buffer.EventBuffer(self.write_batch, max_batch_size=5, max_delay=60, on_written=on_written)
+        for index in range(5):
+            buffer.put({'index': index})
+        buffer.flush()
+        self.assertEqual(self.written(), list(range(5)))
+        self.assertEqual(calls, [list(range(5))])
+        self.assertEqual(buffer.stats()['dropped'], 0)
+        buffer.stop()
@@ -0,0 +1,43 @@
+"""Test the PAKET API geographic helpers."""
+import unittest
+
+import geo
+
+LONDON = 51.4983407, -0.173709
+PARIS = 48.8566, 2.3522
+
+
+class ParseLocationTest(unittest.TestCase):
+    """Location parsing test."""
+
+    def test_parse(self):
+        """Test parsing valid and invalid locations."""
+        self.assertEqual(geo.parse_location('51.4983407,-0.173709'), LONDON)
+        self.assertEqual(geo.parse_location(' 1.5 , 2 '), (1.5, 2.0))
+        for location in (None, '', 'home', '1,2,3', '91,0', '0,181'):
+            self.assertEqual(geo.parse_location(location), (None, None), location)
+
+
+class DistanceTest(unittest.TestCase):
+    """Distance and bounding box test."""
+
+    def test_distance(self):
+        """Test the distance between known cities."""
+        self.assertAlmostEqual(geo.distance_km(*LONDON, *PARIS), 344, delta=2)
+        self.assertEqual(geo.distance_km(*LONDON, *LONDON), 0)
+
+    def test_bounding_box(self):
+        """Test that a bounding box contains its circle, and nothing much farther."""
+        min_latitude, max_latitude, min_longitude, max_longitude = geo.bounding_box(*LONDON, 10)
+        self.assertTrue(min_latitude < LONDON[0] < max_latitude and min_longitude < LONDON[1] < max_longitude)
+        for latitude, longitude in (
+                (min_latitude, LONDON[1]), (max_latitude, LONDON[1]),
+                (LONDON[0], min_longitude), (LONDON[0], max_longitude)):
+            self.assertAlmostEqual(geo.distance_km(*LONDON, latitude, longitude), 10, delta=0.1)
+
+    def test_edge_boxes(self):
+        """Test boxes reaching a pole or crossing the antimeridian."""
+        self.assertEqual(geo.bounding_box(89.99, 0, 10)[1:], (90, -180, 180))
+        self.assertEqual(geo.bounding_box(0, 179.99, 10)[2:], (-180, 180))
+        with self.assertRaises(ValueError):
+            geo.bounding_box(0, 0, -1)
@@ -0,0 +1,99 @@
+"""Test reading the tail of log files."""
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import logs
+
+LOG_LINES = [
+    '2018-08-03 12:00:00,000 pkt.api INFO calling package\n',
+    '2018-08-03 12:00:01,000 pkt.db DEBUG selecting package\n',
+    '2018-08-03 12:00:02,000 pkt.db ERROR query failed\n',
+    'Traceback (most recent call last):\n',
+    '  File "db.py", line 1, in get_package\n',
+    'ValueError: bad package\n',
+    '2018-08-03 12:00:03,000 pkt.dbx WARNING not a child logger\n',
+    '2018-08-03 12:00:04,000 pkt.api.test INFO test done ✓\n']
+
+
+class CountingBytesIO(io.BytesIO):
+    """In memory binary file counting the bytes read from it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_bytes = 0
+
+    def read(self, *args, **kwargs):
+        data = super().read(*args, **kwargs)
+        self.read_bytes += len(data)
+        return data
+
+
+class ReadLinesBackwardTest(unittest.TestCase):
+    """Test reading files backward."""
+
+    def test_lines(self):
+        """Test that lines are those of readlines, in reverse order, whatever the block size."""
+        contents = ''.join(LOG_LINES)
+        for content in (contents, contents[:-1], '\n\nlast', '', '\n'):
+            for block_size in (1, 2, 7, 1024):
+                self.assertEqual(
+                    list(logs.read_lines_backward(io.BytesIO(content.encode()), block_size)),
+                    io.StringIO(content).readlines()[::-1], "block size {}: {!r}".format(block_size, content))
+
+    def test_reads_needed_blocks(self):
+        """Test that only the blocks holding the consumed lines are read."""
+        logfile = CountingBytesIO(''.join(LOG_LINES * 10000).encode())
+        lines = logs.read_lines_backward(logfile, 1024)
+        self.assertEqual([next(lines) for _ in range(3)], LOG_LINES[:-4:-1])
+        self.assertEqual(logfile.read_bytes, 1024)
+
+    def test_max_bytes(self):
+        """Test that reading stops max_bytes before the end, dropping the cut line."""
+        content = ''.join(LOG_LINES).encode()
+        last_lines_size = len(''.join(LOG_LINES[-2:]).encode())
+        self.assertEqual(
+            list(logs.read_lines_backward(io.BytesIO(content), 16, last_lines_size + 5)), LOG_LINES[:-3:-1])
+
+
+class TailTest(unittest.TestCase):
+    """Test getting the filtered tail of a log file."""
+
+    def setUp(self):
+        """Write a log file."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'test.log')
+        with open(self.path, 'w', encoding='utf8') as logfile:
+            logfile.writelines(LOG_LINES)
+
+    def tail(self, lines_num=100, **kwargs):
+        """Get the tail of the log file as a list."""
+        return list(logs.tail(self.path, lines_num, block_size=16, **kwargs))
+
+    def test_tail(self):
+        """Test getting the last lines, newest first."""
+        self.assertEqual(self.tail(2), LOG_LINES[:-3:-1])
+        self.assertEqual(self.tail(), LOG_LINES[::-1])
+
+    def test_filters(self):
+        """Test filtering by level, logger and substring, with lines without a level going with their record."""
+        self.assertEqual(self.tail(level='error'), LOG_LINES[5:1:-1])
+        self.assertEqual(self.tail(level='WARN'), LOG_LINES[6:1:-1])
+        self.assertEqual(self.tail(logger_name='pkt.db'), LOG_LINES[5:0:-1])
+        self.assertEqual(self.tail(logger_name='pkt.api'), [LOG_LINES[7], LOG_LINES[0]])
+        self.assertEqual(self.tail(logger_name='pkt.db', substring='bad package'), LOG_LINES[5:1:-1])
+        self.assertEqual(self.tail(1, level='INFO', logger_name='pkt.api'), [LOG_LINES[7]])
+        self.assertEqual(self.tail(substring='no such line'), [])
+
+    def test_invalid(self):
+        """Test that invalid filters, missing files and invalid lines_num raise at once."""
+        with self.assertRaises(ValueError):
+            logs.tail(self.path, 10, level='LOUD')
+        with self.assertRaises(OSError):
+            logs.tail(os.path.join(self.directory, 'missing.log'), 10)
+        for lines_num in (0, -1, '10', 1.5, None):
+            with self.assertRaises(ValueError):
+                logs.tail(self.path, lines_num)
@@ -0,0 +1,102 @@
+"""Test the PAKET API courier to package matching engine."""
+import random
+import time
+import unittest
+
+import geo
+import matching
+
+NOW = 1500000000
+
+
+def package(escrow_pubkey, latitude, longitude, payment=100, collateral=100, deadline=NOW + 86400):
+    """Describe a package waiting for pickup."""
+    return dict(
+        escrow_pubkey=escrow_pubkey, latitude=latitude, longitude=longitude, payment=payment,
+        collateral=collateral, deadline=deadline)
+
+
+class MatchingBaseTest(unittest.TestCase):
+    """Base class for matching engine tests."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.packages = []
+        self.couriers = []
+        self.engine = matching.MatchingEngine(lambda: self.packages, lambda: self.couriers, max_distance_km=50)
+
+    def suggested(self, latitude, longitude, top_k=10):
+        """Get the escrow pubkeys suggested at a position."""
+        self.engine.refresh(force=True)
+        return [
+            suggestion['escrow_pubkey']
+            for suggestion in self.engine.suggest([(latitude, longitude)], top_k, now=NOW)[0]]
+
+
+class ScoringTest(MatchingBaseTest):
+    """Scoring test."""
+
+    def test_distance(self):
+        """Test that closer packages come first, and that packages out of reach are not suggested."""
+        self.packages = [package('far', 51.7, -0.17), package('near', 51.51, -0.17), package('paris', 48.86, 2.35)]
+        self.assertEqual(self.suggested(51.5, -0.17), ['near', 'far'])
+        self.engine.refresh(force=True)
+        suggestion = self.engine.suggest([(51.5, -0.17)], now=NOW)[0][0]
+        self.assertAlmostEqual(suggestion['distance_km'], geo.distance_km(51.5, -0.17, 51.51, -0.17), places=6)
+
+    def test_weights(self):
+        """Test that payment, collateral and deadline weigh in."""
+        self.packages = [package('cheap', 51.5, -0.17, payment=10), package('rich', 51.51, -0.17, payment=100)]
+        self.assertEqual(self.suggested(51.5, -0.17), ['rich', 'cheap'])
+        self.packages = [
+            package('secured', 51.5, -0.17, collateral=100), package('light', 51.51, -0.17, collateral=1)]
+        self.assertEqual(self.suggested(51.5, -0.17), ['light', 'secured'])
+        self.packages = [
+            package('later', 51.5, -0.17, deadline=NOW + 86400), package('urgent', 51.51, -0.17, deadline=NOW + 60),
+            package('expired', 51.5, -0.17, deadline=NOW - 60)]
+        self.assertEqual(self.suggested(51.5, -0.17), ['urgent', 'later'])
+
+    def test_top_k(self):
+        """Test that at most top_k packages are suggested."""
+        self.packages = [package(str(index), 51.5 + index / 1000, -0.17) for index in range(20)]
+        self.assertEqual(self.suggested(51.5, -0.17, 3), ['0', '1', '2'])
+
+
+class CourierTest(MatchingBaseTest):
+    """Courier matching test."""
+
+    def test_known_position(self):
+        """Test suggesting packages at the last known position of a courier."""
+        deadline = time.time() + 86400
+        self.packages = [
+            package('london', 51.5, -0.17, deadline=deadline), package('paris', 48.86, 2.35, deadline=deadline)]
+        self.couriers = [{'user_pubkey': 'courier', 'latitude': 48.85, 'longitude': 2.35}]
+        self.assertEqual(
+            [suggestion['escrow_pubkey'] for suggestion in self.engine.suggest_for_courier('courier')], ['paris'])
+        self.assertEqual(
+            [suggestion['escrow_pubkey'] for suggestion in self.engine.suggest_for_courier('courier', 51.5, -0.17)],
+            ['london'])
+        with self.assertRaises(matching.UnknownCourier):
+            self.engine.suggest_for_courier('stranger')
+
+    def test_batch(self):
+        """Test that batch matching agrees with matching couriers one by one, and is fast."""
+        randomizer = random.Random(0)
+        self.packages = [
+            package(str(index), randomizer.uniform(45, 55), randomizer.uniform(-5, 5),
+                    randomizer.randint(1, 100), randomizer.randint(1, 100), NOW + randomizer.randint(-3600, 86400))
+            for index in range(10000)]
+        self.couriers = [
+            {'user_pubkey': str(index), 'latitude': randomizer.uniform(45, 55),
+             'longitude': randomizer.uniform(-5, 5)}
+            for index in range(1000)]
+        self.engine.refresh(force=True)
+        started_at = time.perf_counter()
+        suggestions = self.engine.suggest(
+            [(courier['latitude'], courier['longitude']) for courier in self.couriers], 5, now=NOW)
+        # Matching a thousand couriers against ten thousand packages takes about 100ms.
+        self.assertLess(time.perf_counter() - started_at, 0.5, 'batch matching is not in the milliseconds range')
+        for index in (0, 499, 999):
+            courier = self.couriers[index]
+            self.assertEqual(
+                suggestions[index], self.engine.suggest([(courier['latitude'], courier['longitude'])], 5, now=NOW)[0])
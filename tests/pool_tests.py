@@ -0,0 +1,238 @@
+"""Test the PAKET API database connection pool."""
+import threading
+import time
+import unittest
+
+import pool
+
+
+class MockConnection:
+    """Mock database connection."""
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def is_connected(self):
+        """Check if connection is alive."""
+        return self.alive
+
+    def cursor(self, dictionary=False):
+        """Get a mock cursor."""
+        assert dictionary, 'pool must ask for dictionary cursors'
+        return MockCursor()
+
+    def commit(self):
+        """Commit transaction."""
+        self.commits += 1
+
+    def rollback(self):
+        """Rollback transaction."""
+        self.rollbacks += 1
+
+    def close(self):
+        """Close connection."""
+        self.closed = True
+
+
+# pylint: disable=too-few-public-methods
+# Only the cursor methods the pool calls are mocked.
+class MockCursor:
+    """Mock database cursor."""
+
+    def close(self):
+        """Close cursor."""
+# pylint: enable=too-few-public-methods
+
+
+class PoolBaseTest(unittest.TestCase):
+    """Base class for pool tests."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.connections = []
+        self.pools = []
+
+    def tearDown(self):
+        """Close the pools, stopping their reapers."""
+        for connection_pool in self.pools:
+            connection_pool.close()
+
+    def connect(self):
+        """Open a mock connection."""
+        connection = MockConnection()
+        self.connections.append(connection)
+        return connection
+
+    def create_pool(self, **kwargs):
+        """Create a pool of mock connections."""
+        connection_pool = pool.ConnectionPool(self.connect, **kwargs)
+        self.pools.append(connection_pool)
+        return connection_pool
+
+    def wait_for(self, condition, timeout=5):
+        """Wait until a condition holds."""
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'condition still false')
+            time.sleep(0.005)
+
+
+class ReuseTest(PoolBaseTest):
+    """Connection reuse test."""
+
+    def test_reuse(self):
+        """Test that sequential calls share a single connection and commit each transaction."""
+        connection_pool = self.create_pool()
+        for _ in range(5):
+            with connection_pool.sql_connection():
+                pass
+        self.assertEqual(len(self.connections), 1, "expected 1 connection, {} opened".format(len(self.connections)))
+        self.assertEqual(self.connections[0].commits, 5)
+        stats = connection_pool.stats()
+        self.assertEqual(stats['checkouts'], 5)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_rollback(self):
+        """Test that a failing block is rolled back and its connection reused."""
+        connection_pool = self.create_pool()
+        with self.assertRaises(ZeroDivisionError):
+            with connection_pool.sql_connection():
+                _ = 1 / 0
+        self.assertEqual(self.connections[0].rollbacks, 1)
+        self.assertEqual(self.connections[0].commits, 0)
+        with connection_pool.sql_connection():
+            pass
+        self.assertEqual(len(self.connections), 1)
+
+
+class BoundsTest(PoolBaseTest):
+    """Pool size bounds test."""
+
+    def test_exhausted(self):
+        """Test that checkout times out when all connections are in use."""
+        connection_pool = self.create_pool(max_size=2, checkout_timeout=0.05)
+        first, second = connection_pool.checkout(), connection_pool.checkout()
+        with self.assertRaises(pool.PoolExhausted):
+            connection_pool.checkout()
+        self.assertEqual(connection_pool.stats()['timeouts'], 1)
+        connection_pool.checkin(first)
+        connection_pool.checkin(second)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_waiting(self):
+        """Test that a waiting checkout gets a connection as soon as one is returned."""
+        connection_pool = self.create_pool(max_size=1, checkout_timeout=5)
+        pooled = connection_pool.checkout()
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(connection_pool.checkout()))
+        waiter.start()
+        while connection_pool.stats()['waiting'] == 0:
+            time.sleep(0.001)
+        connection_pool.checkin(pooled)
+        waiter.join()
+        self.assertIs(results[0], pooled)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_concurrency(self):
+        """Test that concurrent users never exceed the maximal size."""
+        connection_pool = self.create_pool(max_size=3)
+        peak = []
+
+        def use_pool():
+            """Use a connection for a while."""
+            for _ in range(20):
+                with connection_pool.sql_connection():
+                    peak.append(connection_pool.stats()['in_use'])
+                    time.sleep(0.0005)
+
+        threads = [threading.Thread(target=use_pool) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(max(peak), 3)
+        self.assertLessEqual(len(self.connections), 3)
+        self.assertEqual(connection_pool.stats()['checkouts'], 160)
+
+
+class ExpiryTest(PoolBaseTest):
+    """Connection expiry and health test."""
+
+    def test_health_check(self):
+        """Test that dead connections are replaced on checkout."""
+        connection_pool = self.create_pool()
+        with connection_pool.sql_connection():
+            pass
+        self.connections[0].alive = False
+        with connection_pool.sql_connection():
+            pass
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+
+    def test_max_lifetime(self):
+        """Test that old connections are closed."""
+        connection_pool = self.create_pool(max_lifetime=0.01)
+        with connection_pool.sql_connection():
+            pass
+        time.sleep(0.02)
+        with connection_pool.sql_connection():
+            pass
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+
+    def test_idle_timeout(self):
+        """Test that idle connections are closed, except for the minimal number of connections."""
+        connection_pool = self.create_pool(min_size=1, idle_timeout=0.01)
+        first, second = connection_pool.checkout(), connection_pool.checkout()
+        connection_pool.checkin(first)
+        connection_pool.checkin(second)
+        time.sleep(0.02)
+        connection_pool.checkin(connection_pool.checkout())
+        self.assertEqual(connection_pool.stats()['size'], 1)
+        self.assertEqual(sum(connection.closed for connection in self.connections), 1)
+
+    def test_reaper(self):
+        """Test that idle connections beyond min_size are reaped without any checkout, and expired ones replaced."""
+        connection_pool = self.create_pool(min_size=1, idle_timeout=0.05, max_lifetime=0.2, reap_interval=0.01)
+        pooled_connections = [connection_pool.checkout() for _ in range(3)]
+        for pooled in pooled_connections:
+            connection_pool.checkin(pooled)
+        self.wait_for(lambda: connection_pool.stats()['size'] == 1)
+        self.assertEqual(sum(connection.closed for connection in self.connections), 2)
+        self.assertEqual(connection_pool.stats()['reaped'], 2)
+        self.wait_for(lambda: len(self.connections) == 4)
+        self.assertEqual(connection_pool.stats()['size'], 1, 'expired connection was not replaced')
+
+
+class FillTest(PoolBaseTest):
+    """Up front connections test."""
+
+    def test_min_size(self):
+        """Test that min_size connections are opened up front, and used before opening more."""
+        connection_pool = self.create_pool(min_size=2, max_size=3)
+        self.assertEqual((len(self.connections), connection_pool.stats()['idle']), (2, 2))
+        first, second = connection_pool.checkout(), connection_pool.checkout()
+        self.assertEqual(len(self.connections), 2)
+        connection_pool.checkin(first)
+        connection_pool.checkin(second)
+
+    def test_failing_connect(self):
+        """Test that failing to connect up front is not fatal, and that connections are then opened on demand."""
+        failures = [ConnectionError('database down')]
+
+        def connect():
+            """Fail once, and then connect."""
+            if failures:
+                raise failures.pop()
+            return self.connect()
+
+        connection_pool = pool.ConnectionPool(connect, min_size=1, reap_interval=0)
+        self.pools.append(connection_pool)
+        self.assertEqual(connection_pool.stats()['size'], 0)
+        with connection_pool.sql_connection():
+            pass
+        self.assertEqual(len(self.connections), 1)
@@ -0,0 +1,81 @@
+"""Test the PAKET API read replica routing."""
+import contextlib
+import unittest
+
+import replicas
+
+
+# pylint: disable=too-few-public-methods
+# Only the connection the router uses is faked.
+class FakeDatabase:
+    """A fake database, recording the reads it served."""
+
+    def __init__(self, name, lag=0):
+        self.name = name
+        self.lag = lag
+        self.down = False
+        self.reads = 0
+
+    @contextlib.contextmanager
+    def sql_connection(self):
+        """Yield the database itself in place of a cursor."""
+        if self.down:
+            raise ConnectionError("{} is down".format(self.name))
+        self.reads += 1
+        yield self
+# pylint: enable=too-few-public-methods
+
+
+class ReplicaRouterBaseTest(unittest.TestCase):
+    """Base class for replica router tests."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.primary = FakeDatabase('primary')
+        self.replicas = [FakeDatabase('replica1'), FakeDatabase('replica2')]
+        self.router = replicas.ReplicaRouter(
+            self.primary.sql_connection, [(replica.name, replica.sql_connection) for replica in self.replicas],
+            max_lag=5, lag_check_interval=0, retry_interval=60, get_lag=lambda database: database.lag)
+
+    def read(self, *keys):
+        """Read through the router, returning the name of the database that served the read."""
+        with self.router.read_connection(keys) as database:
+            return database.name
+
+
+class RoutingTest(ReplicaRouterBaseTest):
+    """Routing test."""
+
+    def test_round_robin(self):
+        """Test that reads are spread over the replicas."""
+        self.assertEqual(sorted(self.read() for _ in range(4)), ['replica1', 'replica1', 'replica2', 'replica2'])
+        self.assertEqual(self.primary.reads, 0)
+        self.assertEqual(self.router.stats()['replica_reads'], 4)
+
+    def test_lagging_replica(self):
+        """Test that a lagging replica is skipped, and the primary used when all replicas lag."""
+        self.replicas[0].lag = 60
+        self.assertEqual({self.read() for _ in range(4)}, {'replica2'})
+        self.replicas[1].lag = None
+        self.assertEqual(self.read(), 'primary')
+
+    def test_failover(self):
+        """Test that a failing replica is marked down and its read served by another database."""
+        self.replicas[0].down = True
+        self.replicas[1].down = True
+        self.assertEqual(self.read(), 'primary')
+        self.replicas[0].down = False
+        self.replicas[1].down = False
+        self.assertEqual(self.read(), 'primary', 'replica used before its retry interval')
+        self.assertTrue(all(replica['down'] for replica in self.router.stats()['replicas']))
+
+    def test_read_your_writes(self):
+        """Test that recently written keys are read from the primary."""
+        self.router.mark_written(['escrow', None])
+        self.assertEqual(self.read('escrow'), 'primary')
+        self.assertEqual(self.read('user', 'escrow'), 'primary')
+        self.assertNotEqual(self.read('user'), 'primary')
+        self.router.read_your_writes_window = 0
+        self.router.mark_written(['escrow'])
+        self.assertNotEqual(self.read('escrow'), 'primary')
+        self.assertEqual(self.router.stats()['read_your_writes'], 2)
@@ -0,0 +1,122 @@
+"""Test the PAKET API event rollups."""
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import geo
+import migrations
+import rollups
+import sqlite_engine
+
+DAY = datetime.date(2018, 8, 3)
+
+
+def event(event_type, user_pubkey, location=None, day=DAY):
+    """Describe a new event."""
+    return dict(
+        timestamp=datetime.datetime.combine(day, datetime.time(12)), escrow_pubkey=None, user_pubkey=user_pubkey,
+        event_type=event_type, location=location)
+
+
+class RollupsTest(unittest.TestCase):
+    """Rollups test, on an SQLite database."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.database = sqlite_engine.SQLiteDatabase(os.path.join(self.directory, 'test.sqlite3'))
+        migrations.migrate(self.database.sql_connection, dialect='sqlite')
+
+    def tearDown(self):
+        """Close the database."""
+        self.database.close()
+
+    def add_events(self, events, count=True):
+        """Insert events and count them in the rollups (unless count is False)."""
+        with self.database.sql_connection() as sql:
+            for new_event in events:
+                sql.execute("""
+                    INSERT INTO events (timestamp, user_pubkey, event_type, location, latitude, longitude)
+                    VALUES (%s, %s, %s, %s, %s, %s)""", (
+                        new_event['timestamp'], new_event['user_pubkey'], new_event['event_type'],
+                        new_event['location']) + geo.parse_location(new_event['location']))
+            if count:
+                rollups.update_rollups(sql, events, 'sqlite')
+
+    def get_rollups(self, region=rollups.ALL_REGIONS, event_type=None):
+        """Get the rollups of the test day and the next."""
+        with self.database.sql_connection() as sql:
+            return rollups.get_rollups(sql, DAY, DAY + datetime.timedelta(days=2), event_type, region)
+
+    def test_incremental(self):
+        """Test that events and distinct users are counted per day and event type, over several updates."""
+        self.add_events([event('couriered', 'courier1'), event('couriered', 'courier1')])
+        self.add_events([
+            event('couriered', 'courier1'), event('couriered', 'courier2'), event('installed app', 'user'),
+            event('couriered', 'courier1', day=DAY + datetime.timedelta(days=1))])
+        self.assertEqual(self.get_rollups(), [
+            {'day': '2018-08-03', 'event_type': 'couriered', 'events_num': 4, 'users_num': 2},
+            {'day': '2018-08-03', 'event_type': 'installed app', 'events_num': 1, 'users_num': 1},
+            {'day': '2018-08-04', 'event_type': 'couriered', 'events_num': 1, 'users_num': 1}])
+        self.assertEqual(len(self.get_rollups(event_type='installed app')), 1)
+
+    def test_regions(self):
+        """Test that located events are also counted in their region."""
+        self.add_events([
+            event('launched', 'launcher', '51.4983407,-0.173709'), event('launched', 'launcher', '48.85,2.35'),
+            event('launched', 'launcher')])
+        self.assertEqual(self.get_rollups()[0]['events_num'], 3)
+        self.assertEqual(self.get_rollups('51,-1')[0]['events_num'], 1)
+        self.assertEqual(self.get_rollups('48,2')[0]['events_num'], 1)
+        self.assertEqual(rollups.get_region(-0.5, -0.5), '-1,-1')
+        self.assertIsNone(rollups.get_region(None, None))
+
+    def test_statements(self):
+        """Test that a batch of events is counted with a statement for the users and one for the rollups."""
+        events = [
+            event(event_type, "user{}".format(index), location)
+            for index in range(20) for event_type in ('couriered', 'received')
+            for location in ('51.4983407,-0.173709', None)]
+        with self.database.sql_connection() as sql:
+            executed = []
+            original_execute = sql.execute
+
+            def execute(*args):
+                """Record and execute a statement."""
+                executed.append(args[0])
+                return original_execute(*args)
+
+            sql.execute = execute
+            rollups.update_rollups(sql, events, 'sqlite')
+        self.assertEqual(len(executed), 2)
+        self.assertEqual([
+            (rollup['event_type'], rollup['events_num'], rollup['users_num']) for rollup in self.get_rollups()], [
+                ('couriered', 40, 20), ('received', 40, 20)])
+        self.assertEqual([rollup['users_num'] for rollup in self.get_rollups('51,-1')], [20, 20])
+
+    def test_rebuild(self):
+        """Test that rebuilding the rollups from events gives the incrementally updated ones."""
+        self.add_events([
+            event('couriered', 'courier1', '51.5,-0.17'), event('couriered', 'courier2'),
+            event('received', 'recipient', day=DAY + datetime.timedelta(days=1))])
+        incremental = self.get_rollups(), self.get_rollups('51,-1')
+        with self.database.sql_connection() as sql:
+            self.assertEqual(rollups.rebuild_rollups(sql, 'sqlite', batch_size=2), 3)
+        self.assertEqual((self.get_rollups(), self.get_rollups('51,-1')), incremental)
+
+    def test_migration(self):
+        """Test that the rollups migration counts the existing events like the incremental updates do."""
+        events = [
+            event('couriered', 'courier1', '51.5,-0.17'), event('couriered', 'courier1', '-0.5,-0.5'),
+            event('couriered', 'courier2'), event('received', None, day=DAY + datetime.timedelta(days=1))]
+        self.add_events(events)
+        incremental = self.get_rollups(), self.get_rollups('51,-1'), self.get_rollups('-1,-1')
+        self.database.close()
+        self.database = sqlite_engine.SQLiteDatabase(os.path.join(self.directory, 'migrated.sqlite3'))
+        migrations.migrate(self.database.sql_connection, 6, 'sqlite')
+        self.add_events(events, count=False)
+        migrations.migrate(self.database.sql_connection, 7, 'sqlite')
+        self.assertEqual((self.get_rollups(), self.get_rollups('51,-1'), self.get_rollups('-1,-1')), incremental)
@@ -1,4 +1,5 @@
 """Tests for routes module"""
+import gzip
 import json
 import time
 import unittest
@@ -230,6 +231,25 @@ class PrepareSendBulsTest(ApiBaseTest):
             'prepare_send_buls', 200, 'can not prepare send from {} to {}'.format(self.funded_pubkey, pubkey),
             from_pubkey=self.funded_pubkey, to_pubkey=pubkey, amount_buls=50000000)
 
+    @unittest.skipUnless(routes.SEQUENCES, 'sequence cache disabled')
+    def test_cached_sequences(self):
+        """Test that the real transaction builders prepare consecutive transactions with a single horizon lookup."""
+        pubkey, _ = self.create_and_setup_new_account()
+        routes.SEQUENCES.resync(self.funded_pubkey)
+        misses = routes.SEQUENCES.stats()['misses']
+        transactions = [self.call(
+            'prepare_send_buls', 200, 'can not prepare send from {} to {}'.format(self.funded_pubkey, pubkey),
+            from_pubkey=self.funded_pubkey, to_pubkey=pubkey, amount_buls=50000000)['transaction'] for _ in range(3)]
+        first_sequence = routes.sequences.envelope_source_and_sequence(transactions[0])[1]
+        self.assertEqual(
+            [routes.sequences.envelope_source_and_sequence(transaction) for transaction in transactions],
+            [(self.funded_pubkey, first_sequence + offset) for offset in range(3)])
+        self.assertEqual(routes.SEQUENCES.stats()['misses'], misses + 1)
+        # Builders used outside of the prepare_* handlers still look sequence numbers up on horizon.
+        builder = paket_stellar.stellar_base.builder.Builder(
+            horizon=paket_stellar.HORIZON_SERVER, address=self.funded_pubkey)
+        self.assertEqual(int(builder.get_sequence()), first_sequence - 1)
+
 
 class PrepareEscrowTest(ApiBaseTest):
     """Test for prepare_escrow endpoint."""
@@ -330,6 +350,96 @@ class PackageTest(ApiBaseTest):
         self.assertEqual(package['collateral'], collateral)
         self.assertEqual(package['payment'], payment)
 
+    def test_not_modified(self):
+        """Test that unchanged packages are not sent again to clients that have them."""
+        escrow_stuff = self.prepare_escrow(50000000, 100000000, int(time.time()))
+        path = "/v{}/package".format(routes.VERSION)
+        data = {'escrow_pubkey': escrow_stuff['escrow'][0]}
+        response = self.app.post(path, data=data)
+        etag = response.headers['ETag']
+        response = self.app.post(path, data=data, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertNotEqual(self.app.post(path, data=dict(data, view='summary')).headers['ETag'], etag)
+        routes.db.add_event(escrow_stuff['escrow'][0], escrow_stuff['launcher'][0], 'changed location', None)
+        self.assertEqual(self.app.post(path, data=data, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_compression(self):
+        """Test that large responses are compressed for clients accepting it."""
+        escrow_stuff = self.prepare_escrow(50000000, 100000000, int(time.time()))
+        path = "/v{}/package".format(routes.VERSION)
+        data = {'escrow_pubkey': escrow_stuff['escrow'][0]}
+        response = self.app.post(path, data=data)
+        self.assertNotIn('Content-Encoding', response.headers)
+        compressed_response = self.app.post(path, data=data, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed_response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed_response.headers['Vary'])
+        self.assertLess(len(compressed_response.data), len(response.data))
+        self.assertEqual(json.loads(gzip.decompress(compressed_response.data)), json.loads(response.data))
+
+
+class PackagesByIdsTest(ApiBaseTest):
+    """Test for packages_by_ids endpoint."""
+
+    def test_packages_by_ids(self):
+        """Test getting several packages at once."""
+        escrow_stuff = self.prepare_escrow(50000000, 100000000, int(time.time()))
+        escrow_pubkey = escrow_stuff['escrow'][0]
+        packages = self.call(
+            'packages_by_ids', 200, 'can not get packages',
+            escrow_pubkeys="unknown pubkey,{}".format(escrow_pubkey))['packages']
+        self.assertEqual([package['escrow_pubkey'] for package in packages], ['unknown pubkey', escrow_pubkey])
+        self.assertIn('error', packages[0])
+        self.assertEqual(packages[1]['package'], self.call(
+            'package', 200, 'can not get package', escrow_pubkey=escrow_pubkey)['package'])
+        self.call('packages_by_ids', 400, 'accepted an empty list', escrow_pubkeys=' , ')
+        self.call('packages_by_ids', 400, 'accepted too many pubkeys', escrow_pubkeys=','.join(
+            [escrow_pubkey] * (routes.MAX_PACKAGES_BY_IDS + 1)))
+
+
+class BatchTest(ApiBaseTest):
+    """Test for batch route."""
+
+    def subrequest(self, path, seed=None, **kwargs):
+        """Describe a batched call, signed with seed if given."""
+        headers = {}
+        if seed:
+            fingerprint = webserver.validation.generate_fingerprint(
+                "{}/v{}/{}".format(self.host, routes.VERSION, path), kwargs)
+            headers = {
+                'Pubkey': paket_stellar.get_keypair(seed=seed).address().decode(), 'Fingerprint': fingerprint,
+                'Signature': webserver.validation.sign_fingerprint(fingerprint, seed)}
+        return {'path': "/v{}/{}".format(routes.VERSION, path), 'data': kwargs, 'headers': headers}
+
+    def test_batch(self):
+        """Test that batched calls get the responses of standalone calls, in order."""
+        escrow_stuff = self.prepare_escrow(50000000, 100000000, int(time.time()))
+        escrow_pubkey = escrow_stuff['escrow'][0]
+        requests = [
+            self.subrequest('package', escrow_pubkey=escrow_pubkey),
+            self.subrequest('bul_account', queried_pubkey=self.funded_pubkey),
+            self.subrequest('my_packages', escrow_stuff['launcher'][1], user_pubkey=escrow_stuff['launcher'][0]),
+            self.subrequest('no_such_call'),
+            self.subrequest('batch', requests='[]')]
+        responses = self.call('batch', 200, 'batch failed', requests=json.dumps(requests))['responses']
+        self.assertEqual([response['status'] for response in responses], [200, 200, 200, 404, 400])
+        standalone = self.call('package', 200, 'can not get package', escrow_pubkey=escrow_pubkey)
+        self.assertEqual(responses[0]['body']['package'], standalone['package'])
+        self.assertEqual(responses[2]['body']['packages'][0]['escrow_pubkey'], escrow_pubkey)
+
+        requests = [self.subrequest('package', escrow_pubkey=escrow_pubkey)]
+        requests[0]['headers']['If-None-Match'] = responses[0]['etag']
+        responses = self.call('batch', 200, 'batch failed', requests=json.dumps(requests))['responses']
+        self.assertEqual(responses[0]['status'], 304)
+
+    def test_invalid_batch(self):
+        """Test that invalid batches are rejected."""
+        self.call('batch', 400, 'accepted an invalid batch', requests='not json')
+        self.call('batch', 400, 'accepted an empty batch', requests='[]')
+        self.call('batch', 400, 'accepted a request without path', requests='[{"data": {}}]')
+        self.call('batch', 400, 'accepted a huge batch', requests=json.dumps(
+            [self.subrequest('stats')] * (routes.BATCH_MAX_REQUESTS + 1)))
+
 
 class AddEventTest(ApiBaseTest):
     """Test for add_event endpoint."""
@@ -344,3 +454,15 @@ class AddEventTest(ApiBaseTest):
             path='add_event', expected_code=200,
             fail_message='could not add event', seed=escrow_stuff['launcher'][1],
             escrow_pubkey=escrow_stuff['escrow'][0], event_type='package launched', location='32.1245, 22.43153')
+
+
+class DebugLogTest(ApiBaseTest):
+    """Test for the debug log endpoints."""
+
+    def test_invalid_lines_num(self):
+        """Test that a lines_num that is not a positive integer is rejected before streaming."""
+        for lines_num in ('-1', '0', 'ten'):
+            response = self.app.get("/v{}/debug/log.txt?lines_num={}".format(routes.VERSION, lines_num))
+            self.assertEqual(response.status_code, 400, "accepted lines_num {}".format(lines_num))
+            self.assertEqual(response.mimetype, 'application/json')
+            self.call('debug/log', 400, "accepted lines_num {}".format(lines_num), lines_num=lines_num)
@@ -0,0 +1,140 @@
+"""Test the PAKET API sequence number cache."""
+import base64
+import concurrent.futures
+import struct
+import time
+import unittest
+
+import sequences
+
+ZERO_ACCOUNT = 'GAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAWHF'
+
+
+def envelope(sequence, ed25519_key=bytes(32)):
+    """Build the XDR of a transaction envelope (truncated after the sequence number)."""
+    return base64.b64encode(struct.pack('>i32sIq', 0, ed25519_key, 100, sequence) + bytes(16)).decode()
+
+
+# pylint: disable=too-few-public-methods
+# Only the lookup the builders make is stood in for.
+class LocalHorizon:
+    """A stand-in for Horizon sequence number lookups, counting them."""
+
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.lookups = 0
+
+    def get_sequence(self):
+        """Get the sequence number of an account, as a string like Horizon does."""
+        self.lookups += 1
+        return str(self.sequence)
+# pylint: enable=too-few-public-methods
+
+
+# pylint: disable=too-few-public-methods
+# Only the lookup the hook wraps is stood in for.
+class LocalBuilder:
+    """A stand-in for a transaction builder class, looking sequence numbers up on a LocalHorizon."""
+    horizon = None
+
+    def __init__(self, address):
+        self.address = address
+
+    def get_sequence(self):
+        """Get the sequence number of the builder's account."""
+        return self.horizon.get_sequence()
+# pylint: enable=too-few-public-methods
+
+
+class EnvelopeTest(unittest.TestCase):
+    """Transaction envelope parsing test."""
+
+    def test_source_and_sequence(self):
+        """Test getting the source account and the sequence number of an envelope."""
+        self.assertEqual(sequences.encode_account_id(bytes(32)), ZERO_ACCOUNT)
+        self.assertEqual(sequences.envelope_source_and_sequence(envelope(2 ** 40 + 1)), (ZERO_ACCOUNT, 2 ** 40 + 1))
+        other_account = sequences.envelope_source_and_sequence(envelope(1, bytes(range(32))))[0]
+        self.assertTrue(other_account.startswith('G') and len(other_account) == 56 and other_account != ZERO_ACCOUNT)
+        for invalid_envelope in ('not base64!', base64.b64encode(b'short').decode(), None):
+            self.assertIsNone(sequences.envelope_source_and_sequence(invalid_envelope))
+
+
+class SequenceManagerTest(unittest.TestCase):
+    """Sequence number cache test."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.horizon = LocalHorizon(100)
+        self.manager = sequences.SequenceManager(ttl=60)
+
+    def lookup(self):
+        """Look the sequence number of the zero account up."""
+        return self.manager.lookup(ZERO_ACCOUNT, self.horizon.get_sequence)
+
+    def prepare(self, builder_class, transactions_num):
+        """
+        Prepare transactions for the zero account like the prepare_* handlers do, taking a moment to build them.
+        Returns their sequence numbers.
+        """
+        with self.manager.serving():
+            sequence = builder_class(ZERO_ACCOUNT).get_sequence()
+            time.sleep(0.001)
+            transactions = [envelope(int(sequence) + offset) for offset in range(1, transactions_num + 1)]
+            self.manager.advance_envelopes(*transactions)
+        return [sequences.envelope_source_and_sequence(transaction)[1] for transaction in transactions]
+
+    def test_consecutive(self):
+        """Test that transactions prepared in a row follow each other, with a single lookup."""
+        self.assertEqual([self.lookup() for _ in range(2)], [100, 100])
+        self.manager.advance_envelopes(envelope(102), None)
+        self.assertEqual(self.lookup(), 102)
+        self.manager.advance(ZERO_ACCOUNT, 101)
+        self.assertEqual(self.lookup(), 102, 'sequence number went back')
+        self.assertEqual(self.horizon.lookups, 1)
+        stats = self.manager.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['advances']), (3, 1, 1))
+
+    def test_concurrent(self):
+        """Test that concurrent prepares of several transactions never use the same sequence number."""
+        builder_class = type('HookedBuilder', (LocalBuilder,), {'horizon': self.horizon})
+        self.manager.hook(builder_class)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            prepared = list(executor.map(lambda _: self.prepare(builder_class, 3), range(50)))
+        self.assertEqual(sorted(sequence for block in prepared for sequence in block), list(range(101, 251)))
+        self.assertEqual(self.horizon.lookups, 1)
+
+    def test_resync(self):
+        """Test that sequence numbers are looked up again after a resync, or once they expire."""
+        self.lookup()
+        self.manager.resync(ZERO_ACCOUNT)
+        self.assertEqual(self.lookup(), 100)
+        self.manager.ttl = 0.01
+        self.manager.advance(ZERO_ACCOUNT, 102)
+        time.sleep(0.02)
+        self.horizon.sequence = 101
+        self.assertEqual(self.lookup(), 101)
+        self.assertEqual(self.horizon.lookups, 3)
+
+    def test_hook(self):
+        """Test that hooked builders use the cache within serving() blocks only, with one lookup per block."""
+        builder_class = type('HookedBuilder', (LocalBuilder,), {'horizon': self.horizon})
+        self.manager.hook(builder_class)
+        self.assertEqual(builder_class(ZERO_ACCOUNT).get_sequence(), '100')
+        self.assertEqual(self.prepare(builder_class, 2), [101, 102])
+        with self.manager.serving():
+            self.assertEqual([builder_class(ZERO_ACCOUNT).get_sequence() for _ in range(2)], [102, 102])
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                self.assertEqual(executor.submit(builder_class(ZERO_ACCOUNT).get_sequence).result(), '100')
+        self.assertEqual(self.horizon.lookups, 3)
+
+    def test_held_account(self):
+        """Test that a block waiting too long for an account held by another one looks its sequence number up."""
+        builder_class = type('HookedBuilder', (LocalBuilder,), {'horizon': self.horizon})
+        self.manager.hook(builder_class)
+        self.manager.lock_timeout = 0.01
+        with self.manager.serving():
+            self.assertEqual(builder_class(ZERO_ACCOUNT).get_sequence(), 100)
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                self.assertEqual(executor.submit(self.prepare, builder_class, 1).result(), [101])
+        self.assertEqual((self.horizon.lookups, self.manager.stats()['lock_timeouts']), (2, 1))
+        self.assertEqual(self.prepare(builder_class, 1), [102])
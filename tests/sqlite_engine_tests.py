@@ -0,0 +1,105 @@
+"""Test the PAKET API embedded SQLite engine."""
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import migrations
+import sqlite_engine
+
+
+class SQLiteBaseTest(unittest.TestCase):
+    """Base class for SQLite engine tests."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.database = sqlite_engine.SQLiteDatabase(os.path.join(self.directory, 'test.sqlite3'))
+        migrations.migrate(self.database.sql_connection, dialect='sqlite')
+
+    def tearDown(self):
+        """Close the database."""
+        self.database.close()
+
+
+class SQLiteConnectionTest(SQLiteBaseTest):
+    """SQLite connection test."""
+
+    def test_round_trip(self):
+        """Test MySQL style placeholders, dictionary rows and timestamps."""
+        timestamp = datetime.datetime(2018, 1, 2, 3, 4, 5)
+        with self.database.sql_connection() as sql:
+            sql.execute(
+                'INSERT INTO events (timestamp, user_pubkey, event_type) VALUES (%s, %s, %s)',
+                (timestamp, 'user', 'installed app'))
+        with self.database.sql_connection() as sql:
+            sql.execute('SELECT timestamp, user_pubkey FROM events WHERE timestamp >= %s', (timestamp,))
+            self.assertEqual(sql.fetchall(), [{'timestamp': timestamp, 'user_pubkey': 'user'}])
+
+    def test_rollback(self):
+        """Test that a failed transaction is rolled back."""
+        with self.assertRaises(ValueError):
+            with self.database.sql_connection() as sql:
+                sql.execute("INSERT INTO packages (escrow_pubkey) VALUES (%s)", ('escrow',))
+                raise ValueError('failure')
+        with self.database.sql_connection() as sql:
+            sql.execute('SELECT COUNT(*) AS packages_num FROM packages')
+            self.assertEqual(sql.fetchone()['packages_num'], 0)
+
+    def test_connection_per_thread(self):
+        """Test that each thread reads the committed writes of others, on its own connection."""
+        with self.database.sql_connection() as sql:
+            sql.execute("INSERT INTO packages (escrow_pubkey) VALUES (%s)", ('escrow',))
+        counts = []
+
+        def count_packages():
+            """Count packages from another thread."""
+            with self.database.sql_connection() as sql:
+                sql.execute('SELECT COUNT(*) AS packages_num FROM packages')
+                counts.append(sql.fetchone()['packages_num'])
+        threads = [threading.Thread(target=count_packages) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counts, [1, 1, 1])
+        self.assertEqual(self.database.stats()['connections'], 4)
+
+    def test_wal(self):
+        """Test that the database is in WAL mode."""
+        with self.database.sql_connection() as sql:
+            sql.execute('PRAGMA journal_mode')
+            self.assertEqual(sql.fetchone()['journal_mode'], 'wal')
+
+
+class SQLiteMigrationsTest(SQLiteBaseTest):
+    """SQLite schema migrations test."""
+
+    def test_schema(self):
+        """Test that the schema is migrated to the latest version, with its indexes."""
+        self.assertEqual(
+            migrations.get_schema_version(self.database.sql_connection, 'sqlite'), migrations.LATEST_VERSION)
+        self.assertEqual(
+            migrations.migrate(self.database.sql_connection, dialect='sqlite'), migrations.LATEST_VERSION)
+        with self.database.sql_connection() as sql:
+            sql.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'events'")
+            self.assertIn('events_escrow_pubkey_timestamp', [row['name'] for row in sql.fetchall()])
+            sql.execute(
+                'EXPLAIN QUERY PLAN SELECT * FROM events WHERE escrow_pubkey = %s ORDER BY timestamp', ('escrow',))
+            self.assertIn('events_escrow_pubkey_timestamp', sql.fetchone()['detail'])
+
+    def test_events_rebuild(self):
+        """Test that events written before they had an id keep their order when the table is rebuilt."""
+        database = sqlite_engine.SQLiteDatabase(os.path.join(self.directory, 'old.sqlite3'))
+        migrations.migrate(database.sql_connection, 1, 'sqlite')
+        with database.sql_connection() as sql:
+            for event_type in ('first', 'second'):
+                sql.execute('INSERT INTO events (event_type) VALUES (%s)', (event_type,))
+        migrations.migrate(database.sql_connection, dialect='sqlite')
+        with database.sql_connection() as sql:
+            sql.execute('SELECT id, event_type FROM events ORDER BY id')
+            self.assertEqual(sql.fetchall(), [{'id': 1, 'event_type': 'first'}, {'id': 2, 'event_type': 'second'}])
+        database.close()
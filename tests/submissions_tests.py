@@ -0,0 +1,185 @@
+"""Test the PAKET API transaction submission queue."""
+import collections
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import migrations
+import sqlite_engine
+import submissions
+
+
+class LocalHorizon:
+    """A stand-in for Horizon transaction submission, failing with a scripted list of outcomes first."""
+
+    def __init__(self, outcomes=()):
+        self.outcomes = collections.deque(outcomes)
+        self.submitted = collections.Counter()
+        self.applied = set()
+        self.lock = threading.Lock()
+
+    def submit(self, transaction):
+        """Submit a transaction envelope, like paket_stellar.submit_transaction_envelope."""
+        with self.lock:
+            self.submitted[transaction] += 1
+            outcome = self.outcomes.popleft() if self.outcomes else {'hash': transaction, 'ledger': 1}
+        if isinstance(outcome, Exception):
+            raise outcome
+        if 'status' not in outcome:
+            self.applied.add(transaction)
+        return outcome
+
+    def lookup(self, transaction):
+        """Get the record of a transaction envelope if the ledger has it, or None."""
+        return {'hash': transaction, 'ledger': 1} if transaction in self.applied else None
+
+
+class SubmissionQueueTest(unittest.TestCase):
+    """Submission queue test, on an SQLite database."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.database = sqlite_engine.SQLiteDatabase(os.path.join(self.directory, 'test.sqlite3'))
+        migrations.migrate(self.database.sql_connection, dialect='sqlite')
+        self.horizon = LocalHorizon()
+        self.queues = []
+
+    def tearDown(self):
+        """Stop the submitters and close the database."""
+        for queue in self.queues:
+            queue.stop()
+        self.database.close()
+
+    def queue(self, **kwargs):
+        """Create a submission queue on the test database, and start it like a worker does on startup."""
+        kwargs = dict(dict(max_attempts=3, backoff=0.01, poll_interval=0.01), **kwargs)
+        queue = submissions.SubmissionQueue(self.database.sql_connection, self.horizon.submit, **kwargs)
+        self.queues.append(queue)
+        queue.start()
+        return queue
+
+    def wait_for_status(self, queue, submission_id, statuses=(submissions.SUCCEEDED, submissions.FAILED)):
+        """Wait for a submission to reach one of some statuses, and return it."""
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            submission = queue.get_status(submission_id)
+            if submission['status'] in statuses:
+                return submission
+            time.sleep(0.01)
+        self.fail("submission {} is still {}".format(submission_id, submission['status']))
+
+    def test_submit(self):
+        """Test that queued transactions are submitted, and their horizon response reported."""
+        queue = self.queue()
+        submission_id = queue.enqueue('envelope')
+        submission = self.wait_for_status(queue, submission_id)
+        self.assertEqual(submission['status'], submissions.SUCCEEDED)
+        self.assertEqual((submission['attempts'], submission['response']), (1, {'hash': 'envelope', 'ledger': 1}))
+        self.assertIsNone(submission['error'])
+        with self.assertRaises(submissions.UnknownSubmission):
+            queue.get_status('unknown')
+
+    def test_retry(self):
+        """Test that failures and horizon timeouts are retried, until an attempt succeeds."""
+        self.horizon.outcomes.extend([ConnectionError('horizon unreachable'), {'status': 504, 'title': 'Timeout'}])
+        queue = self.queue()
+        submission = self.wait_for_status(queue, queue.enqueue('envelope'))
+        self.assertEqual((submission['status'], submission['attempts']), (submissions.SUCCEEDED, 3))
+        self.assertEqual(queue.stats()['retries'], 2)
+
+    def test_applied_failure(self):
+        """Test that failed attempts which were applied anyway are not submitted again."""
+        self.horizon.outcomes.append({'status': 504, 'title': 'Timeout'})
+        self.horizon.applied.add('envelope')
+        queue = self.queue(lookup=self.horizon.lookup)
+        submission = self.wait_for_status(queue, queue.enqueue('envelope'))
+        self.assertEqual((submission['status'], submission['attempts']), (submissions.SUCCEEDED, 2))
+        self.assertEqual(submission['response'], {'hash': 'envelope', 'ledger': 1})
+        self.assertEqual((self.horizon.submitted['envelope'], queue.stats()['found']), (1, 1))
+
+    def test_give_up(self):
+        """Test that submissions fail after max_attempts attempts, or at once if horizon rejects them."""
+        self.horizon.outcomes.extend([ConnectionError('horizon unreachable')] * 3)
+        queue = self.queue()
+        submission = self.wait_for_status(queue, queue.enqueue('envelope'))
+        self.assertEqual((submission['status'], submission['attempts']), (submissions.FAILED, 3))
+        self.assertEqual(submission['error'], 'horizon unreachable')
+        self.horizon.outcomes.append({'status': 400, 'title': 'Transaction Failed'})
+        submission = self.wait_for_status(queue, queue.enqueue('bad envelope'))
+        self.assertEqual((submission['status'], submission['attempts']), (submissions.FAILED, 1))
+        self.assertEqual(submission['response']['status'], 400)
+
+    def test_workers(self):
+        """Test that workers sharing the queue submit each transaction once."""
+        queues = [self.queue(submitters_num=3) for _ in range(3)]
+        submission_ids = [queues[index % 3].enqueue("envelope {}".format(index)) for index in range(30)]
+        for submission_id in submission_ids:
+            self.assertEqual(self.wait_for_status(queues[0], submission_id)['status'], submissions.SUCCEEDED)
+        self.assertEqual(set(self.horizon.submitted.values()), {1})
+        self.assertEqual(sum(queue.stats()['succeeded'] for queue in queues), 30)
+
+    def test_lease(self):
+        """Test that submissions claimed by a worker that died are claimed again once the lease expires."""
+        dead_queue = self.queue(submitters_num=0, lease=0.05)
+        submission_id = dead_queue.enqueue('envelope')
+        self.assertEqual(dead_queue.claim()['submission_id'], submission_id)
+        self.assertIsNone(dead_queue.claim())
+        queue = self.queue()
+        submission = self.wait_for_status(queue, submission_id)
+        self.assertEqual((submission['status'], submission['attempts']), (submissions.SUCCEEDED, 2))
+        self.assertEqual(self.horizon.submitted['envelope'], 1)
+
+    def test_restart(self):
+        """Test that submissions queued before a restart are drained on startup, without a new enqueue."""
+        now = datetime.datetime.now()
+        with self.database.sql_connection() as sql:
+            sql.execute("""
+                INSERT INTO transaction_submissions (
+                    submission_id, transaction_envelope, status, attempts, next_attempt_at, created_at, updated_at)
+                VALUES (%s, %s, %s, 0, %s, %s, %s)""", (
+                    'queued before restart', 'envelope', submissions.QUEUED, now, now, now))
+        queue = self.queue()
+        submission = self.wait_for_status(queue, 'queued before restart')
+        self.assertEqual((submission['status'], submission['attempts']), (submissions.SUCCEEDED, 1))
+        self.assertEqual(queue.stats()['queued'], 0)
+        self.assertEqual(self.horizon.submitted['envelope'], 1)
+
+
+class SubmitEnvelopeTest(unittest.TestCase):
+    """Synchronous submission test."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.horizon = LocalHorizon()
+        self.resynced = []
+
+    def submit(self, transaction):
+        """Submit a transaction envelope to the local horizon."""
+        return submissions.submit_envelope(transaction, self.horizon.submit, self.horizon.lookup, self.resynced.append)
+
+    def test_bad_sequence(self):
+        """Test that tx_bad_seq rejections of applied transactions return their record, and resync the others."""
+        self.horizon.applied.add('applied envelope')
+        self.horizon.outcomes.extend([
+            {'status': 400, 'extras': {'result_codes': {'transaction': 'tx_bad_seq'}}}, ValueError('tx_bad_seq')])
+        self.assertEqual(self.submit('applied envelope'), {'hash': 'applied envelope', 'ledger': 1})
+        with self.assertRaises(ValueError):
+            self.submit('envelope')
+        self.assertEqual(self.resynced, ['envelope'])
+        self.horizon.outcomes.append({'status': 400, 'extras': {'result_codes': {'transaction': 'tx_bad_seq'}}})
+        self.assertEqual(self.submit('envelope')['status'], 400)
+        self.assertEqual(self.resynced, ['envelope'] * 2)
+
+    def test_other_errors(self):
+        """Test that other errors go through, without a lookup or a resync."""
+        self.horizon.outcomes.extend([ConnectionError('horizon unreachable'), {'status': 504, 'title': 'Timeout'}])
+        with self.assertRaises(ConnectionError):
+            self.submit('envelope')
+        self.assertEqual(self.submit('envelope')['status'], 504)
+        self.assertEqual(self.resynced, [])
@@ -3,3 +3,19 @@
 # pylint: disable=unused-wildcard-import
 from tests.db_tests import *
 from tests.routes_test import *
+from tests.pool_tests import *
+from tests.event_buffer_tests import *
+from tests.cache_tests import *
+from tests.replicas_tests import *
+from tests.sqlite_engine_tests import *
+from tests.geo_tests import *
+from tests.matching_tests import *
+from tests.rollups_tests import *
+from tests.updates_tests import *
+from tests.encoding_tests import *
+from tests.accounts_tests import *
+from tests.submissions_tests import *
+from tests.sequences_tests import *
+from tests.logs_tests import *
+from tests.batches_tests import *
+from tests.db_rows_tests import *
@@ -0,0 +1,65 @@
+"""Test the PAKET API package updates fan out."""
+import threading
+import unittest
+
+import broker
+import updates
+
+CHANNEL = 'pkt.packages.events'
+
+
+def event(escrow_pubkey, timestamp='2018-08-03 12:00:00.000000'):
+    """Describe a package event."""
+    return dict(timestamp=timestamp, escrow_pubkey=escrow_pubkey, user_pubkey='user', event_type='couriered')
+
+
+class UpdatesHubTest(unittest.TestCase):
+    """Package updates hub test."""
+
+    def setUp(self):
+        """Setting up the test fixture before exercising it."""
+        self.broker = broker.LocalBroker()
+        self.hub = updates.UpdatesHub(self.broker, CHANNEL, max_queued=2)
+
+    def test_fan_out(self):
+        """Test that events reach the subscriptions of their packages, in every worker sharing the broker."""
+        other_hub = updates.UpdatesHub(self.broker, CHANNEL)
+        with self.hub.subscription(['first', 'second']) as both, self.hub.subscription(['second']) as second, \
+                other_hub.subscription(['first']) as first:
+            self.broker.publish(CHANNEL, event('first'))
+            self.broker.publish(CHANNEL, event('second'))
+            self.broker.publish(CHANNEL, event('third'))
+            self.assertEqual([new_event['escrow_pubkey'] for new_event in both.get(0)], ['first', 'second'])
+            self.assertEqual([new_event['escrow_pubkey'] for new_event in second.get(0)], ['second'])
+            self.assertEqual([new_event['escrow_pubkey'] for new_event in first.get(0)], ['first'])
+        self.assertEqual(self.hub.stats(), dict(
+            dispatched=3, delivered=3, dropped=0, subscribed_packages=0, subscriptions=0))
+
+    def test_wait(self):
+        """Test that waiting subscriptions wake up on new events, and time out without them."""
+        with self.hub.subscription(['package']) as subscription:
+            self.assertEqual(subscription.get(0.01), [])
+            timer = threading.Timer(0.05, self.broker.publish, (CHANNEL, event('package')))
+            timer.start()
+            self.assertEqual(len(subscription.get(5)), 1)
+            timer.join()
+
+    def test_full(self):
+        """Test that events are dropped for subscriptions that do not keep up, without blocking the publisher."""
+        with self.hub.subscription(['package']) as subscription:
+            for _ in range(3):
+                self.broker.publish(CHANNEL, event('package'))
+            self.assertEqual(subscription.dropped, 1)
+            self.assertEqual(len(subscription.get(0)), 2)
+        self.assertEqual(self.hub.stats()['dropped'], 1)
+
+    def test_stream(self):
+        """Test that streams start with the missed events, send heartbeats, and end after max_duration."""
+        stream = self.hub.stream(['package'], lambda: [event('package')], heartbeat_interval=0.01, max_duration=0.2)
+        self.assertEqual(len(next(stream)), 1)
+        self.assertEqual(self.hub.stats()['subscriptions'], 1)
+        self.broker.publish(CHANNEL, event('package'))
+        self.assertEqual(len(next(stream)), 1)
+        self.assertEqual(next(stream), [])
+        self.assertTrue(all(events == [] for events in stream))
+        self.assertEqual(self.hub.stats()['subscriptions'], 0)
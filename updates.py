@@ -0,0 +1,112 @@
+"""Fan out of new package events to the clients waiting for them."""
+import collections
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+LOGGER = logging.getLogger('pkt.api')
+
+
+# pylint: disable=too-few-public-methods
+# Events are put on the subscription queue by the hub, so its only method is get.
+class Subscription:
+    """The queue of new events of a set of packages, for a single client."""
+
+    def __init__(self, escrow_pubkeys, max_queued=1000):
+        self.escrow_pubkeys = frozenset(escrow_pubkeys)
+        self.queue = queue.Queue(max_queued)
+        self.dropped = 0
+
+    def get(self, timeout):
+        """Wait up to timeout seconds for new events, and return all the queued ones (possibly none)."""
+        try:
+            events = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+# pylint: enable=too-few-public-methods
+
+
+class UpdatesHub:
+    """
+    Dispatches the package events published on a broker channel to the subscriptions of their packages.
+    With a shared broker, the events recorded by any worker reach the clients of every worker.
+    """
+
+    def __init__(self, broker, channel, max_queued=1000):
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.subscriptions = collections.defaultdict(set)
+        self.counters = dict(dispatched=0, delivered=0, dropped=0)
+        broker.subscribe(channel, self.dispatch)
+
+    def dispatch(self, event):
+        """Queue an event for all the subscriptions of its package."""
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(event['escrow_pubkey'], ()))
+            self.counters['dispatched'] += 1
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(event)
+                self.counters['delivered'] += 1
+            except queue.Full:
+                # A client that does not keep up loses events rather than blocking the publisher.
+                subscription.dropped += 1
+                self.counters['dropped'] += 1
+
+    def subscribe(self, escrow_pubkeys):
+        """Start queueing the new events of some packages."""
+        subscription = Subscription(escrow_pubkeys, self.max_queued)
+        with self.lock:
+            for escrow_pubkey in subscription.escrow_pubkeys:
+                self.subscriptions[escrow_pubkey].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop queueing events for a subscription."""
+        with self.lock:
+            for escrow_pubkey in subscription.escrow_pubkeys:
+                self.subscriptions[escrow_pubkey].discard(subscription)
+                if not self.subscriptions[escrow_pubkey]:
+                    del self.subscriptions[escrow_pubkey]
+
+    @contextlib.contextmanager
+    def subscription(self, escrow_pubkeys):
+        """Context manager yielding a subscription to the new events of some packages."""
+        subscription = self.subscribe(escrow_pubkeys)
+        try:
+            yield subscription
+        finally:
+            self.unsubscribe(subscription)
+
+    def stream(self, escrow_pubkeys, catch_up=None, heartbeat_interval=15, max_duration=None):
+        """
+        Generate lists of new events of some packages, as they are dispatched.
+        catch_up is called once subscribed, to get the events that were missed before (returning a list, which is
+        generated first, even if empty).
+        An empty list is generated every heartbeat_interval seconds without events, so callers can keep their
+        connections alive. The stream ends after max_duration seconds if set.
+        """
+        started_at = time.monotonic()
+        with self.subscription(escrow_pubkeys) as subscription:
+            if catch_up:
+                yield catch_up()
+            while max_duration is None or time.monotonic() - started_at < max_duration:
+                timeout = heartbeat_interval
+                if max_duration is not None:
+                    timeout = min(timeout, max(0, max_duration - (time.monotonic() - started_at)))
+                yield subscription.get(timeout)
+
+    def stats(self):
+        """Get fan out statistics."""
+        with self.lock:
+            return dict(
+                self.counters, subscribed_packages=len(self.subscriptions),
+                subscriptions=len({
+                    subscription for subscriptions in self.subscriptions.values() for subscription in subscriptions}))